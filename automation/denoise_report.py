@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/12 15:30
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: accuracy vs latency of the watermark denoise strategies of ResNetControl
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+from loguru import logger
+
+import hcaptcha_challenger as solver
+from hcaptcha_challenger.onnx.modelhub import ModelHub
+from hcaptcha_challenger.onnx.quantize import DEFAULT_AGREEMENT_THRESHOLD
+from hcaptcha_challenger.onnx.resnet import (
+    ResNetControl,
+    ChallengeStyle,
+    DENOISE_STRATEGIES,
+    denoise,
+)
+
+assets_dir = Path(__file__).parent.parent.joinpath("assets")
+
+
+def _images(image_dir: Path) -> List[Path]:
+    return sorted(p for p in image_dir.rglob("*") if p.suffix in (".png", ".jpg", ".jpeg"))
+
+
+def _watermarked(image_paths: List[Path], force: bool) -> List[np.ndarray]:
+    images = [cv2.imread(str(p)) for p in image_paths]
+    images = [img for img in images if img is not None]
+    if force:
+        return images
+    return [img for img in images if img.shape[0] == ChallengeStyle.WATERMARK]
+
+
+def measure(
+    control: ResNetControl, images: List[np.ndarray], strategies: Tuple[str, ...]
+) -> Dict[str, Tuple[float, List[bool]]]:
+    """{ strategy: (median ms of one denoise, verdicts) }"""
+    report = {}
+    for strategy in strategies:
+        if images:
+            denoise(images[0], strategy)
+
+        elapsed, verdicts = [], []
+        for img in images:
+            start = time.perf_counter()
+            img = denoise(img, strategy)
+            elapsed.append(time.perf_counter() - start)
+            # One image per pass, --model may have a fixed batch size
+            [(prediction, _)] = control.classify_batch([img])
+            verdicts.append(prediction)
+        report[strategy] = (float(np.median(elapsed)) * 1000 if elapsed else 0.0, verdicts)
+    return report
+
+
+def print_report(name: str, report: Dict[str, Tuple[float, List[bool]]], threshold: float):
+    baseline_ms, reference = report["nlmeans"]
+    print(f"\n{name} ({len(reference)} images)")
+    print(f"{'strategy':<10} {'ms/img':>8} {'speedup':>8} {'agreement':>10} {'positive':>9}")
+
+    holding = []
+    for strategy, (ms, verdicts) in report.items():
+        agreement = np.mean([a == b for a, b in zip(verdicts, reference)]) if verdicts else 0.0
+        if agreement >= threshold:
+            holding.append((ms, strategy))
+        positive = np.mean(verdicts) if verdicts else 0.0
+        speedup = baseline_ms / ms if ms else float("inf")
+        print(f"{strategy:<10} {ms:>8.2f} {speedup:>7.1f}x {agreement:>10.2%} {positive:>9.2%}")
+
+    if holding:
+        print(f"fastest strategy within {threshold:.0%} agreement: {min(holding)[1]}")
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strategies", nargs="+", default=DENOISE_STRATEGIES)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_AGREEMENT_THRESHOLD)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Denoise every image, not only the 144px watermarked ones",
+    )
+    parser.add_argument("--model", type=Path, help="A single ResNet model instead of the assets")
+    parser.add_argument("--images", type=Path, help="Images to classify with --model")
+    args = parser.parse_args()
+
+    strategies = ("nlmeans", *[s for s in args.strategies if s != "nlmeans"])
+
+    if args.model:
+        control = ResNetControl.from_pluggable_model(cv2.dnn.readNetFromONNX(str(args.model)))
+        images = _watermarked(_images(args.images), args.force)
+        print_report(args.model.name, measure(control, images, strategies), args.threshold)
+        return
+
+    solver.install(upgrade=False)
+    modelhub = ModelHub.from_github_repo()
+    modelhub.parse_objects()
+
+    models = set(modelhub.label_alias.values())
+    for image_dir in sorted(assets_dir.joinpath("image_label_binary").iterdir()):
+        focus_name = f"{image_dir.name}.onnx"
+        if image_dir.name not in models:
+            logger.warning("Skip unknown model", focus_name=focus_name)
+            continue
+        images = _watermarked(_images(image_dir), args.force)
+        if not images:
+            logger.warning("No watermarked images, try --force", focus_name=focus_name)
+            continue
+
+        control = ResNetControl.from_pluggable_model(modelhub.match_net(focus_name))
+        print_report(focus_name, measure(control, images, strategies), args.threshold)
+
+
+if __name__ == "__main__":
+    run()
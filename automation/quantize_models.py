@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/8 16:20
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: offline accuracy gate of the INT8/FP16 model variants
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+import onnxruntime
+from loguru import logger
+
+import hcaptcha_challenger as solver
+from hcaptcha_challenger.onnx.modelhub import ModelHub
+from hcaptcha_challenger.onnx.quantize import DEFAULT_AGREEMENT_THRESHOLD, QuantizedVariant
+from hcaptcha_challenger.onnx.resnet import ResNetControl
+from hcaptcha_challenger.onnx.yolo import YOLOv8, YOLOv8Seg
+
+assets_dir = Path(__file__).parent.parent.joinpath("assets")
+
+# The largest distance in pixels between two clicks that still counts as the same answer
+POINT_TOLERANCE = 8
+
+
+def _images(image_dir: Path) -> List[Path]:
+    return sorted(p for p in image_dir.rglob("*") if p.suffix in (".png", ".jpg", ".jpeg"))
+
+
+def _input_name(model_path: Path) -> str:
+    session = onnxruntime.InferenceSession(str(model_path), providers=["CPUExecutionProvider"])
+    return session.get_inputs()[0].name
+
+
+def _resnet_feeds(model_path: Path, images: List[Path]):
+    input_name = _input_name(model_path)
+    for image_path in images:
+        img = cv2.resize(cv2.imread(str(image_path)), (64, 64))
+        blob = cv2.dnn.blobFromImage(img, 1 / 255.0, (64, 64), (0, 0, 0), swapRB=True)
+        yield {input_name: blob}
+
+
+def _detector(focus_name: str, session, classes: List[str]) -> YOLOv8 | YOLOv8Seg:
+    if "-seg" in focus_name:
+        return YOLOv8Seg.from_pluggable_model(session, classes)
+    return YOLOv8.from_pluggable_model(session, classes)
+
+
+def _yolo_feeds(modelhub: ModelHub, focus_name: str, classes: List[str], images: List[Path]):
+    session = modelhub.match_net(focus_name)
+    detector = _detector(focus_name, session, classes)
+    prepare = detector.prepare_input if isinstance(detector, YOLOv8Seg) else detector._prepare_input
+    for image_path in images:
+        yield {detector.input_names[0]: prepare(cv2.imread(str(image_path)))}
+
+
+def _same_click(a: list, b: list) -> bool:
+    """Both models click the same object on the image"""
+    if not a or not b:
+        return not a and not b
+    (name_a, point_a, _), (name_b, point_b, _) = a[0], b[0]
+    return name_a == name_b and np.hypot(*np.subtract(point_a, point_b)) <= POINT_TOLERANCE
+
+
+def check_binary_models(modelhub: ModelHub, threshold: float) -> List[QuantizedVariant]:
+    """ResNet binaries of assets/image_label_binary, served by cv2.dnn"""
+    variants = []
+    models = set(modelhub.label_alias.values())
+    for image_dir in sorted(assets_dir.joinpath("image_label_binary").iterdir()):
+        focus_name = f"{image_dir.name}.onnx"
+        if image_dir.name not in models:
+            logger.warning("Skip unknown model", focus_name=focus_name)
+            continue
+        modelhub.pull_model(focus_name)
+
+        images = _images(image_dir)
+        samples = [p.read_bytes() for p in images]
+        calibration = _resnet_feeds(modelhub.models_dir.joinpath(focus_name), images)
+
+        def predict(net, sample):
+            return ResNetControl.from_pluggable_model(net).execute(sample)
+
+        variants.append(
+            modelhub.check_quantized(
+                focus_name, "static", samples, predict, threshold=threshold, calibration=calibration
+            )
+        )
+    return variants
+
+
+def check_detection_models(
+    modelhub: ModelHub, threshold: float, modes: Tuple[str, ...]
+) -> List[QuantizedVariant]:
+    """YOLOv8 ashes_of_war of assets/image_label_area_select, served by onnxruntime"""
+    variants = []
+    for image_dir in sorted(assets_dir.joinpath("image_label_area_select").iterdir()):
+        ash = image_dir.name
+        if not modelhub.router.is_matched(ash):
+            logger.warning("Skip prompt without a detection model", ash=ash)
+            continue
+        focus_name, classes = modelhub.apply_ash_of_war(ash)
+        modelhub.pull_model(focus_name)
+
+        images = _images(image_dir)
+
+        def predict(session, image_path: Path):
+            return _detector(focus_name, session, classes)(image_path, shape_type="point")
+
+        for mode in modes:
+            calibration = None
+            if mode == "static":
+                calibration = _yolo_feeds(modelhub, focus_name, classes, images)
+            variants.append(
+                modelhub.check_quantized(
+                    focus_name,
+                    mode,
+                    images,
+                    predict,
+                    compare=_same_click,
+                    threshold=threshold,
+                    calibration=calibration,
+                )
+            )
+    return variants
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threshold", type=float, default=DEFAULT_AGREEMENT_THRESHOLD)
+    parser.add_argument(
+        "--modes", nargs="+", default=["dynamic", "static"], choices=["dynamic", "static", "fp16"]
+    )
+    args = parser.parse_args()
+
+    solver.install(upgrade=False)
+    modelhub = ModelHub.from_github_repo()
+    modelhub.parse_objects()
+    # Compare the FP32 model against its variants, never a variant against itself
+    modelhub.use_quantized = False
+
+    variants = check_binary_models(modelhub, args.threshold)
+    variants += check_detection_models(modelhub, args.threshold, tuple(args.modes))
+
+    for v in variants:
+        status = "approved" if v.approved else "rejected"
+        print(f"{v.name:<60} {v.agreement:>7.2%} / {v.threshold:.2%} ({v.samples}) {status}")
+
+
+if __name__ == "__main__":
+    run()
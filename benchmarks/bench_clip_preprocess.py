@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 22:50
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: CLIP preprocessing, float32 per image `Preprocessor.__call__` vs uint8 `batch`
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from hcaptcha_challenger.onnx import clip
+from hcaptcha_challenger.onnx.clip import Preprocessor
+
+GOOSE_DIR = Path(__file__).parent.parent.joinpath("tests", "goose")
+BATCH_SIZES = (1, 9, 18)
+ROUNDS = 10
+
+
+def reference(preprocessor: Preprocessor, images):
+    """`MossCLIP.encode_image` before `Preprocessor.batch`"""
+    return np.concatenate([preprocessor(image) for image in images])
+
+
+def bench(name: str, baseline: float | None, fn, *args) -> float:
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(*args)
+    elapsed = (time.perf_counter() - start) / ROUNDS * 1000
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    speedup = f"{baseline / elapsed:>6.1f}x" if baseline else ""
+    print(f"{name:<12} {elapsed:>8.2f} ms  peak +{(peak - base) / 2**20:>6.2f} MiB {speedup}")
+    return elapsed
+
+
+def run():
+    goose = [Image.open(p).convert("RGB") for p in sorted(GOOSE_DIR.glob("*.png"))]
+    preprocessor = Preprocessor()
+    workers = dict.fromkeys([1, clip.PREPROCESS_WORKERS, 4])
+
+    for batch_size in BATCH_SIZES:
+        images = (goose * batch_size)[:batch_size]
+        expected = reference(preprocessor, images)
+        mad = np.abs(preprocessor.batch(images) - expected).mean()
+        print(f"\n{batch_size} images {images[0].size[0]}x{images[0].size[1]}, MAD={mad:.3g}")
+
+        baseline = bench("reference", None, reference, preprocessor, images)
+        for n in workers:
+            clip.PREPROCESS_WORKERS = n
+            bench(f"batch-{n}", baseline, preprocessor.batch, images)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/7 16:10
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: track `python -X importtime` of the package entry points
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+project_dir = Path(__file__).parent.parent
+
+STATEMENTS = {
+    "package": "import hcaptcha_challenger",
+    "prompt_handler": "from hcaptcha_challenger import split_prompt_message, label_cleaning",
+    "modelhub": "from hcaptcha_challenger import ModelHub",
+    "classifier": "from hcaptcha_challenger import BinaryClassifier",
+}
+
+
+def importtime(statement: str, baseline: set | None = None):
+    """
+    :param baseline: modules the interpreter imports on its own, e.g. `site`
+    :return: total cumulative microseconds, [(cumulative, module), ...]
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=project_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        if baseline and module.strip() in baseline:
+            continue
+        rows.append((int(cumulative), module.rstrip()))
+
+    # Top level imports are the ones without indentation
+    total = sum(us for us, module in rows if not module.startswith("  "))
+    return total, sorted(rows, reverse=True)
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=0, help="fail if `package` is slower")
+    args = parser.parse_args()
+
+    _, startup = importtime("pass")
+    baseline = {module.strip() for _, module in startup}
+
+    exit_code = 0
+    for name, statement in STATEMENTS.items():
+        samples = [importtime(statement, baseline) for _ in range(args.rounds)]
+        total, rows = min(samples, key=lambda s: s[0])
+        print(f"{name:<16} {total / 1000:>9.2f} ms  ({statement})")
+        for us, module in rows[: args.top]:
+            print(f"    {us / 1000:>9.2f} ms {module}")
+        if name == "package" and args.budget_ms and total / 1000 > args.budget_ms:
+            print(f"!! `import hcaptcha_challenger` exceeds the {args.budget_ms}ms budget")
+            exit_code = 1
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 15:40
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: YOLOv8 post-processing, per class NMS loops vs decode_predictions + batched_nms
+import time
+
+import numpy as np
+
+from hcaptcha_challenger.onnx.utils import (
+    batched_nms,
+    decode_predictions,
+    multiclass_nms,
+    xywh2xyxy,
+)
+
+# The head of COCO2020_yolov8m.onnx: 4 + 80 classes over 8400 anchors of a 640px input
+NUM_CLASSES = 80
+NUM_ANCHORS = 8400
+NUM_OBJECTS = 20
+CONF_THRESHOLDS = (0.5, 0.25, 0.05)
+IOU_THRESHOLD = 0.5
+ROUNDS = 10
+
+
+def head_output(seed: int = 0) -> np.ndarray:
+    """Anchors around a few objects score high on their class, the rest is background noise"""
+    rng = np.random.default_rng(seed)
+    output = np.empty((4 + NUM_CLASSES, NUM_ANCHORS), dtype=np.float32)
+    output[:2] = rng.uniform(0, 640, (2, NUM_ANCHORS))
+    output[2:4] = rng.uniform(4, 120, (2, NUM_ANCHORS))
+    output[4:] = rng.beta(0.3, 12, (NUM_CLASSES, NUM_ANCHORS))
+
+    anchors = rng.permutation(NUM_ANCHORS)[: NUM_OBJECTS * 60].reshape(NUM_OBJECTS, 60)
+    for group in anchors:
+        center, size = rng.uniform(40, 600, 2), rng.uniform(24, 240, 2)
+        output[:2, group] = center[:, None] + rng.normal(0, 0.08, (2, 60)) * size[:, None]
+        output[2:4, group] = size[:, None] * (1 + rng.normal(0, 0.1, (2, 60)))
+        output[4 + rng.integers(NUM_CLASSES), group] = rng.uniform(0.3, 0.95, 60)
+    return output
+
+
+def legacy(output: np.ndarray, conf_threshold: float):
+    """`YOLOv8._process_output` before decode_predictions and batched_nms"""
+    predictions = np.squeeze(output[np.newaxis]).T
+    scores = np.max(predictions[:, 4:], axis=1)
+    predictions = predictions[scores > conf_threshold, :]
+    scores = scores[scores > conf_threshold]
+    class_ids = np.argmax(predictions[:, 4:], axis=1)
+    boxes = xywh2xyxy(predictions[:, :4])
+    indices = multiclass_nms(boxes, scores, class_ids, IOU_THRESHOLD)
+    return boxes[indices], scores[indices], class_ids[indices]
+
+
+def fused(output: np.ndarray, conf_threshold: float, backend: str = "numpy"):
+    boxes, scores, class_ids, _ = decode_predictions(output, conf_threshold)
+    boxes = xywh2xyxy(boxes, inplace=True)
+    indices = batched_nms(boxes, scores, class_ids, IOU_THRESHOLD, backend=backend)
+    return boxes[indices], scores[indices], class_ids[indices]
+
+
+def bench(fn, *args) -> float:
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(*args)
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+
+def run():
+    output = head_output()
+    for conf_threshold in CONF_THRESHOLDS:
+        expected = legacy(output, conf_threshold)
+        candidates = int(np.sum(np.max(output[4:], axis=0) > conf_threshold))
+        print(f"\nconf={conf_threshold} candidates={candidates} kept={len(expected[0])}")
+
+        baseline = bench(legacy, output, conf_threshold)
+        print(f"{'legacy':<12} {baseline:>8.2f} ms")
+        for backend in ("numpy", "cv2"):
+            actual = fused(output, conf_threshold, backend)
+            same = all(np.array_equal(a, b) for a, b in zip(actual, expected))
+            ms = bench(fused, output, conf_threshold, backend)
+            print(f"{'fused-' + backend:<12} {ms:>8.2f} ms {baseline / ms:>6.1f}x  same={same}")
+
+
+if __name__ == "__main__":
+    run()
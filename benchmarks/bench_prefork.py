@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/10 16:05
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: per-worker USS/PSS of pre-fork workers vs workers that load their own models
+"""
+USS: pages only this worker maps, what killing it would free
+PSS: its fair share of every page, shared pages are split between the processes mapping them
+
+    python benchmarks/bench_prefork.py --workers 4
+    python benchmarks/bench_prefork.py --workers 4 --synthetic 256
+"""
+
+import argparse
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+from hcaptcha_challenger.onnx.modelhub import ModelHub, Assets
+from hcaptcha_challenger.onnx.prefork import spawn_workers, wait_workers, prepare_for_fork
+
+MiB = 1024 * 1024
+
+
+def smaps_rollup(pid: int) -> Dict[str, int]:
+    """Bytes of Rss, Pss and USS (Private_Clean + Private_Dirty)"""
+    fields = {}
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()[1:]:
+        key, value = line.split(":", 1)
+        fields[key] = int(value.split()[0]) * 1024
+    return {
+        "rss": fields["Rss"],
+        "pss": fields["Pss"],
+        "uss": fields["Private_Clean"] + fields["Private_Dirty"],
+    }
+
+
+def build_synthetic_model(path: Path, megabytes: int):
+    """A weight-heavy MatMul chain, named so that onnxruntime serves it"""
+    import numpy as np
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    dim = 1024
+    layers = max(1, megabytes * MiB // (dim * dim * 4))
+    rng = np.random.default_rng(2309)
+    nodes, initializers = [], []
+    prev = "x"
+    for i in range(layers):
+        weight = numpy_helper.from_array(rng.random((dim, dim), dtype=np.float32), f"w{i}")
+        initializers.append(weight)
+        nodes.append(helper.make_node("MatMul", [prev, f"w{i}"], [f"h{i}"]))
+        prev = f"h{i}"
+    graph = helper.make_graph(
+        nodes,
+        "synthetic",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, [1, dim])],
+        [helper.make_tensor_value_info(prev, TensorProto.FLOAT, [1, dim])],
+        initializers,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8)
+    onnx.save(model, str(path))
+
+
+def make_modelhub(models_dir: Path | None) -> ModelHub:
+    modelhub = ModelHub()
+    if models_dir is not None:
+        modelhub.models_dir = models_dir
+        modelhub.optimized_dir = models_dir.joinpath("_optimized")
+        modelhub.assets = Assets(release_url="", _assets_dir=models_dir, _memory_dir=models_dir)
+    else:
+        modelhub.assets = Assets.from_release_url(ModelHub().release_url)
+        modelhub.parse_objects()
+    prepare_for_fork(modelhub)
+    return modelhub
+
+
+def measure(pids: List[int], ready_r: int, release_w: int) -> List[Dict[str, int]]:
+    for _ in pids:
+        os.read(ready_r, 1)
+    usage = [smaps_rollup(pid) for pid in pids]
+    os.write(release_w, b"x" * len(pids))
+    return usage
+
+
+def wait_for_release(ready_w: int, release_r: int):
+    os.write(ready_w, b"1")
+    os.read(release_r, 1)
+
+
+def run_prefork(focus_names, models_dir, workers) -> List[Dict[str, int]]:
+    ready_r, ready_w = os.pipe()
+    release_r, release_w = os.pipe()
+    modelhub = make_modelhub(models_dir)
+
+    def target(hub: ModelHub, index: int):
+        try:
+            hub.preload(focus_names)
+        finally:
+            wait_for_release(ready_w, release_r)
+
+    pids = spawn_workers(target, workers, modelhub=modelhub, focus_names=focus_names)
+    usage = measure(pids, ready_r, release_w)
+    wait_workers(pids)
+    return usage
+
+
+def run_independent(focus_names, models_dir, workers) -> List[Dict[str, int]]:
+    ready_r, ready_w = os.pipe()
+    release_r, release_w = os.pipe()
+
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                make_modelhub(models_dir).preload(focus_names)
+            finally:
+                wait_for_release(ready_w, release_r)
+                os._exit(0)
+        pids.append(pid)
+    usage = measure(pids, ready_r, release_w)
+    wait_workers(pids)
+    return usage
+
+
+def report(name: str, usage: List[Dict[str, int]]):
+    print(f"{name}")
+    for i, u in enumerate(usage):
+        print(
+            f"    worker-{i}  rss {u['rss'] / MiB:>8.1f} MiB"
+            f"  pss {u['pss'] / MiB:>8.1f} MiB  uss {u['uss'] / MiB:>8.1f} MiB"
+        )
+    print(f"    total pss {sum(u['pss'] for u in usage) / MiB:>8.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--models", nargs="*", help="defaults to every downloaded model")
+    parser.add_argument("--synthetic", type=int, default=0, help="MiB of a generated model")
+    args = parser.parse_args()
+
+    models_dir = None
+    focus_names = args.models
+    if args.synthetic:
+        models_dir = Path(tempfile.mkdtemp())
+        build_synthetic_model(models_dir.joinpath("synthetic_yolov8.onnx"), args.synthetic)
+        focus_names = ["synthetic_yolov8.onnx"]
+
+    for name, runner in [("independent", run_independent), ("prefork", run_prefork)]:
+        report(name, runner(focus_names, models_dir, args.workers))
+
+
+if __name__ == "__main__":
+    main()
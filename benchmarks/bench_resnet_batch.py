@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/11 15:45
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: ResNet binaries, one forward pass per image vs one per challenge grid
+import itertools
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+import cv2
+
+from hcaptcha_challenger.onnx.modelhub import ModelHub, Assets
+from hcaptcha_challenger.onnx import resnet
+from hcaptcha_challenger.onnx.resnet import ResNetControl
+from hcaptcha_challenger.onnx.server import ModelServer
+
+project_dir = Path(__file__).parent.parent
+BATCH_SIZES = (1, 9, 18)
+ROUNDS = 20
+
+
+def bench(name: str, fn, batch):
+    fn(batch)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(batch)
+    elapsed = time.perf_counter() - start
+    rate = ROUNDS * len(batch) / elapsed
+    print(
+        f"{name:<16} batch={len(batch):<3} {elapsed / ROUNDS * 1000:>8.2f} ms  {rate:>8.1f} img/s"
+    )
+
+
+def bench_control(prefix: str, control: ResNetControl, images: List[bytes]):
+    def loop(batch):
+        return [control.execute(image) for image in batch]
+
+    def batched(batch):
+        return control.execute_batch(batch)
+
+    # Without decoding and denoising, i.e. the share of the forward pass
+    def forward_loop(batch):
+        return [control.classify_batch([img]) for img in batch]
+
+    def forward_batched(batch):
+        return control.classify_batch(batch)
+
+    for size in BATCH_SIZES:
+        batch = list(itertools.islice(itertools.cycle(images), size))
+        assert loop(batch) == batched(batch)
+        bench(f"{prefix}-loop", loop, batch)
+        bench(f"{prefix}-batch", batched, batch)
+
+        preprocessed = [control.preprocess(image, control.denoise_strategy) for image in batch]
+        bench(f"{prefix}-fwd-loop", forward_loop, preprocessed)
+        bench(f"{prefix}-fwd-batch", forward_batched, preprocessed)
+
+    if not control._batchable:
+        print("[!] The model was served without a dynamic batch copy, install `onnx`")
+
+
+def _modelhub(models_dir: Path, server_address: str = "") -> ModelHub:
+    modelhub = ModelHub(server_address=server_address)
+    modelhub.models_dir = models_dir
+    modelhub.optimized_dir = models_dir.joinpath("_optimized")
+    modelhub.assets = Assets(release_url="", _assets_dir=models_dir, _memory_dir=models_dir)
+    return modelhub
+
+
+def run():
+    # Every image of a real grid is new, measure the denoise instead of the cache
+    resnet.DENOISE_CACHE_SIZE = 0
+
+    tests_dir = project_dir.joinpath("tests")
+    images = [p.read_bytes() for p in sorted(tests_dir.joinpath("goose").glob("*.png"))]
+    print(f"cv2 threads={cv2.getNumThreads()}, {ROUNDS} rounds")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        models_dir = Path(tmp)
+        shutil.copyfile(tests_dir.joinpath("goose2309.onnx"), models_dir.joinpath("goose2309.onnx"))
+
+        net = _modelhub(models_dir).match_net("goose2309.onnx")
+        bench_control("local", ResNetControl.from_pluggable_model(net), images)
+
+        # Over `hcaptcha_challenger.onnx.server` every forward pass is a round trip
+        socket_path = models_dir.joinpath("modelhub.sock")
+        server = ModelServer(_modelhub(models_dir), socket_path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        remote = _modelhub(models_dir, str(socket_path))
+        try:
+            net = remote.match_net("goose2309.onnx")
+            bench_control("remote", ResNetControl.from_pluggable_model(net), images)
+        finally:
+            # server_close() joins the handlers once their connections are gone
+            remote._client.close()
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/6 22:40
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: prompt-to-model routing, linear substring scans vs AshRouter
+import json
+import shutil
+import time
+from pathlib import Path
+
+from hcaptcha_challenger import split_prompt_message, label_cleaning
+from hcaptcha_challenger.onnx.modelhub import ModelHub, DEFAULT_KEYPOINT_MODEL
+from hcaptcha_challenger.onnx.routing import AshRouter
+from hcaptcha_challenger.onnx.yolo import is_matched_ash_of_war
+
+project_dir = Path(__file__).parent.parent
+ROUNDS = 20
+
+
+def linear_route(modelhub: ModelHub, ash: str):
+    if not any(is_matched_ash_of_war(ash, c) for c in modelhub.yolo_names):
+        return
+    if "head of " in ash and "animal" in ash:
+        for model_name, covered_class in modelhub.ashes_of_war.items():
+            if "head" not in model_name:
+                continue
+            for class_name in covered_class:
+                if class_name.replace("-head", "") in ash:
+                    return model_name, covered_class
+    for model_name, covered_class in modelhub.ashes_of_war.items():
+        for class_name in covered_class:
+            if class_name in ash:
+                return model_name, covered_class
+    return DEFAULT_KEYPOINT_MODEL, modelhub.ashes_of_war[DEFAULT_KEYPOINT_MODEL]
+
+
+def router_route(modelhub: ModelHub, ash: str):
+    router = modelhub.router
+    if not router.is_matched(ash):
+        return
+    return router.apply(ash)
+
+
+def bench(name: str, fn, modelhub: ModelHub, asks):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for ash in asks:
+            fn(modelhub, ash)
+    elapsed = time.perf_counter() - start
+    per_prompt = elapsed / (ROUNDS * len(asks)) * 1e6
+    print(f"{name:<8} {elapsed * 1000:>9.2f} ms  {per_prompt:>7.2f} us/prompt")
+
+
+def run():
+    modelhub = ModelHub()
+    modelhub.objects_path = modelhub.models_dir.joinpath("bench_objects.yaml")
+    shutil.copyfile(project_dir.joinpath("src/objects.yaml"), modelhub.objects_path)
+    modelhub.parse_objects()
+
+    prompts = json.loads(project_dir.joinpath("tests/prompts.json").read_text("utf8"))
+    asks = [label_cleaning(split_prompt_message(p, lang="en")) for p in prompts]
+
+    for ash in asks:
+        assert linear_route(modelhub, ash) == router_route(modelhub, ash), ash
+
+    start = time.perf_counter()
+    AshRouter.from_objects(modelhub.ashes_of_war, modelhub.clip_candidates, DEFAULT_KEYPOINT_MODEL)
+    print(f"compile  {(time.perf_counter() - start) * 1000:>9.2f} ms")
+
+    print(f"{len(asks)} prompts x {ROUNDS} rounds, {len(modelhub.yolo_names)} classes")
+    bench("linear", linear_route, modelhub, asks)
+    bench("router", router_route, modelhub, asks)
+
+
+if __name__ == "__main__":
+    run()
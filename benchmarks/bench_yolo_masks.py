@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 17:30
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: YOLOv8Seg masks, full size float64 maps per detection vs lazy crop-local masks
+import math
+import time
+import tracemalloc
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from hcaptcha_challenger.onnx.preprocess import Letterbox
+from hcaptcha_challenger.onnx.utils import sigmoid
+from hcaptcha_challenger.onnx.yolo import YOLOv8Seg
+
+ASSETS_DIR = Path(__file__).parent.parent.joinpath("assets", "find_unique_object")
+IMAGE_NAMES = ("raw1.png", "raw2.png")
+
+# The heads of appears_only_once_2309_yolov8s-seg.onnx on a 640px input
+CLASSES = ["the-one-piece"]
+NUM_MASKS = 32
+NUM_ANCHORS = 8400
+PROTO_SIZE = 160
+INPUT_SIZE = 640
+ROUNDS = 20
+
+
+class ReplaySession:
+    """Answers every run with the recorded outputs of the seg model"""
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    @staticmethod
+    def get_inputs():
+        return [_Arg("images", [1, 3, INPUT_SIZE, INPUT_SIZE])]
+
+    @staticmethod
+    def get_outputs():
+        return [_Arg("output0", []), _Arg("output1", [])]
+
+    def run(self, output_names, input_feed):
+        return self.outputs
+
+
+class _Arg:
+    def __init__(self, name, shape):
+        self.name, self.shape = name, shape
+
+
+def head_outputs(image: np.ndarray, seed: int = 0):
+    """A few anchors on every circle of the image, the rest below the confidence threshold"""
+    rng = np.random.default_rng(seed)
+    gray = cv2.medianBlur(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), 5)
+    circles = cv2.HoughCircles(
+        gray, cv2.HOUGH_GRADIENT, 1, 30, param1=50, param2=30, minRadius=15, maxRadius=60
+    )[0]
+    scale = np.array([INPUT_SIZE / image.shape[1], INPUT_SIZE / image.shape[0]])
+
+    output = np.empty((1, 4 + len(CLASSES) + NUM_MASKS, NUM_ANCHORS), dtype=np.float32)
+    output[0, :2] = rng.uniform(0, INPUT_SIZE, (2, NUM_ANCHORS))
+    output[0, 2:4] = rng.uniform(8, 80, (2, NUM_ANCHORS))
+    output[0, 4] = rng.uniform(0, 0.3, NUM_ANCHORS)
+    output[0, 5:] = rng.normal(0, 1, (NUM_MASKS, NUM_ANCHORS))
+    anchors = rng.permutation(NUM_ANCHORS)[: len(circles) * 8].reshape(len(circles), 8)
+    for (x, y, radius), group in zip(circles, anchors):
+        output[0, :2, group] = np.array([x, y]) * scale + rng.normal(0, 1, (8, 2))
+        output[0, 2:4, group] = 2 * radius * scale + rng.normal(0, 1, (8, 2))
+        output[0, 4, group] = rng.uniform(0.75, 0.95, 8)
+
+    protos = rng.normal(0, 1, (NUM_MASKS, PROTO_SIZE, PROTO_SIZE)).astype(np.float32)
+    protos = np.stack([cv2.GaussianBlur(proto, (9, 9), 3) for proto in protos])[np.newaxis]
+    return [output, protos]
+
+
+def legacy_mask_maps(boxes, img_shape, mask_predictions, mask_output):
+    """`YOLOv8Seg.process_mask_output` before crop-local masks"""
+    mask_output = np.squeeze(mask_output)
+    num_mask, mask_height, mask_width = mask_output.shape
+    masks = sigmoid(mask_predictions @ mask_output.reshape((num_mask, -1)))
+    masks = masks.reshape((-1, mask_height, mask_width))
+    img_height, img_width = img_shape
+    scale_boxes = YOLOv8Seg.rescale_boxes(boxes, img_shape, (mask_height, mask_width))
+
+    mask_maps = np.zeros((len(scale_boxes), img_height, img_width))
+    blur_size = (int(img_width / mask_width), int(img_height / mask_height))
+    for i in range(len(scale_boxes)):
+        sx1, sy1 = (int(math.floor(v)) for v in scale_boxes[i][:2])
+        sx2, sy2 = (int(math.ceil(v)) for v in scale_boxes[i][2:])
+        x1, y1 = (int(math.floor(v)) for v in boxes[i][:2])
+        x2, y2 = (int(math.ceil(v)) for v in boxes[i][2:])
+        crop_mask = cv2.resize(
+            masks[i][sy1:sy2, sx1:sx2], (x2 - x1, y2 - y1), interpolation=cv2.INTER_CUBIC
+        )
+        crop_mask = cv2.blur(crop_mask, blur_size)
+        mask_maps[i, y1:y2, x1:x2] = (crop_mask > 0.5).astype(np.uint8)
+    return mask_maps
+
+
+def legacy(detector: YOLOv8Seg, outputs, letterbox: Letterbox):
+    """`YOLOv8Seg._process_outputs` before lazy masks"""
+    boxes, scores, class_ids, mask_pred = detector.process_box_output(outputs[0], letterbox)
+    img_shape = (letterbox.img_height, letterbox.img_width)
+    return legacy_mask_maps(boxes, img_shape, mask_pred, outputs[1])
+
+
+def bench(name: str, fn, *args):
+    fn(*args)
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(*args)
+    elapsed = (time.perf_counter() - start) / ROUNDS
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:<14} {elapsed * 1000:>8.2f} ms  peak +{(peak - baseline) / 2**20:>7.2f} MiB")
+
+
+def run():
+    for image_name in IMAGE_NAMES:
+        image = cv2.imread(str(ASSETS_DIR.joinpath(image_name)))
+        outputs = head_outputs(image)
+        detector = YOLOv8Seg.from_pluggable_model(ReplaySession(outputs), CLASSES)
+
+        # point/bounding_box answers, then the masks of `draw_masks`
+        _, [letterbox] = detector._inputs.fill([image])
+        segmentation = detector.segment(image)
+        assert np.array_equal(segmentation.mask_maps, legacy(detector, outputs, letterbox))
+        print(
+            f"\n{image_name} {image.shape[1]}x{image.shape[0]}, {len(segmentation.boxes)} objects"
+        )
+
+        bench("legacy", legacy, detector, outputs, letterbox)
+        bench("point", detector._process_outputs, outputs, letterbox)
+        bench("crop-masks", lambda: detector._process_outputs(outputs, letterbox).masks)
+        bench("mask-maps", lambda: detector._process_outputs(outputs, letterbox).mask_maps)
+        bench("point+decode", lambda: detector(ASSETS_DIR.joinpath(image_name)))
+
+
+if __name__ == "__main__":
+    run()
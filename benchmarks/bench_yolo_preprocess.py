@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 11:40
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: YOLO input preprocessing, fresh temporaries per image vs a reused InputTensor
+import itertools
+import time
+import tracemalloc
+from typing import List
+
+import cv2
+import numpy as np
+
+from hcaptcha_challenger.onnx.preprocess import InputTensor
+
+INPUT_SIZE = 640
+IMAGE_SHAPES = ((520, 520), (430, 500), (128, 128))
+BATCH_SIZES = (1, 9)
+ROUNDS = 50
+
+
+def legacy(images: List[np.ndarray]) -> np.ndarray:
+    """`YOLOv8._prepare_input` before InputTensor, concatenated for a batch"""
+    tensors = []
+    for image in images:
+        input_img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        input_img = cv2.resize(input_img, (INPUT_SIZE, INPUT_SIZE))
+        input_img = input_img / 255.0
+        input_img = input_img.transpose(2, 0, 1)
+        tensors.append(input_img[np.newaxis, :, :, :].astype(np.float32))
+    return np.concatenate(tensors)
+
+
+def bench(name: str, fn, images: List[np.ndarray]):
+    fn(images)
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(images)
+    elapsed = (time.perf_counter() - start) / ROUNDS
+
+    # Bytes allocated on top of what is already held, i.e. the temporaries of one call
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    fn(images)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name:<12} batch={len(images):<2} {elapsed * 1000:>8.2f} ms"
+        f"  {elapsed * 1000 / len(images):>7.2f} ms/img  peak +{(peak - baseline) / 2**20:>7.2f} MiB"
+    )
+
+
+def run():
+    rng = np.random.default_rng(0)
+    for shape in IMAGE_SHAPES:
+        print(f"\nimage {shape[1]}x{shape[0]} -> input {INPUT_SIZE}x{INPUT_SIZE}")
+        image = rng.integers(0, 256, (*shape, 3), dtype=np.uint8)
+        for size in BATCH_SIZES:
+            images = list(itertools.repeat(image, size))
+            inputs = InputTensor(INPUT_SIZE, INPUT_SIZE)
+            letterboxed = InputTensor(INPUT_SIZE, INPUT_SIZE, letterbox=True)
+            assert np.array_equal(legacy(images), inputs.fill(images)[0])
+
+            bench("legacy", legacy, images)
+            bench("input-tensor", lambda batch: inputs.fill(batch), images)
+            bench("letterbox", lambda batch: letterboxed.fill(batch), images)
+
+
+if __name__ == "__main__":
+    run()
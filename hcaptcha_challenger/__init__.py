@@ -5,38 +5,46 @@
 # Description:
 from __future__ import annotations
 
+import importlib
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, TYPE_CHECKING
 from urllib.parse import urlparse
 
-from hcaptcha_challenger.components.image_classifier import Classifier as BinaryClassifier
-from hcaptcha_challenger.components.image_classifier import LocalBinaryClassifier
-from hcaptcha_challenger.components.image_label_area_select import AreaSelector
-from hcaptcha_challenger.components.middleware import QuestionResp, ChallengeResp, Answers, Status
-from hcaptcha_challenger.components.prompt_handler import (
-    label_cleaning,
-    diagnose_task,
-    split_prompt_message,
-    prompt2task,
-    handle,
-)
-from hcaptcha_challenger.components.zero_shot_image_classifier import (
-    ZeroShotImageClassifier,
-    DataLake,
-    register_pipline,
-)
-from hcaptcha_challenger.onnx.modelhub import ModelHub
-from hcaptcha_challenger.onnx.resnet import ResNetControl
-from hcaptcha_challenger.onnx.yolo import YOLOv8
-from hcaptcha_challenger.onnx.yolo import YOLOv8Seg
-from hcaptcha_challenger.utils import init_log
+if TYPE_CHECKING:
+    from hcaptcha_challenger.components.image_classifier import Classifier as BinaryClassifier
+    from hcaptcha_challenger.components.image_classifier import LocalBinaryClassifier
+    from hcaptcha_challenger.components.image_label_area_select import AreaSelector
+    from hcaptcha_challenger.components.middleware import (
+        QuestionResp,
+        ChallengeResp,
+        Answers,
+        Status,
+    )
+    from hcaptcha_challenger.components.prompt_handler import (
+        label_cleaning,
+        diagnose_task,
+        split_prompt_message,
+        prompt2task,
+        handle,
+    )
+    from hcaptcha_challenger.components.zero_shot_image_classifier import (
+        ZeroShotImageClassifier,
+        DataLake,
+        register_pipline,
+        release_pipline,
+    )
+    from hcaptcha_challenger.onnx.modelhub import ModelHub
+    from hcaptcha_challenger.onnx.resnet import ResNetControl
+    from hcaptcha_challenger.onnx.yolo import YOLOv8
+    from hcaptcha_challenger.onnx.yolo import YOLOv8Seg
 
 __all__ = [
     "BinaryClassifier",
     "LocalBinaryClassifier",
     "ZeroShotImageClassifier",
     "register_pipline",
+    "release_pipline",
     "DataLake",
     "AreaSelector",
     "QuestionResp",
@@ -53,8 +61,61 @@ __all__ = [
     "YOLOv8",
     "YOLOv8Seg",
     "install",
+    "init_project_log",
 ]
 
+# Public name -> (module, attribute), resolved on first access (PEP 562)
+_LAZY_ATTRS = {
+    "BinaryClassifier": ("hcaptcha_challenger.components.image_classifier", "Classifier"),
+    "LocalBinaryClassifier": (
+        "hcaptcha_challenger.components.image_classifier",
+        "LocalBinaryClassifier",
+    ),
+    "AreaSelector": ("hcaptcha_challenger.components.image_label_area_select", "AreaSelector"),
+    "QuestionResp": ("hcaptcha_challenger.components.middleware", "QuestionResp"),
+    "ChallengeResp": ("hcaptcha_challenger.components.middleware", "ChallengeResp"),
+    "Answers": ("hcaptcha_challenger.components.middleware", "Answers"),
+    "Status": ("hcaptcha_challenger.components.middleware", "Status"),
+    "label_cleaning": ("hcaptcha_challenger.components.prompt_handler", "label_cleaning"),
+    "diagnose_task": ("hcaptcha_challenger.components.prompt_handler", "diagnose_task"),
+    "split_prompt_message": (
+        "hcaptcha_challenger.components.prompt_handler",
+        "split_prompt_message",
+    ),
+    "prompt2task": ("hcaptcha_challenger.components.prompt_handler", "prompt2task"),
+    "handle": ("hcaptcha_challenger.components.prompt_handler", "handle"),
+    "ZeroShotImageClassifier": (
+        "hcaptcha_challenger.components.zero_shot_image_classifier",
+        "ZeroShotImageClassifier",
+    ),
+    "DataLake": ("hcaptcha_challenger.components.zero_shot_image_classifier", "DataLake"),
+    "register_pipline": (
+        "hcaptcha_challenger.components.zero_shot_image_classifier",
+        "register_pipline",
+    ),
+    "release_pipline": (
+        "hcaptcha_challenger.components.zero_shot_image_classifier",
+        "release_pipline",
+    ),
+    "ModelHub": ("hcaptcha_challenger.onnx.modelhub", "ModelHub"),
+    "ResNetControl": ("hcaptcha_challenger.onnx.resnet", "ResNetControl"),
+    "YOLOv8": ("hcaptcha_challenger.onnx.yolo", "YOLOv8"),
+    "YOLOv8Seg": ("hcaptcha_challenger.onnx.yolo", "YOLOv8Seg"),
+}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attr = _LAZY_ATTRS[name]
+    value = getattr(importlib.import_module(module_name), attr)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
+
 
 @dataclass
 class Project:
@@ -64,11 +125,20 @@ class Project:
 
 project = Project()
 
-init_log(
-    runtime=project.logs.joinpath("runtime.log"),
-    error=project.logs.joinpath("error.log"),
-    serialize=project.logs.joinpath("serialize.log"),
-)
+
+def init_project_log(logs_dir: Path | None = None):
+    """
+    Install the stdout format and the runtime/error/serialize file sinks under `logs_dir`.
+    Importing the package no longer touches loguru, call it once at startup to opt in.
+    """
+    from hcaptcha_challenger.utils import init_log
+
+    logs_dir = Path(logs_dir) if logs_dir else project.logs
+    return init_log(
+        runtime=logs_dir.joinpath("runtime.log"),
+        error=logs_dir.joinpath("error.log"),
+        serialize=logs_dir.joinpath("serialize.log"),
+    )
 
 
 def install(
@@ -85,6 +155,8 @@ def install(
 
         PyPI("hcaptcha-challenger").install()
 
+    from hcaptcha_challenger.onnx.modelhub import ModelHub
+
     modelhub = ModelHub.from_github_repo(username=username, lang=lang)
     modelhub.pull_objects(upgrade=upgrade)
     modelhub.assets.flush_runtime_assets(upgrade=upgrade)
@@ -100,15 +172,14 @@ def install(
         if isinstance(flush_yolo, bool) and flush_yolo:
             flush_yolo = [modelhub.circle_segment_model]
         if isinstance(flush_yolo, Iterable):
-            pending_models = []
-            for model_name in flush_yolo:
-                if model_name in modelhub.ashes_of_war:
-                    modelhub.match_net(model_name, install_only=True)
-                    pending_models.append(model_name)
+            pending_models = [m for m in flush_yolo if m in modelhub.ashes_of_war]
+            modelhub.pull_models(pending_models)
             return pending_models
 
 
 def set_reverse_proxy(https_cdn: str):
+    from hcaptcha_challenger.onnx.modelhub import ModelHub
+
     parser = urlparse(https_cdn)
     if parser.netloc and parser.scheme.startswith("https"):
         ModelHub.CDN_PREFIX = https_cdn
@@ -11,7 +11,6 @@ from pathlib import Path
 from typing import List, Literal, Iterable
 
 import cv2
-from PIL import Image
 from loguru import logger
 
 from hcaptcha_challenger.components.common import (
@@ -19,6 +18,10 @@ from hcaptcha_challenger.components.common import (
     download_challenge_images,
     rank_models,
     match_datalake,
+    classify_images,
+    detect_objects,
+    detect_images,
+    zero_shot_images,
 )
 from hcaptcha_challenger.components.cv_toolkit import (
     annotate_objects,
@@ -109,7 +112,7 @@ class RanniTheWitch:
                     logger.warning("unknown shape type", shape_type=shape_type, qr=qr)
                     return self.status.CHALLENGE_BACKCALL
             else:
-                if not any(is_matched_ash_of_war(self.ash, c) for c in self.modelhub.yolo_names):
+                if not self.modelhub.router.is_matched(self.ash):
                     return self.status.CHALLENGE_BACKCALL
                 if shape_type == "point":
                     self.keypoint_challenge()
@@ -135,7 +138,7 @@ class RanniTheWitch:
         self.modelhub.unplug()
 
     def _rank_models(self, nested_models: List[str]) -> ResNetControl | None:
-        result = rank_models(nested_models, self.example_paths, self.modelhub)
+        result = rank_models(nested_models, self.example_paths, self.modelhub, label=self.label)
         if result and isinstance(result, tuple):
             best_model, model_name = result
             return best_model
@@ -165,12 +168,14 @@ class RanniTheWitch:
     def binary_challenge(self, model: ResNetControl | None = None):
         classifier = model or self._match_model(select="resnet")
 
+        indices = [i for i, img_path in enumerate(self.img_paths) if img_path.stat().st_size]
+        images = [self.img_paths[i].read_bytes() for i in indices]
+        results = classify_images(classifier, images, self.modelhub, label=self.label)
+        results = dict(zip(indices, results))
+
         answers = {}
         for i, img_path in enumerate(self.img_paths):
-            result = None
-            if img_path.stat().st_size:
-                result = classifier.execute(img_stream=img_path.read_bytes())
-
+            result = results.get(i)
             uid = self.qr.tasklist[i].task_key
             answers[uid] = "true" if result else "false"
 
@@ -182,19 +187,21 @@ class RanniTheWitch:
 
         model = register_pipline(self.modelhub)
 
+        # The example and the challenge images share one pass of the visual model
+        example_paths = (self.example_paths or [])[-1:]
+        grid = zero_shot_images(tool, model, example_paths + self.img_paths, self.modelhub)
+
         # {{< CATCH EXAMPLES >}}
         target = {}
-        if self.example_paths:
-            example_path = self.example_paths[-1]
-            results = tool(model, image=Image.open(example_path))
-            target = results[0]
+        if example_paths and grid[0]:
+            target = grid[0][0]
 
         # {{< IMAGE CLASSIFICATION >}}
         answers = {}
-        for i, img_path in enumerate(self.img_paths):
-            results = tool(model, image=Image.open(img_path))
-
-            if (
+        for i, results in enumerate(grid[len(example_paths) :]):
+            if not results:
+                result = "false"
+            elif (
                 results[0]["label"] in target.get("label", "")
                 or results[0]["label"] in tool.positive_labels
             ):
@@ -219,8 +226,9 @@ class RanniTheWitch:
                     res = detector(img_path, shape_type="point")
                 else:
                     detector = YOLOv8.from_pluggable_model(session, classes)
-                    res = detector(image, shape_type="point")
-                self.modelhub.unplug()
+                    res = detect_objects(
+                        detector, image, self.modelhub, shape_type="point", ash=self.ash
+                    )
                 for name, (center_x, center_y), score in res:
                     point = [int(center_x), int(center_y)]
                     logger.debug("handle task", point=point, catch_model=focus_name, ash=self.ash)
@@ -234,7 +242,6 @@ class RanniTheWitch:
             session = self.modelhub.match_net(model_name)
             detector = YOLOv8Seg.from_pluggable_model(session, classes)
             results = detector(img_path, shape_type="point")
-            self.modelhub.unplug()
             img, circles = annotate_objects(str(img_path))
             # Extract point coordinates
             if results:
@@ -281,10 +288,14 @@ class RanniTheWitch:
     def keypoint_challenge(self):
         detector: YOLOv8 = self._match_model(select="yolo")
 
+        detections = detect_images(
+            detector, self.img_paths, self.modelhub, shape_type="point", ash=self.ash
+        )
+
         answers = {}
         for i, img_path in enumerate(self.img_paths):
             coords: List[int] | None = []
-            res = detector(img_path, shape_type="point")
+            res = detections[i] or []
 
             # Subject: Select the object with the highest confidence
             entities = []
@@ -305,11 +316,15 @@ class RanniTheWitch:
     def bounding_challenge(self):
         detector: YOLOv8 = self._match_model(select="yolo")
 
+        detections = detect_images(
+            detector, self.img_paths, self.modelhub, shape_type="bounding_box", ash=self.ash
+        )
+
         answers = {}
         for i, img_path in enumerate(self.img_paths):
             coords: List[int] | None = []
 
-            res = detector(img_path, shape_type="bounding_box")
+            res = detections[i] or []
 
             # Subject: the entity that occupies the largest area of the image
             entities = []
@@ -339,9 +354,8 @@ class RanniTheWitch:
         model = register_pipline(self.modelhub)
 
         answers = {}
-        for i, img_path in enumerate(self.img_paths):
-            results = tool(model, image=Image.open(img_path))
-            trusted_label = results[0]["label"]
+        for i, results in enumerate(zero_shot_images(tool, model, self.img_paths, self.modelhub)):
+            trusted_label = results[0]["label"] if results else candidates[0]
 
             uid = self.qr.tasklist[i].task_key
             answers[uid] = [trusted_label]
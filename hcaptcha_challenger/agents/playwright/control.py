@@ -14,7 +14,6 @@ from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List, Dict, Literal, Iterable
 
-from PIL import Image
 from loguru import logger
 from playwright.async_api import Page, FrameLocator, Response, Position, Locator
 from playwright.async_api import TimeoutError
@@ -25,6 +24,10 @@ from hcaptcha_challenger.components.common import (
     match_datalake,
     rank_models,
     download_challenge_images,
+    classify_images,
+    detect_objects,
+    zero_shot,
+    zero_shot_images,
 )
 from hcaptcha_challenger.components.cv_toolkit import (
     find_unique_object,
@@ -253,7 +256,7 @@ class Radagon:
         return model
 
     def _rank_models(self, nested_models: List[str]) -> ResNetControl | None:
-        result = rank_models(nested_models, self.example_paths, self.modelhub)
+        result = rank_models(nested_models, self.example_paths, self.modelhub, label=self.label)
         if result and isinstance(result, tuple):
             best_model, model_name = result
             logger.debug("handle task", rank_model=model_name, prompt=self.prompt)
@@ -269,7 +272,9 @@ class Radagon:
             path = self.tmp_dir.joinpath("_challenge", f"{uuid.uuid4()}.png")
             await locator.screenshot(path=path, type="png")
 
-            res = detector(Path(path), shape_type="bounding_box")
+            res = detect_objects(
+                detector, Path(path), self.modelhub, shape_type="bounding_box", ash=self.ash
+            )
 
             alts = []
             for name, (x1, y1), (x2, y2), score in res:
@@ -309,8 +314,9 @@ class Radagon:
                     res = detector(path, shape_type="point")
                 else:
                     detector = YOLOv8.from_pluggable_model(session, classes)
-                    res = detector(image, shape_type="point")
-                self.modelhub.unplug()
+                    res = detect_objects(
+                        detector, image, self.modelhub, shape_type="point", ash=self.ash
+                    )
                 for name, (center_x, center_y), score in res:
                     if center_y < 20 or center_y > 520 or center_x < 91 or center_x > 400:
                         continue
@@ -325,7 +331,6 @@ class Radagon:
             session = self.modelhub.match_net(model_name)
             detector = YOLOv8Seg.from_pluggable_model(session, classes)
             results = detector(path, shape_type="point")
-            self.modelhub.unplug()
             img, circles = annotate_objects(str(path))
             # Extract point coordinates
             if results:
@@ -400,7 +405,9 @@ class Radagon:
             await locator.screenshot(path=path, type="png")
 
             # {{< Please click on the X >}}
-            res = detector(Path(path), shape_type="point")
+            res = detect_objects(
+                detector, Path(path), self.modelhub, shape_type="point", ash=self.ash
+            )
 
             alts = []
             for name, (center_x, center_y), score in res:
@@ -443,12 +450,16 @@ class Radagon:
             # Drop element location
             samples = frame_challenge.locator("//div[@class='task-image']")
             count = await samples.count()
-            # Classify and Click on the right image
+            # Classify the whole grid in one forward pass
+            img_paths = self.img_paths[pth * 9 : pth * 9 + count]
+            images = [p.read_bytes() for p in img_paths]
+            results = classify_images(classifier, images, self.modelhub, label=self.label)
+            # Click on the right image
             positive_cases = 0
             for i in range(count):
                 sample = samples.nth(i)
                 await sample.wait_for()
-                result = classifier.execute(img_stream=self.img_paths[i + pth * 9].read_bytes())
+                result = results[i]
                 if result:
                     positive_cases += 1
                     with suppress(TimeoutError):
@@ -479,12 +490,15 @@ class Radagon:
             timit=f"{te - t0:.3f}s",
         )
 
+        # The example and every challenge image share one pass of the visual model
+        example_paths = (self.example_paths or [])[-1:]
+        grid = zero_shot_images(tool, model, example_paths + self.img_paths, self.modelhub)
+
         # {{< CATCH EXAMPLES >}}
         target = {}
-        if self.example_paths:
-            example_path = self.example_paths[-1]
-            results = tool(model, image=Image.open(example_path))
-            target = results[0]
+        if example_paths and grid[0]:
+            target = grid[0][0]
+        grid = grid[len(example_paths) :]
 
         # {{< IMAGE CLASSIFICATION >}}
         times = int(len(self.qr.tasklist) / 9)
@@ -495,9 +509,9 @@ class Radagon:
             for i in range(count):
                 sample = samples.nth(i)
                 await sample.wait_for()
-                results = tool(model, image=Image.open(self.img_paths[i + pth * 9]))
+                results = grid[i + pth * 9]
 
-                if (
+                if results and (
                     results[0]["label"] in target.get("label", "")
                     or results[0]["label"] in tool.positive_labels
                 ):
@@ -519,7 +533,7 @@ class Radagon:
                 positive_labels=candidates[:1], negative_labels=candidates[1:]
             )
             tool = ZeroShotImageClassifier.from_datalake(dl)
-            results = tool(model, image=Image.open(img_path))
+            results = zero_shot(tool, model, img_path, self.modelhub)
             sample_label = results[0]["label"]
             logger.debug(
                 "handle task",
@@ -653,7 +667,7 @@ class AgentT(Radagon):
                 else:
                     return self.status.CHALLENGE_BACKCALL
             else:
-                if not any(is_matched_ash_of_war(ash, c) for c in self.modelhub.yolo_names):
+                if not self.modelhub.router.is_matched(ash):
                     return self.status.CHALLENGE_BACKCALL
                 if shape_type == "point":
                     await self._keypoint_challenge(frame_challenge)
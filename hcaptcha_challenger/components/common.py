@@ -8,41 +8,133 @@ from __future__ import annotations
 import asyncio
 import hashlib
 import shutil
+import threading
 import time
+from collections import OrderedDict
 from contextlib import suppress
 from pathlib import Path
-from typing import Literal, List, Tuple
+from typing import Literal, List, Tuple, Dict
+
+import numpy as np
+from PIL import Image
+from loguru import logger
 
 from hcaptcha_challenger.components.image_downloader import Cirilla
 from hcaptcha_challenger.components.middleware import QuestionResp
+from hcaptcha_challenger.onnx.clip import MossCLIP
 from hcaptcha_challenger.onnx.modelhub import ModelHub, DataLake
-from hcaptcha_challenger.onnx.resnet import ResNetControl
+from hcaptcha_challenger.onnx.resnet import ResNetControl, default_denoise_strategy
+from hcaptcha_challenger.onnx.verdicts import image_digest
 from hcaptcha_challenger.onnx.yolo import YOLOv8
 
+RANK_MEMO_SIZE = 512
+
+_rank_memo: OrderedDict[Tuple, str] = OrderedDict()
+"""
+{ (label, nested_models, model versions, denoise strategy, example digests):
+  winner model_name, "" if no model qualified }
+"""
+
+_rank_memo_lock = threading.Lock()
 
-def rank_models(
-    nested_models: List[str], example_paths: List[Path], modelhub: ModelHub
-) -> Tuple[ResNetControl, str] | None:
-    # {{< Rank ResNet Models >}}
-    rank_ladder = []
 
-    for example_path in example_paths:
-        img_stream = example_path.read_bytes()
+def _is_final(result_: bool, proba: np.ndarray) -> bool:
+    """A confident hit, the legacy loop tries no further model on this example"""
+    return result_ and proba[0] > 0.87
+
+
+def _rank_ladder(
+    nested_models: List[str], examples: List[np.ndarray], modelhub: ModelHub
+) -> List[Tuple[ResNetControl, str, np.ndarray]] | None:
+    """
+    The rank ladder of the legacy loop, one batch per model instead of one pass per pair.
+
+    The legacy loop walks the models in reverse order for each example and stops
+    at the first confident hit (> 0.87). Here every model receives, in one batch,
+    exactly the examples that had not stopped yet when the legacy loop reached it,
+    then the hits are replayed in the legacy (example, model) order.
+    """
+    active = list(range(len(examples)))
+    verdicts: Dict[Tuple[int, str], Tuple[bool, np.ndarray]] = {}
+    controls: Dict[str, ResNetControl] = {}
+
+    for model_name in reversed(nested_models):
+        if not active:
+            break
+        if (net := modelhub.match_net(focus_name=model_name)) is None:
+            return
+        control = ResNetControl.from_pluggable_model(net)
+        controls[model_name] = control
+
+        results = control.classify_batch([examples[i] for i in active])
+        for i, result in zip(active, results):
+            verdicts[(i, model_name)] = result
+        active = [
+            i for i, (result_, proba) in zip(active, results) if not _is_final(result_, proba)
+        ]
+
+    rank_ladder = []
+    for i in range(len(examples)):
         for model_name in reversed(nested_models):
-            if (net := modelhub.match_net(focus_name=model_name)) is None:
-                return
-            control = ResNetControl.from_pluggable_model(net)
-            result_, proba = control.execute(img_stream, proba=True)
+            if (i, model_name) not in verdicts:
+                break
+            result_, proba = verdicts[(i, model_name)]
             if result_ and proba[0] > 0.68:
-                rank_ladder.append([control, model_name, proba])
-                if proba[0] > 0.87:
-                    break
+                rank_ladder.append((controls[model_name], model_name, proba))
+            if _is_final(result_, proba):
+                break
+    return rank_ladder
+
+
+def rank_models(
+    nested_models: List[str], example_paths: List[Path], modelhub: ModelHub, *, label: str = ""
+) -> Tuple[ResNetControl, str] | None:
+    """
+    Pick the nested model that recognizes the examples most confidently.
+
+    Each example is decoded once and batched through the models, the winner is remembered
+    per (label, examples) so a repeated challenge skips the ranking. A new release or
+    quantized variant of a model, or another denoise strategy, ranks them again.
+    """
+    img_streams = [example_path.read_bytes() for example_path in example_paths or []]
+    strategy = default_denoise_strategy()
+    key = (
+        label,
+        tuple(nested_models),
+        tuple(modelhub.model_version(model_name) for model_name in nested_models),
+        strategy,
+        tuple(hashlib.md5(img_stream).hexdigest() for img_stream in img_streams),
+    )
+
+    with _rank_memo_lock:
+        model_name = _rank_memo.get(key)
+        if model_name is not None:
+            _rank_memo.move_to_end(key)
+    if model_name == "":
+        return
+    if model_name and (net := modelhub.match_net(focus_name=model_name)) is not None:
+        return ResNetControl.from_pluggable_model(net), model_name
+
+    # {{< Rank ResNet Models >}}
+    examples = [ResNetControl.preprocess(img_stream, strategy) for img_stream in img_streams]
+    examples = [img for img in examples if img is not None]
+    rank_ladder = _rank_ladder(nested_models, examples, modelhub)
+    if rank_ladder is None:
+        return
 
     # {{< Catch-all Rules >}}
+    result = None
     if rank_ladder:
         alts = sorted(rank_ladder, key=lambda x: x[-1][0], reverse=True)
         best_model, model_name = alts[0][0], alts[0][1]
-        return best_model, model_name
+        result = best_model, model_name
+
+    with _rank_memo_lock:
+        _rank_memo[key] = result[1] if result else ""
+        while len(_rank_memo) > RANK_MEMO_SIZE:
+            _rank_memo.popitem(last=False)
+
+    return result
 
 
 def match_datalake(modelhub: ModelHub, label: str) -> DataLake:
@@ -51,12 +143,10 @@ def match_datalake(modelhub: ModelHub, label: str) -> DataLake:
         return dl
 
     # prelude clip_candidates
-    for ket in reversed(modelhub.clip_candidates.keys()):
-        if ket in label:
-            candidates = modelhub.clip_candidates[ket]
-            if candidates and len(candidates) > 2:
-                dl = DataLake.from_binary_labels(candidates[:1], candidates[1:])
-                return dl
+    if ket := modelhub.router.match_clip_candidates(label):
+        candidates = modelhub.clip_candidates[ket]
+        dl = DataLake.from_binary_labels(candidates[:1], candidates[1:])
+        return dl
 
     # catch-all
     dl = DataLake.from_challenge_prompt(raw_prompt=label)
@@ -85,6 +175,173 @@ def match_model(
     return control
 
 
+def classify_images(
+    control: ResNetControl, images: List[bytes], modelhub: ModelHub, *, label: str = ""
+) -> List[bool | None]:
+    """`ResNetControl.execute_batch` that reuses the verdicts of `ModelHub.verdicts`"""
+    verdicts = modelhub.verdicts
+    focus_name = modelhub.lookup_name(control.net) if verdicts is not None else None
+    if not focus_name:
+        return control.execute_batch(images)
+
+    version = f"{modelhub.model_version(focus_name)}.{control.denoise_strategy}"
+    digests = [image_digest(image) for image in images]
+
+    results: List[bool | None] = [None] * len(images)
+    misses = []
+    for i, digest in enumerate(digests):
+        if (cached := verdicts.get(digest, focus_name, version, label, "resnet")) is not None:
+            results[i] = cached[0]
+        else:
+            misses.append(i)
+
+    computed = control.execute_batch([images[i] for i in misses], proba=True)
+    for i, result in zip(misses, computed):
+        if result is None:
+            continue
+        prediction, proba = result
+        results[i] = prediction
+        verdicts.put(digests[i], focus_name, version, label, "resnet", [prediction, proba])
+    return results
+
+
+def detect_objects(
+    detector: YOLOv8,
+    image: Path | bytes,
+    modelhub: ModelHub,
+    *,
+    shape_type: Literal["point", "bounding_box"] = "point",
+    ash: str = "",
+):
+    """`YOLOv8.__call__` that reuses the detections of `ModelHub.verdicts`"""
+    verdicts = modelhub.verdicts
+    focus_name = modelhub.lookup_name(detector.session) if verdicts is not None else None
+    if not focus_name:
+        return detector(image, shape_type=shape_type)
+
+    if isinstance(image, Path):
+        image = image.read_bytes()
+    digest, version = image_digest(image), modelhub.model_version(focus_name)
+    if (cached := verdicts.get(digest, focus_name, version, ash, shape_type)) is not None:
+        return list(cached)
+
+    result = detector(image, shape_type=shape_type)
+    verdicts.put(digest, focus_name, version, ash, shape_type, result)
+    return result
+
+
+def detect_images(
+    detector: YOLOv8,
+    images: List[Path | bytes],
+    modelhub: ModelHub,
+    *,
+    shape_type: Literal["point", "bounding_box"] = "point",
+    ash: str = "",
+) -> List[list | None]:
+    """`YOLOv8.detect_batch` that reuses the detections of `ModelHub.verdicts`"""
+    verdicts = modelhub.verdicts
+    focus_name = modelhub.lookup_name(detector.session) if verdicts is not None else None
+    if not focus_name:
+        return detector.detect_batch(images, shape_type=shape_type)
+
+    images = [image.read_bytes() if isinstance(image, Path) else image for image in images]
+    version = modelhub.model_version(focus_name)
+    digests = [image_digest(image) for image in images]
+
+    results: List[list | None] = [None] * len(images)
+    misses = []
+    for i, digest in enumerate(digests):
+        if (cached := verdicts.get(digest, focus_name, version, ash, shape_type)) is not None:
+            results[i] = list(cached)
+        else:
+            misses.append(i)
+
+    computed = detector.detect_batch([images[i] for i in misses], shape_type=shape_type)
+    for i, result in zip(misses, computed):
+        if result is None:
+            continue
+        results[i] = result
+        verdicts.put(digests[i], focus_name, version, ash, shape_type, result)
+    return results
+
+
+def _clip_focus_name(model, modelhub: ModelHub) -> str | None:
+    """visual+textual model names of a MossCLIP pipeline, the model of its verdicts"""
+    if not isinstance(model, MossCLIP):
+        return
+    visual_name = modelhub.lookup_name(model.visual_session)
+    textual_name = modelhub.lookup_name(model.textual_session)
+    if visual_name and textual_name:
+        return f"{visual_name}+{textual_name}"
+
+
+def _clip_version(focus_name: str, modelhub: ModelHub) -> str:
+    """The versions of both models of `_clip_focus_name`, the scores depend on each of them"""
+    return "+".join(modelhub.model_version(name) for name in focus_name.split("+"))
+
+
+def zero_shot(tool, model, image_path: Path, modelhub: ModelHub):
+    """
+    `ZeroShotImageClassifier.__call__` that reuses the top labels of `ModelHub.verdicts`,
+    only the ONNX pipeline (MossCLIP) of `register_pipline` is cached
+    """
+    verdicts = modelhub.verdicts
+    focus_name = _clip_focus_name(model, modelhub) if verdicts is not None else None
+    if not focus_name:
+        return tool(model, image=Image.open(image_path))
+
+    image = image_path.read_bytes()
+    digest = image_digest(image)
+    version = _clip_version(focus_name, modelhub)
+    prompt = "|".join(tool.candidate_labels)
+    if (cached := verdicts.get(digest, focus_name, version, prompt, "clip")) is not None:
+        return [dict(item) for item in cached]
+
+    results = tool(model, image=Image.open(image_path))
+    verdicts.put(digest, focus_name, version, prompt, "clip", [list(r.items()) for r in results])
+    return results
+
+
+def zero_shot_images(
+    tool, model, image_paths: List[Path], modelhub: ModelHub
+) -> List[List[dict] | None]:
+    """
+    `zero_shot` of each image, the images missing from `ModelHub.verdicts` are scored
+    together by `ZeroShotImageClassifier.batch`, None for the images that cannot be opened
+    """
+    verdicts = modelhub.verdicts
+    focus_name = _clip_focus_name(model, modelhub) if verdicts is not None else None
+
+    results: List[List[dict] | None] = [None] * len(image_paths)
+    digests: List[str | None] = [None] * len(image_paths)
+    version = _clip_version(focus_name, modelhub) if focus_name else ""
+    prompt = "|".join(tool.candidate_labels)
+
+    misses, images = [], []
+    for i, image_path in enumerate(image_paths):
+        try:
+            if focus_name:
+                digests[i] = image_digest(image_path.read_bytes())
+                cached = verdicts.get(digests[i], focus_name, version, prompt, "clip")
+                if cached is not None:
+                    results[i] = [dict(item) for item in cached]
+                    continue
+            image = Image.open(image_path)
+            image.load()
+        except Exception as err:
+            logger.debug("Failed to open the challenge image", image_path=image_path, err=err)
+        else:
+            images.append(image)
+            misses.append(i)
+
+    for i, scores in zip(misses, tool.batch(model, images)):
+        results[i] = tool.rank(scores)
+        if focus_name:
+            value = [list(r.items()) for r in results[i]]
+            verdicts.put(digests[i], focus_name, version, prompt, "clip", value)
+    return results
+
+
 async def download_challenge_images(
     qr: QuestionResp, label: str, tmp_dir: Path, ignore_examples: bool = False
 ):
@@ -7,7 +7,6 @@ from typing import Tuple, List, Literal
 
 import cv2
 import numpy as np
-from skimage.metrics import structural_similarity as compare_ssim
 
 
 def limited_radius(img) -> int:
@@ -59,6 +58,9 @@ def _build_mask(img: np.ndarray, circles: List[List[int]], lookup: Literal["colo
 
 
 def find_unique_object(img: np.ndarray, circles: List[List[int]]) -> Tuple[int, int, int]:
+    # scikit-image takes seconds to import, only this challenge needs it
+    from skimage.metrics import structural_similarity as compare_ssim
+
     mask_images = _build_mask(img, circles, lookup="object")
 
     similarity = []
@@ -7,7 +7,6 @@ from pathlib import Path
 from typing import List
 
 import cv2
-from sklearn.cluster import SpectralClustering
 
 
 def get_2d_image(path: Path):
@@ -23,6 +22,9 @@ def extract_features(img):
 
 
 def find_similar_objects(example_paths: List[Path], challenge_paths: List[Path]):
+    # Deferred, importing sklearn costs more than the clustering itself
+    from sklearn.cluster import SpectralClustering
+
     example_num = len(example_paths)
 
     results: List[bool | None] = [None] * len(challenge_paths)
@@ -10,10 +10,9 @@ from pathlib import Path
 from typing import List, Dict
 
 import cv2
-from PIL import Image
 from loguru import logger
 
-from hcaptcha_challenger.components.common import rank_models
+from hcaptcha_challenger.components.common import rank_models, classify_images, zero_shot_images
 from hcaptcha_challenger.components.prompt_handler import handle
 from hcaptcha_challenger.components.zero_shot_image_classifier import (
     ZeroShotImageClassifier,
@@ -54,28 +53,35 @@ class Classifier:
     def rank_models(
         self, nested_models: List[str], example_paths: List[Path]
     ) -> ResNetControl | None:
-        result = rank_models(nested_models, example_paths, self.modelhub)
+        result = rank_models(nested_models, example_paths, self.modelhub, label=self.label)
         if result and isinstance(result, tuple):
             best_model, model_name = result
             self.model_name = model_name
             return best_model
 
     def inference(self, images: List[Path | bytes], control: ResNetControl):
-        for image in images:
+        streams: Dict[int, bytes] = {}
+        for i, image in enumerate(images):
             try:
                 if isinstance(image, Path):
                     if not image.exists():
-                        self.response.append(None)
                         continue
                     image = image.read_bytes()
                 if isinstance(image, bytes):
-                    result = control.execute(image)
-                    self.response.append(result)
-                else:
-                    self.response.append(None)
+                    streams[i] = image
             except Exception as err:
                 logger.debug(str(err), prompt=self.prompt)
-                self.response.append(None)
+
+        results = {}
+        try:
+            verdicts = classify_images(
+                control, list(streams.values()), self.modelhub, label=self.label
+            )
+            results = dict(zip(streams, verdicts))
+        except Exception as err:
+            logger.debug(str(err), prompt=self.prompt)
+
+        self.response.extend(results.get(i) for i in range(len(images)))
 
     def inference_by_clip(self, image_paths: List[Path]):
         dl = self.modelhub.datalake.get(self.label)
@@ -87,6 +93,7 @@ class Classifier:
         model = self.clip_model or register_pipline(self.modelhub)
         self.model_name = self.modelhub.DEFAULT_CLIP_VISUAL_MODEL
 
+        paths = []
         for image_path in image_paths:
             try:
                 if not isinstance(image_path, Path):
@@ -97,13 +104,22 @@ class Classifier:
                     )
                 if not image_path.exists():
                     raise FileNotFoundError(f"ChallengeImage not found - path={image_path}")
-                # self-supervised image classification
-                results = tool(model, image=Image.open(image_path))
-                trusted = results[0]["label"] in tool.positive_labels
-                self.response.append(trusted)
             except Exception as err:
                 logger.debug(str(err), prompt=self.prompt)
-                self.response.append(None)
+            else:
+                paths.append(image_path)
+
+        # self-supervised image classification, one pass of the visual model over the grid
+        grid = dict.fromkeys(paths)
+        try:
+            grid.update(zip(paths, zero_shot_images(tool, model, paths, self.modelhub)))
+        except Exception as err:
+            logger.debug(str(err), prompt=self.prompt)
+
+        for image_path in image_paths:
+            results = grid.get(image_path) if isinstance(image_path, Path) else None
+            trusted = results[0]["label"] in tool.positive_labels if results else None
+            self.response.append(trusted)
 
         # Pop the temporarily inserted model and free up memory
         if not self.clip_model:
@@ -10,6 +10,7 @@ from typing import List, Literal
 
 from loguru import logger
 
+from hcaptcha_challenger.components.common import detect_images
 from hcaptcha_challenger.components.prompt_handler import handle
 from hcaptcha_challenger.onnx.modelhub import ModelHub
 from hcaptcha_challenger.onnx.yolo import YOLOv8
@@ -59,20 +60,27 @@ class AreaSelector:
             return response
         detector = YOLOv8.from_pluggable_model(session, classes)
 
-        for image in images:
+        streams = {}
+        for i, image in enumerate(images):
             try:
                 if isinstance(image, Path):
                     if not image.exists():
-                        response.append(None)
                         continue
                     image = image.read_bytes()
                 if isinstance(image, bytes):
-                    result = detector(image=image, shape_type=shape_type)
-                    response.append(result)
-                else:
-                    response.append(None)
+                    streams[i] = image
             except Exception as err:
                 logger.debug(str(err), prompt=prompt)
-                response.append(None)
+
+        results = {}
+        try:
+            detections = detect_images(
+                detector, list(streams.values()), self.modelhub, shape_type=shape_type, ash=ash
+            )
+            results = dict(zip(streams, detections))
+        except Exception as err:
+            logger.debug(str(err), prompt=prompt)
+
+        response.extend(results.get(i) for i in range(len(images)))
 
         return response
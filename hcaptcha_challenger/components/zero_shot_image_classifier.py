@@ -5,12 +5,17 @@
 # Description: zero-shot image classification
 from __future__ import annotations
 
+import os
+import threading
+import time
 from dataclasses import dataclass
 from dataclasses import field
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Literal, Iterable, Tuple
+from typing import List, Literal, Iterable, Tuple, Any, Dict
 
-import onnxruntime
+import numpy as np
+from loguru import logger
 from PIL.Image import Image
 
 from hcaptcha_challenger.components.prompt_handler import handle
@@ -18,6 +23,27 @@ from hcaptcha_challenger.onnx.clip import MossCLIP
 from hcaptcha_challenger.onnx.modelhub import ModelHub, DataLake
 from hcaptcha_challenger.onnx.utils import is_cuda_pipline_available
 
+# Seconds a shared pipeline stays registered without being requested again
+PIPELINE_IDLE_TIMEOUT = float(os.environ.get("CLIP_PIPELINE_IDLE_TIMEOUT", 600))
+
+
+@dataclass
+class _PipelineEntry:
+    pipeline: Any
+    modelhub: ModelHub
+    nets: Dict[str, Any]
+    """Sessions of the pipeline that live in the pool of `modelhub`, pinned by focus_name"""
+    last_used: float = field(default_factory=time.monotonic)
+
+    def is_warm(self, modelhub: ModelHub) -> bool:
+        if modelhub is not self.modelhub:
+            return False
+        return all(modelhub.lookup_name(net) == name for name, net in self.nets.items())
+
+
+_pipelines: Dict[Tuple[str, str, str], _PipelineEntry] = {}
+_pipelines_lock = threading.RLock()
+
 
 def register_pipline(
     modelhub: ModelHub,
@@ -31,6 +57,13 @@ def register_pipline(
         - laion/CLIP-ViT-L-14-DataComp.XL-s13B-b90K --> ONNX 1.7GB
         - QuanSun/EVA-CLIP/EVA02_CLIP_L_psz14_224to336 --> ONNX
 
+    Pipelines are shared process-wide by (visual, textual, fmt), the next challenge gets
+    the warm pipeline back instead of new sessions, tokenizer and preprocessor.
+    Its sessions are pinned in the pool of the modelhub until `release_pipline`,
+    or until it has not been requested for `PIPELINE_IDLE_TIMEOUT` seconds.
+    Pins are counted, releasing a pipeline keeps the sessions that another
+    registered pipeline or the caller still pins.
+
     :param install_only:
     :param modelhub:
     :param fmt:
@@ -40,8 +73,96 @@ def register_pipline(
     if fmt in ["transformers", None]:
         fmt = "transformers" if is_cuda_pipline_available else "onnx"
 
+    if install_only:
+        return _create_pipline(modelhub, fmt, install_only=True, **kwargs)
+
+    if PIPELINE_IDLE_TIMEOUT > 0:
+        release_pipline(idle=PIPELINE_IDLE_TIMEOUT)
+
+    if fmt in ["onnx"]:
+        visual = str(kwargs.get("visual_path") or "") or kwargs.get(
+            "visual_model", modelhub.DEFAULT_CLIP_VISUAL_MODEL
+        )
+        textual = str(kwargs.get("textual_path") or "") or kwargs.get(
+            "textual_model", modelhub.DEFAULT_CLIP_TEXTUAL_MODEL
+        )
+    else:
+        visual = textual = kwargs.get("checkpoint", "laion/CLIP-ViT-L-14-DataComp.XL-s13B-b90K")
+    key = (visual, textual, fmt)
+
+    if (pipeline := _lookup_pipline(key, modelhub)) is not None:
+        return pipeline
+
+    # Downloads and session builds run outside the lock, registrations of other
+    # pipelines do not wait for them. Two threads racing for the same key keep the first.
+    _pipeline = _create_pipline(modelhub, fmt, **kwargs)
+    nets = {}
+    if isinstance(_pipeline, MossCLIP):
+        if not kwargs.get("visual_path"):
+            nets[visual] = _pipeline.visual_session
+        if not kwargs.get("textual_path"):
+            nets[textual] = _pipeline.textual_session
+
+    with _pipelines_lock:
+        if (pipeline := _lookup_pipline(key, modelhub)) is not None:
+            return pipeline
+        for focus_name in nets:
+            modelhub.pin(focus_name)
+        _pipelines[key] = _PipelineEntry(_pipeline, modelhub, nets)
+        return _pipeline
+
+
+def _lookup_pipline(key: Tuple[str, str, str], modelhub: ModelHub) -> Any | None:
+    with _pipelines_lock:
+        entry = _pipelines.get(key)
+        if entry is not None and not entry.is_warm(modelhub):
+            _unpin(_pipelines.pop(key))
+            entry = None
+        if entry is None:
+            return None
+        entry.last_used = time.monotonic()
+        return entry.pipeline
+
+
+def release_pipline(pipeline: Any = None, *, idle: float | None = None) -> int:
+    """
+    Drop shared pipelines from the registry of `register_pipline` and unpin their sessions,
+    `ModelHub.unplug` frees them once nothing else holds them.
+
+    :param pipeline: only this pipeline, defaults to every registered pipeline
+    :param idle: only the pipelines that have not been requested for `idle` seconds
+    :return: the number of pipelines released
+    """
+    now = time.monotonic()
+    with _pipelines_lock:
+        keys = [
+            key
+            for key, entry in _pipelines.items()
+            if (pipeline is None or entry.pipeline is pipeline)
+            and (idle is None or now - entry.last_used >= idle)
+        ]
+        for key in keys:
+            _unpin(_pipelines.pop(key))
+    if keys:
+        logger.debug("release pipline", pipelines=keys)
+    return len(keys)
+
+
+def _unpin(entry: _PipelineEntry):
+    for focus_name in entry.nets:
+        entry.modelhub.unpin(focus_name)
+
+
+def _create_pipline(
+    modelhub: ModelHub,
+    fmt: Literal["onnx", "transformers"],
+    *,
+    install_only: bool = False,
+    **kwargs,
+):
     if fmt in ["onnx"]:
         v_net, t_net = None, None
+        textual_name = ""
 
         if not modelhub.label_alias:
             modelhub.parse_objects()
@@ -54,9 +175,7 @@ def register_pipline(
                     "Select to use visual ONNX model, but the specified model does not exist -"
                     f" {visual_path=}"
                 )
-            v_net = onnxruntime.InferenceSession(
-                visual_path, providers=onnxruntime.get_available_providers()
-            )
+            v_net = modelhub.session_profile.create_session(visual_path)
         if textual_path := kwargs.get("textual_path"):
             if not isinstance(textual_path, Path):
                 raise ValueError("textual_path should be a pathlib.Path")
@@ -65,9 +184,8 @@ def register_pipline(
                     "Select to use textual ONNX model, but the specified model does not exist -"
                     f" {textual_path=}"
                 )
-            t_net = onnxruntime.InferenceSession(
-                textual_path, providers=onnxruntime.get_available_providers()
-            )
+            t_net = modelhub.session_profile.create_session(textual_path)
+            textual_name = str(textual_path)
 
         if not v_net:
             visual_model = kwargs.get("visual_model", modelhub.DEFAULT_CLIP_VISUAL_MODEL)
@@ -75,9 +193,10 @@ def register_pipline(
         if not t_net:
             textual_model = kwargs.get("textual_model", modelhub.DEFAULT_CLIP_TEXTUAL_MODEL)
             t_net = modelhub.match_net(textual_model, install_only=install_only)
+            textual_name = textual_model
 
         if not install_only:
-            _pipeline = MossCLIP.from_pluggable_model(v_net, t_net)
+            _pipeline = MossCLIP.from_pluggable_model(v_net, t_net, textual_name=textual_name)
             return _pipeline
 
     if fmt in ["transformers"]:
@@ -94,8 +213,34 @@ def register_pipline(
 
 
 def format_datalake(dl: DataLake) -> Tuple[List[str], List[str]]:
-    positive_labels = dl.positive_labels.copy()
-    negative_labels = dl.negative_labels.copy()
+    positive_labels, candidate_labels = _format_labels(
+        tuple(dl.positive_labels),
+        tuple(dl.negative_labels),
+        dl.raw_prompt,
+        dl.PREMISED_YES,
+        dl.PREMISED_BAD,
+    )
+    return list(positive_labels), list(candidate_labels)
+
+
+@lru_cache(maxsize=256)
+def _format_labels(
+    positive_labels: Tuple[str, ...],
+    negative_labels: Tuple[str, ...],
+    raw_prompt: str,
+    premised_yes: str,
+    premised_bad: str,
+) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """`format_datalake` of the fields of a DataLake, the same challenges come back all day"""
+    dl = DataLake(
+        positive_labels=list(positive_labels),
+        negative_labels=list(negative_labels),
+        raw_prompt=raw_prompt,
+        PREMISED_YES=premised_yes,
+        PREMISED_BAD=premised_bad,
+    )
+    positive_labels = dl.positive_labels
+    negative_labels = dl.negative_labels
 
     # When the input is a challenge prompt, cut it into phrases
     if dl.raw_prompt:
@@ -120,7 +265,7 @@ def format_datalake(dl: DataLake) -> Tuple[List[str], List[str]]:
     if isinstance(negative_labels, list) and len(negative_labels) != 0:
         candidate_labels.extend(negative_labels)
 
-    return positive_labels, candidate_labels
+    return tuple(positive_labels), tuple(candidate_labels)
 
 
 @dataclass
@@ -128,13 +273,68 @@ class ZeroShotImageClassifier:
     positive_labels: List[str] = field(default_factory=list)
     candidate_labels: List[str] = field(default_factory=list)
 
+    _text_features: Tuple[Any, Tuple[str, ...], np.ndarray] | None = field(
+        default=None, repr=False, compare=False
+    )
+    """
+    (textual session, candidate labels, text features) prepared by `text_features`
+    """
+
     @classmethod
     def from_datalake(cls, dl: DataLake):
         positive_labels, candidate_labels = format_datalake(dl)
         return cls(positive_labels=positive_labels, candidate_labels=candidate_labels)
 
+    def text_features(self, detector: MossCLIP) -> np.ndarray:
+        """
+        The candidate labels encoded by the textual model of the detector, prepared once,
+        each image then costs a visual pass and one matmul
+        """
+        labels = tuple(self.candidate_labels)
+        prepared = self._text_features
+        if prepared is None or prepared[0] is not detector.textual_session or prepared[1] != labels:
+            prepared = (detector.textual_session, labels, detector.text_features(labels))
+            self._text_features = prepared
+        return prepared[2]
+
     def __call__(self, detector: MossCLIP, image: Image, *args, **kwargs):
-        if isinstance(detector, MossCLIP) and not isinstance(image, Iterable):
-            image = [image]
+        if isinstance(detector, MossCLIP):
+            if not isinstance(image, Iterable):
+                image = [image]
+            return detector(
+                image,
+                candidate_labels=self.candidate_labels,
+                text_features=self.text_features(detector),
+            )
         predictions = detector(image, candidate_labels=self.candidate_labels)
         return predictions
+
+    def batch(self, detector: MossCLIP, images: List[Image]) -> np.ndarray:
+        """
+        (n_images, n_labels) scores of the images over `candidate_labels`.
+
+        MossCLIP encodes all images in one visual forward, the transformers pipeline
+        receives them as one list and batches them by its `batch_size`.
+        """
+        if not images:
+            return np.zeros((0, len(self.candidate_labels)), dtype=np.float32)
+
+        if isinstance(detector, MossCLIP):
+            return detector.predict_proba(
+                images, self.candidate_labels, text_features=self.text_features(detector)
+            )
+
+        predictions = detector(list(images), candidate_labels=self.candidate_labels)
+        columns = {label: j for j, label in enumerate(self.candidate_labels)}
+        scores = np.zeros((len(images), len(self.candidate_labels)), dtype=np.float32)
+        for i, prediction in enumerate(predictions):
+            for item in prediction:
+                scores[i, columns[item["label"]]] = item["score"]
+        return scores
+
+    def rank(self, scores: np.ndarray) -> List[dict]:
+        """The predictions of `__call__` from a row of `batch`, best label first"""
+        return [
+            {"score": score, "label": label}
+            for score, label in sorted(zip(scores, self.candidate_labels), key=lambda x: -x[0])
+        ]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/12 10:18
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: inference backends of the ResNet binaries
+from __future__ import annotations
+
+import time
+from typing import Callable, Dict, Literal, Tuple
+
+import numpy as np
+from cv2.dnn import Net
+from loguru import logger
+from onnxruntime import InferenceSession
+
+Backend = Literal["cv2", "onnxruntime"]
+
+BACKENDS = ("cv2", "onnxruntime")
+
+BENCHMARK_ROUNDS = 10
+
+
+class OrtNet:
+    """
+    An onnxruntime.InferenceSession behind the `setInput()` / `forward()` calls
+    of cv2.dnn.Net, so ResNetControl runs unchanged on either backend.
+    Like cv2.dnn.Net it keeps the input between the two calls.
+    """
+
+    def __init__(self, session: InferenceSession):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+        self.output_name = session.get_outputs()[0].name
+        self._blob: np.ndarray | None = None
+
+    def setInput(self, blob: np.ndarray, name: str = "", *args, **kwargs):
+        self._blob = blob
+
+    def forward(self, *args, **kwargs) -> np.ndarray:
+        return self.session.run([self.output_name], {self.input_name: self._blob})[0]
+
+
+def time_forward(net: Net | OrtNet, blob: np.ndarray, rounds: int = BENCHMARK_ROUNDS) -> float:
+    """Median seconds of one forward pass, after a first pass that is not counted"""
+    net.setInput(blob)
+    net.forward()
+
+    elapsed = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        net.setInput(blob)
+        net.forward()
+        elapsed.append(time.perf_counter() - start)
+    return float(np.median(elapsed))
+
+
+def select_backend(
+    loaders: Dict[Backend, Callable[[], Net | OrtNet]],
+    blob: np.ndarray,
+    *,
+    rounds: int = BENCHMARK_ROUNDS,
+) -> Tuple[Backend, Net | OrtNet, Dict[Backend, float]]:
+    """
+    Load the model on every backend and keep the one with the fastest forward pass.
+
+    :param loaders: { backend: load the model on it }
+    :param blob: a typical input, e.g. a challenge grid of 9 images
+    :return: the backend, the model loaded on it and the timings of every backend
+    """
+    nets, timings = {}, {}
+    for backend, load in loaders.items():
+        try:
+            net = load()
+            timings[backend] = time_forward(net, blob, rounds)
+            nets[backend] = net
+        except Exception as err:
+            logger.debug("Backend cannot serve the model", backend=backend, err=err)
+
+    if not timings:
+        raise RuntimeError(f"No backend can serve the model - backends={list(loaders)}")
+
+    backend = min(timings, key=timings.get)
+    return backend, nets[backend], timings
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/11 14:05
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: dynamic batch copies of the ResNet binaries and the YOLO detectors
+from __future__ import annotations
+
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable
+
+import cv2
+import numpy as np
+from loguru import logger
+
+UNBATCHABLE_CACHE_SIZE = 256
+"""Nets without weak references (cv2.dnn.Net) `mark_unbatchable` keeps at most"""
+
+_unbatchable: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_unbatchable_ids: OrderedDict[int, Any] = OrderedDict()
+"""cv2.dnn.Net by id, held until `forget_unbatchable` or pushed out of the LRU"""
+_unbatchable_lock = threading.Lock()
+
+
+def is_unbatchable(net: Any) -> bool:
+    """The net or session rejected a batch before, see `mark_unbatchable`"""
+    with _unbatchable_lock:
+        try:
+            return _unbatchable.get(net, False)
+        except TypeError:
+            return _unbatchable_ids.get(id(net)) is net
+
+
+def mark_unbatchable(net: Any):
+    """
+    Remember that a net or session rejects batches for as long as it lives.
+
+    `ResNetControl` and the YOLO detectors are built for every challenge around the nets
+    of the ModelHub pool, the next wrapper skips the failed batched run.
+    """
+    with _unbatchable_lock:
+        try:
+            _unbatchable[net] = True
+        except TypeError:
+            _unbatchable_ids[id(net)] = net
+            _unbatchable_ids.move_to_end(id(net))
+            while len(_unbatchable_ids) > UNBATCHABLE_CACHE_SIZE:
+                _unbatchable_ids.popitem(last=False)
+
+
+def forget_unbatchable(net: Any):
+    """Release a net `mark_unbatchable` holds, once it leaves the pool"""
+    with _unbatchable_lock:
+        if _unbatchable_ids.get(id(net)) is net:
+            del _unbatchable_ids[id(net)]
+
+
+def batch_name(model_path: Path) -> str:
+    """`bird_2309.onnx` -> `bird_2309.batch.onnx`"""
+    return f"{model_path.stem}.batch.onnx"
+
+
+def _verify(model_path: Path, batch_path: Path):
+    """The batch copy must answer N images exactly like N forward passes of the original"""
+    reference = cv2.dnn.readNetFromONNX(str(model_path))
+    candidate = cv2.dnn.readNetFromONNX(str(batch_path))
+
+    blob = np.random.default_rng(0).random((3, 3, 64, 64), dtype=np.float32)
+    candidate.setInput(blob)
+    batched = candidate.forward()
+    if batched.shape[0] != len(blob):
+        raise ValueError(f"Batch copy returns {batched.shape[0]} rows for {len(blob)} images")
+
+    for i, row in enumerate(batched):
+        reference.setInput(blob[i : i + 1])
+        if not np.allclose(reference.forward()[0], row, atol=1e-5):
+            raise ValueError("Batch copy disagrees with the original model")
+
+
+def verify_session(model_path: Path, batch_path: Path, batch_size: int = 2):
+    """`_verify` through onnxruntime, for the models served as an InferenceSession"""
+    from onnxruntime import InferenceSession
+
+    providers = ["CPUExecutionProvider"]
+    reference = InferenceSession(str(model_path), providers=providers)
+    candidate = InferenceSession(str(batch_path), providers=providers)
+
+    model_input = reference.get_inputs()[0]
+    if not all(isinstance(dim, int) for dim in model_input.shape[1:]):
+        raise ValueError(f"Dynamic image size {model_input.shape} of {model_input.name}")
+    shape = (batch_size, *model_input.shape[1:])
+    blob = np.random.default_rng(0).random(shape, dtype=np.float32)
+
+    batched = candidate.run(None, {model_input.name: blob})
+    for i in range(batch_size):
+        expected = reference.run(None, {model_input.name: blob[i : i + 1]})
+        for output, row in zip(batched, expected):
+            if output.shape[0] != batch_size:
+                raise ValueError(f"Batch copy returns {output.shape[0]} rows for {batch_size}")
+            if not np.allclose(output[i], row[0], rtol=1e-4, atol=1e-4):
+                raise ValueError("Batch copy disagrees with the original model")
+
+
+def export_dynamic_batch(
+    model_path: Path, output_path: Path, *, verify: Callable[[Path, Path], None] = _verify
+) -> Path:
+    """
+    Write a copy of a ResNet binary whose batch dimension is dynamic.
+
+    The models are exported with `torch.onnx.export` for one image, which bakes
+    the batch size into the input shape and into the `[1, -1]` target of the Reshape
+    in front of the classifier head. The copy declares the batch dimension as `N`
+    and rewrites those targets to `[0, -1]` (copy the batch dimension of the input),
+    so `cv2.dnn` runs a whole challenge grid in one forward pass.
+    The heads of the YOLOv8 exports reshape to `[1, C, -1]` the same way,
+    their copies are checked with `verify_session`.
+
+    Requires the `onnx` package (`pip install hcaptcha-challenger[quantize]`).
+
+    :raise ValueError: the graph cannot be batched this way
+    """
+    import onnx
+    from onnx import numpy_helper
+
+    model = onnx.load(str(model_path))
+    graph = model.graph
+
+    for value in [*graph.input, *graph.output]:
+        dims = value.type.tensor_type.shape.dim
+        if dims and dims[0].HasField("dim_value") and dims[0].dim_value != 1:
+            raise ValueError(f"Unexpected batch dimension {dims[0].dim_value} of {value.name}")
+        if dims:
+            dims[0].dim_param = "N"
+
+    shape_inputs = {node.input[1] for node in graph.node if node.op_type == "Reshape"}
+    tensors = [t for t in graph.initializer if t.name in shape_inputs]
+    tensors += [
+        attr.t
+        for node in graph.node
+        if node.op_type == "Constant" and node.output[0] in shape_inputs
+        for attr in node.attribute
+        if attr.name == "value"
+    ]
+    for tensor in tensors:
+        shape = numpy_helper.to_array(tensor)
+        if shape.ndim == 1 and len(shape) and shape[0] == 1:
+            shape = shape.copy()
+            shape[0] = 0
+            tensor.CopyFrom(numpy_helper.from_array(shape.astype(np.int64), tensor.name))
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_name(f"{output_path.stem}.{os.getpid()}.tmp.onnx")
+    try:
+        onnx.save(model, str(tmp_path))
+        verify(model_path, tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    logger.debug("Exported dynamic batch model", src=model_path.name, dst=output_path.name)
+    return output_path
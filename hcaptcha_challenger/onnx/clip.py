@@ -1,19 +1,35 @@
 from __future__ import annotations
 
 import gzip
+import hashlib
 import html
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from functools import lru_cache
-from typing import List, Union, Iterable
+from itertools import chain
+from pathlib import Path
+from typing import List, Union, Iterable, Tuple
 
 import cv2
 import ftfy
 import numpy as np
 import regex as re
+from loguru import logger
 from PIL import Image
 from onnxruntime import InferenceSession
 
+TEXT_FEATURES_CACHE_SIZE = 128
+"""
+Normalized text features of recent candidate labels, keyed by (textual model, labels).
+Every image of a challenge is scored against the same labels
+"""
+
+_text_features: OrderedDict[Tuple[str, Tuple[str, ...]], np.ndarray] = OrderedDict()
+_text_features_lock = threading.Lock()
+
 
 @lru_cache()
 def default_bpe():
@@ -172,6 +188,213 @@ class Tokenizer:
         return result
 
 
+TOKENIZER_CACHE_SIZE = 8192
+"""Words (BPE merges) and texts (token ids) a `FastTokenizer` keeps, each in a bounded LRU"""
+
+PREPROCESS_WORKERS = int(os.environ.get("CLIP_PREPROCESS_WORKERS", min(4, os.cpu_count() or 1)))
+"""Threads `Preprocessor.batch` resizes the images of a batch on, PIL releases the GIL"""
+
+_preprocess_executor: Tuple[int, ThreadPoolExecutor] | None = None
+_preprocess_executor_lock = threading.Lock()
+
+BPE_CACHE_DIR = Path(
+    os.environ.get("CLIP_BPE_CACHE_DIR")
+    or os.path.join(os.environ.get("XDG_CACHE_HOME", "~/.cache"), "hcaptcha-challenger")
+).expanduser()
+"""Where `compile_bpe` writes its artifacts, outside of the installed package"""
+
+_MERGES_MAGIC = "#clip-bpe-merges v1"
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _inflate_merges(bpe_path: str) -> List[str]:
+    merges = gzip.open(bpe_path).read().decode("utf-8").split("\n")
+    return merges[1 : 49152 - 256 - 2 + 1]
+
+
+def merges_path(bpe_path: str = default_bpe(), cache_dir: Path | None = None) -> Path:
+    """The artifact of `compile_bpe` in `BPE_CACHE_DIR`, one per vocabulary file"""
+    source = os.path.abspath(bpe_path)
+    digest = hashlib.sha1(source.encode("utf8")).hexdigest()[:8]
+    stem = Path(source).with_suffix("").with_suffix("").name
+    return Path(cache_dir or BPE_CACHE_DIR).joinpath(f"{stem}.{digest}.merges")
+
+
+def compile_bpe(bpe_path: str = default_bpe(), artifact_path: Path | None = None) -> Path:
+    """
+    Precompile the merges `Tokenizer` reads from the gzipped BPE vocabulary into a plain
+    UTF-8 artifact, one "first second" merge per line behind a header with the number of
+    merges, so `FastTokenizer` reads it instead of inflating 1.3MB per process
+    """
+    artifact_path = artifact_path or merges_path(bpe_path)
+    merges = _inflate_merges(bpe_path)
+
+    artifact_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = artifact_path.with_name(f"{artifact_path.name}.{os.getpid()}.tmp")
+    try:
+        tmp_path.write_text(
+            "\n".join([f"{_MERGES_MAGIC} {len(merges)}", *merges]), encoding="utf-8"
+        )
+        os.replace(tmp_path, artifact_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return artifact_path
+
+
+def load_merges(bpe_path: str = default_bpe(), cache_dir: Path | None = None) -> List[str]:
+    """The merges of the BPE vocabulary by rank, read from the artifact of `compile_bpe`"""
+    artifact_path = merges_path(bpe_path, cache_dir)
+    source_mtime = Path(bpe_path).stat().st_mtime
+    if not artifact_path.exists() or artifact_path.stat().st_mtime < source_mtime:
+        try:
+            compile_bpe(bpe_path, artifact_path)
+        except OSError as err:
+            # A read-only cache, inflate the vocabulary in this process
+            logger.debug("Failed to compile the BPE merges", bpe_path=bpe_path, err=err)
+            return _inflate_merges(bpe_path)
+
+    header, *merges = artifact_path.read_text(encoding="utf-8").split("\n")
+    if header != f"{_MERGES_MAGIC} {len(merges)}":
+        # Compiled again by the next process
+        logger.warning("Corrupted BPE merges artifact", artifact_path=artifact_path)
+        artifact_path.unlink(missing_ok=True)
+        return _inflate_merges(bpe_path)
+    return merges
+
+
+class FastTokenizer:
+    """
+    `Tokenizer` with the same token ids, for the candidate labels of every challenge.
+
+    - The merges come from the plain artifact of `compile_bpe`, ranked by their
+      "first second" line so no tuple is built per merge
+    - BPE merges all occurrences of the best ranked pair in one pass over the word
+    - Words and whole texts are kept in bounded LRUs of TOKENIZER_CACHE_SIZE entries,
+      a repeated label skips ftfy, the regex and BPE entirely
+    - Rows are padded by one masked assignment into the int32 output
+    """
+
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = TOKENIZER_CACHE_SIZE):
+        self.byte_encoder = bytes_to_unicode()
+        self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+
+        merges = load_merges(bpe_path)
+        vocab = list(self.byte_encoder.values())
+        vocab = vocab + [v + "</w>" for v in vocab]
+        vocab.extend(merge.replace(" ", "") for merge in merges)
+        vocab.extend(["<|startoftext|>", "<|endoftext|>"])
+        self.encoder = dict(zip(vocab, range(len(vocab))))
+        self.decoder = {v: k for k, v in self.encoder.items()}
+        self.merge_ranks = dict(zip(merges, range(len(merges))))
+        self.sot_token = self.encoder["<|startoftext|>"]
+        self.eot_token = self.encoder["<|endoftext|>"]
+        self.pat = re.compile(
+            r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
+            re.IGNORECASE,
+        )
+
+        self.cache_size = cache_size
+        self._words: OrderedDict[str, Tuple[int, ...]] = OrderedDict()
+        self._texts: OrderedDict[str, Tuple[int, ...]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, cache: OrderedDict, key: str):
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _store(self, cache: OrderedDict, key: str, value):
+        with self._lock:
+            cache[key] = value
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+    def bpe(self, token: str) -> str:
+        if token in ("<|startoftext|>", "<|endoftext|>"):
+            return token
+        word = [*token[:-1], token[-1] + "</w>"]
+        ranks = self.merge_ranks
+        while len(word) > 1:
+            best, rank = None, len(ranks)
+            for i in range(len(word) - 1):
+                r = ranks.get(f"{word[i]} {word[i + 1]}", rank)
+                if r < rank:
+                    best, rank = i, r
+            if best is None:
+                break
+            first, second = word[best], word[best + 1]
+            merged, i = word[:best], best
+            while i < len(word):
+                if i < len(word) - 1 and word[i] == first and word[i + 1] == second:
+                    merged.append(first + second)
+                    i += 2
+                else:
+                    merged.append(word[i])
+                    i += 1
+            word = merged
+        return " ".join(word)
+
+    def _encode_word(self, token: str) -> Tuple[int, ...]:
+        ids = self._lookup(self._words, token)
+        if ids is None:
+            ids = tuple(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" "))
+            self._store(self._words, token, ids)
+        return ids
+
+    def _encode(self, text: str) -> Tuple[int, ...]:
+        ids = self._lookup(self._texts, text)
+        if ids is None:
+            cleaned = _WHITESPACE.sub(" ", basic_clean(text)).strip().lower()
+            # UTF-8 bytes read as latin-1 code points translate into the byte-level symbols
+            ids = tuple(
+                i
+                for token in self.pat.findall(cleaned)
+                for i in self._encode_word(
+                    token.encode("utf-8").decode("latin-1").translate(self.byte_encoder)
+                )
+            )
+            self._store(self._texts, text, ids)
+        return ids
+
+    def encode(self, text: str) -> List[int]:
+        return list(self._encode(text))
+
+    def decode(self, tokens: List[int]) -> str:
+        text = "".join([self.decoder[token] for token in tokens])
+        text = (
+            bytearray([self.byte_decoder[c] for c in text])
+            .decode("utf-8", errors="replace")
+            .replace("</w>", " ")
+        )
+        return text
+
+    def __call__(
+        self, texts: Union[str, Iterable[str]], context_length: int = 77, *args, **kwargs
+    ) -> np.array:
+        if isinstance(texts, str):
+            texts = [texts]
+
+        # [sot] + ids + [eot], truncated to the context with the last token kept at eot
+        rows = [
+            (self.sot_token, *self._encode(text)[: context_length - 2], self.eot_token)
+            for text in texts
+        ]
+        lengths = np.fromiter(map(len, rows), dtype=np.intp, count=len(rows))
+        tokens = np.fromiter(chain.from_iterable(rows), dtype=np.int32, count=int(lengths.sum()))
+
+        result = np.zeros((len(rows), context_length), dtype=np.int32)
+        result[np.arange(context_length) < lengths[:, np.newaxis]] = tokens
+        return result
+
+
+@lru_cache()
+def fast_tokenizer(bpe_path: str = default_bpe()) -> FastTokenizer:
+    """The FastTokenizer every MossCLIP pipeline of the process shares"""
+    return FastTokenizer(bpe_path)
+
+
 class Preprocessor:
     """
     Our approach to the CLIP `preprocess` neural net that does not rely on PyTorch.
@@ -185,6 +408,21 @@ class Preprocessor:
     NORM_MEAN = np.array([0.48145466, 0.4578275, 0.40821073]).reshape((1, 1, 3))
     NORM_STD = np.array([0.26862954, 0.26130258, 0.27577711]).reshape((1, 1, 3))
 
+    def __init__(self):
+        self._local = threading.local()
+
+    @staticmethod
+    def _resized_shape(h: int, w: int) -> Tuple[int, int]:
+        """
+        Resize so that the smaller dimension matches the required input size.
+        Matches PyTorch:
+        https://github.com/pytorch/vision/blob/7cf0f4cc1801ff1892007c7a11f7c35d8dfb7fd0/torchvision/transforms/functional.py#L366
+        """
+        target_size = Preprocessor.CLIP_INPUT_SIZE
+        if h < w:
+            return target_size, int(target_size * w / h)
+        return int(target_size * h / w), target_size
+
     @staticmethod
     def _crop_and_resize(img: np.ndarray) -> np.ndarray:
         """Resize and crop an image to a square, preserving the aspect ratio."""
@@ -198,16 +436,7 @@ class Preprocessor:
             )
 
         target_size = Preprocessor.CLIP_INPUT_SIZE
-
-        # Resize so that the smaller dimension matches the required input size.
-        # Matches PyTorch:
-        # https://github.com/pytorch/vision/blob/7cf0f4cc1801ff1892007c7a11f7c35d8dfb7fd0/torchvision/transforms/functional.py#L366
-        if h < w:
-            resized_h = target_size
-            resized_w = int(resized_h * w / h)
-        else:
-            resized_w = target_size
-            resized_h = int(resized_w * h / w)
+        resized_h, resized_w = Preprocessor._resized_shape(h, w)
 
         # PIL resizing behaves slightly differently than OpenCV because of
         # antialiasing. See also
@@ -342,22 +571,133 @@ class Preprocessor:
 
         return img
 
+    @staticmethod
+    @lru_cache()
+    def _normalize_table() -> np.ndarray:
+        """
+        (3, 256) float32, the normalized value of every uint8 level of each channel,
+        computed like `__call__` does for a resized pixel
+        """
+        levels = (np.arange(256, dtype=np.float32) / 255).astype(np.float64)
+        table = (levels[:, np.newaxis] - Preprocessor.NORM_MEAN[0]) / Preprocessor.NORM_STD[0]
+        return np.ascontiguousarray(table.T, dtype=np.float32)
+
+    @staticmethod
+    def _image_to_uint8_array(img: Union[Image.Image, np.ndarray], validate: bool) -> np.ndarray:
+        """(H, W, 3) uint8 form of an image, the values are only scanned if `validate`"""
+        if isinstance(img, Image.Image) and img.mode in ("RGB", "L"):
+            return np.asarray(img.convert("RGB") if img.mode == "L" else img)
+        if isinstance(img, Image.Image):
+            img = np.array(img)
+        if not isinstance(img, np.ndarray):
+            raise TypeError(f"Expected PIL Image or np.ndarray but instead got {type(img)}")
+
+        if img.ndim not in (2, 3) or (img.ndim == 3 and img.shape[2] != 3):
+            raise ValueError(f"Expected a 3-channel RGB or grayscale image but got {img.shape}")
+        if validate or img.dtype.kind not in "uif":
+            # The checks of `__call__`, its float form converts back to the same levels
+            img = Preprocessor._image_to_float_array(img)
+        if img.dtype.kind == "f":
+            img = (img.astype(np.float32) * 255).astype(np.uint8)
+        elif img.dtype != np.uint8:
+            img = img.astype(np.uint8)
+        if img.ndim == 2:
+            img = np.repeat(img[:, :, np.newaxis], 3, axis=2)
+        return img
+
+    def _write(self, img: Union[Image.Image, np.ndarray], out: np.ndarray, validate: bool):
+        """Resize, center crop and normalize an image into `out`, a (3, 224, 224) plane"""
+        img = self._image_to_uint8_array(img, validate)
+        h, w = img.shape[:2]
+        if h * w == 0:
+            raise ValueError(
+                f"Height and width of the image should both be non-zero but got shape {h, w}"
+            )
+
+        target_size = self.CLIP_INPUT_SIZE
+        resized_h, resized_w = self._resized_shape(h, w)
+        y_from = (resized_h - target_size) // 2
+        x_from = (resized_w - target_size) // 2
+        img_pil = Image.fromarray(img).resize((resized_w, resized_h), resample=Image.BICUBIC)
+        img_pil = img_pil.crop((x_from, y_from, x_from + target_size, y_from + target_size))
+
+        # A single lookup per channel, straight into its plane of the tensor
+        table = self._normalize_table()
+        for channel, plane in enumerate(cv2.split(np.asarray(img_pil))):
+            cv2.LUT(plane, table[channel], dst=out[channel])
+
+    def batch(
+        self, images: Iterable[Image.Image | np.ndarray], *, validate: bool = False
+    ) -> np.ndarray:
+        """
+        The (N, 3, 224, 224) float32 input of N images, like stacking `__call__` of each.
+
+        The images stay uint8 up to the normalization, which is a lookup of their levels
+        written into a tensor that grows to the largest batch and is reused by the thread,
+        the tensor is overwritten by the next call. Every uint8 level survives the float
+        round trip of `__call__`, so valid images come out the same.
+
+        :param images: PIL images or RGB arrays
+        :param validate: scan array values like `__call__` (non-negative, no NaN, in range),
+            RGB and grayscale PIL images cannot violate the checks
+        """
+        images = list(images)
+        tensor = getattr(self._local, "tensor", None)
+        if tensor is None or len(tensor) < len(images):
+            size = self.CLIP_INPUT_SIZE
+            tensor = self._local.tensor = np.empty((len(images), 3, size, size), np.float32)
+        tensor = tensor[: len(images)]
+
+        executor = _get_preprocess_executor() if len(images) > 1 else None
+        if executor is None:
+            for img, out in zip(images, tensor):
+                self._write(img, out, validate)
+        else:
+            futures = [
+                executor.submit(self._write, img, out, validate) for img, out in zip(images, tensor)
+            ]
+            for future in futures:
+                future.result()
+        return tensor
+
+
+def _get_preprocess_executor() -> ThreadPoolExecutor | None:
+    """The resize pool of this process, threads do not survive a fork"""
+    global _preprocess_executor
+    if PREPROCESS_WORKERS <= 1:
+        return
+    with _preprocess_executor_lock:
+        if _preprocess_executor is None or _preprocess_executor[0] != os.getpid():
+            executor = ThreadPoolExecutor(PREPROCESS_WORKERS, thread_name_prefix="clip-preprocess")
+            _preprocess_executor = (os.getpid(), executor)
+        return _preprocess_executor[1]
+
 
 @dataclass
 class MossCLIP:
     visual_session: InferenceSession
     textual_session: InferenceSession
 
+    textual_name: str = ""
+    """
+    Name of the textual model, the pipelines of the same textual model share their
+    `text_features` under it, nothing is cached when it is empty
+    """
+
     _tokenizer = None
     _preprocessor = None
 
     def __post_init__(self):
-        self._tokenizer = Tokenizer()
+        self._tokenizer = fast_tokenizer()
         self._preprocessor = Preprocessor()
 
     @classmethod
-    def from_pluggable_model(cls, visual_model: InferenceSession, textual_model: InferenceSession):
-        return cls(visual_session=visual_model, textual_session=textual_model)
+    def from_pluggable_model(
+        cls, visual_model: InferenceSession, textual_model: InferenceSession, textual_name: str = ""
+    ):
+        return cls(
+            visual_session=visual_model, textual_session=textual_model, textual_name=textual_name
+        )
 
     def encode_image(self, images: Iterable[Image.Image | np.ndarray]) -> np.ndarray:
         """
@@ -370,8 +710,7 @@ class MossCLIP:
             An array of embeddings of shape (len(images), embedding_size).
 
         """
-        images = [self._preprocessor(image) for image in images]
-        batch = np.concatenate(images)
+        batch = self._preprocessor.batch(images)
         input_name = self.visual_session.get_inputs()[0].name
         return self.visual_session.run(None, {input_name: batch})[0]
 
@@ -388,14 +727,71 @@ class MossCLIP:
         input_name = self.textual_session.get_inputs()[0].name
         return self.textual_session.run(None, {input_name: text})[0]
 
+    def text_features(self, texts: Iterable[str]) -> np.ndarray:
+        """
+        L2-normalized `encode_text`, read-only.
+
+        Cached per (textual_name, texts) in a bounded LRU of TEXT_FEATURES_CACHE_SIZE entries,
+        a challenge grid encodes its candidate labels once instead of once per image.
+        """
+        texts = tuple(texts)
+        key = (self.textual_name, texts)
+        if self.textual_name:
+            with _text_features_lock:
+                features = _text_features.get(key)
+                if features is not None:
+                    _text_features.move_to_end(key)
+                    return features
+
+        features = self.encode_text(texts)
+        features /= np.linalg.norm(features, axis=1, keepdims=True)
+        features.flags.writeable = False
+
+        if self.textual_name:
+            with _text_features_lock:
+                _text_features[key] = features
+                while len(_text_features) > TEXT_FEATURES_CACHE_SIZE:
+                    _text_features.popitem(last=False)
+        return features
+
+    def predict_proba(
+        self,
+        images: Iterable[Image.Image | np.ndarray],
+        candidate_labels,
+        *,
+        text_features: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """
+        (n_images, n_labels) softmax scores of the images over the candidate labels,
+        all images in one visual forward
+        """
+
+        def softmax(x):
+            return np.exp(x) / np.sum(np.exp(x), axis=1, keepdims=True)
+
+        image_features = self.encode_image(images)
+        if text_features is None:
+            text_features = self.text_features(candidate_labels)
+
+        image_features /= np.linalg.norm(image_features, axis=1, keepdims=True)
+
+        text_probs = 100 * image_features @ text_features.T
+        return softmax(text_probs)
+
     def __call__(
-        self, images: Iterable[Image.Image | np.ndarray], candidate_labels, *args, **kwargs
+        self,
+        images: Iterable[Image.Image | np.ndarray],
+        candidate_labels,
+        *args,
+        text_features: np.ndarray | None = None,
+        **kwargs,
     ):
         """
 
         :param images:
         :param candidate_labels:
         :param args:
+        :param text_features: `text_features(candidate_labels)` prepared by the caller
         :param kwargs:
         :return:
             A list of dictionaries containing result, one dictionary per proposed label. The dictionaries contain the
@@ -405,17 +801,7 @@ class MossCLIP:
             - **score** (`float`) -- The score attributed by the model for that label (between 0 and 1).
         """
 
-        def softmax(x):
-            return np.exp(x) / np.sum(np.exp(x), axis=1, keepdims=True)
-
-        image_features = self.encode_image(images)
-        text_features = self.encode_text(candidate_labels)
-
-        image_features /= np.linalg.norm(image_features, axis=1, keepdims=True)
-        text_features /= np.linalg.norm(text_features, axis=1, keepdims=True)
-
-        text_probs = 100 * image_features @ text_features.T
-        text_probs = softmax(text_probs)
+        text_probs = self.predict_proba(images, candidate_labels, text_features=text_features)
 
         result = [
             {"score": score, "label": label}
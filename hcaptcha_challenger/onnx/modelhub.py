@@ -5,21 +5,26 @@
 # Description:
 from __future__ import annotations
 
-import gc
+import hashlib
 import json
+import math
 import os
+import pickle
 import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from dataclasses import dataclass, field
-from datetime import datetime, timedelta
+from datetime import timedelta
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Tuple, Literal, Iterable
 from urllib.parse import urlparse
 
 import cv2
 import httpx
-import onnxruntime
+import numpy as np
 import yaml
 from cv2.dnn import Net
 from loguru import logger
@@ -27,19 +32,257 @@ from onnxruntime import InferenceSession
 from tenacity import *
 from tqdm import tqdm
 
+from hcaptcha_challenger.onnx.backend import OrtNet, select_backend
+from hcaptcha_challenger.onnx.batching import (
+    export_dynamic_batch,
+    batch_name,
+    forget_unbatchable,
+    verify_session,
+)
+from hcaptcha_challenger.onnx.options import SessionProfile, file_identity
+from hcaptcha_challenger.onnx.pool import SessionPool, PoolStats, DEFAULT_POOL_BUDGET
+from hcaptcha_challenger.onnx.quantize import (
+    QuantizePolicy,
+    QuantizedVariant,
+    QuantizeMode,
+    DEFAULT_AGREEMENT_THRESHOLD,
+    quantize_model,
+    measure_agreement,
+    variant_name,
+)
+from hcaptcha_challenger.onnx.routing import AshRouter
+from hcaptcha_challenger.onnx.server import ModelClient, ModelServerError, RemoteNet, RemoteSession
+from hcaptcha_challenger.onnx.verdicts import VerdictCache, VerdictStats
 from hcaptcha_challenger.utils import from_dict_to_model
 
 DEFAULT_KEYPOINT_MODEL = "COCO2020_yolov8m.onnx"
 
 
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_WORKERS = 4
+
+OBJECTS_SNAPSHOT_VERSION = 1
+"""
+Bump it whenever the layout of the snapshot or of AshRouter changes
+"""
+
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+_download_locks: Dict[str, threading.RLock] = {}
+_download_locks_guard = threading.Lock()
+
+
+def _download_lock(save_path: Path) -> threading.RLock:
+    """Serialize downloads of the same file, downloads of different files run concurrently"""
+    key = str(Path(save_path).absolute())
+    with _download_locks_guard:
+        return _download_locks.setdefault(key, threading.RLock())
+
+
+def _probe_resource(client: httpx.Client, url: str) -> Tuple[int | None, bool, str]:
+    """
+    Ask for the first byte to learn the size of the resource and whether it supports Range
+    :return: total_size, accept_ranges, etag
+    """
+    with client.stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
+        response.raise_for_status()
+        etag = response.headers.get("ETag", "")
+        if response.status_code == 206:
+            content_range = response.headers.get("Content-Range", "")
+            total = content_range.rsplit("/", 1)[-1]
+            if total.isdigit():
+                return int(total), True, etag
+        total = response.headers.get("Content-Length", "")
+        return (int(total) if total.isdigit() else None), False, etag
+
+
+def _file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(1024 * 1024):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _read_objects_snapshot(snapshot_path: Path, objects_path: Path, stat: os.stat_result):
+    try:
+        snapshot = pickle.loads(snapshot_path.read_bytes())
+    except FileNotFoundError:
+        return
+    except Exception as err:
+        logger.warning("Drop broken objects snapshot", path=snapshot_path, err=err)
+        snapshot_path.unlink(missing_ok=True)
+        return
+
+    if not isinstance(snapshot, dict) or snapshot.get("version") != OBJECTS_SNAPSHOT_VERSION:
+        return
+    if snapshot["mtime_ns"] == stat.st_mtime_ns and snapshot["size"] == stat.st_size:
+        return snapshot
+
+    # `pull_objects` rewrites the file every hour, mostly with the same content
+    if snapshot["size"] == stat.st_size and snapshot["sha256"] == _file_sha256(objects_path):
+        snapshot["mtime_ns"] = stat.st_mtime_ns
+        _write_objects_snapshot(
+            snapshot_path, pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        return snapshot
+
+
+def _write_objects_snapshot(snapshot_path: Path, payload: bytes):
+    tmp_path = snapshot_path.with_name(
+        f"{snapshot_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        tmp_path.write_bytes(payload)
+        os.replace(tmp_path, snapshot_path)
+    except OSError as err:
+        logger.warning("Failed to write objects snapshot", path=snapshot_path, err=err)
+        tmp_path.unlink(missing_ok=True)
+
+
+def load_objects(objects_path: Path) -> Tuple[dict | None, AshRouter | None]:
+    """
+    Parse objects.yaml together with its compiled AshRouter.
+
+    The result is cached in `objects.yaml.snapshot` next to the file,
+    keyed by its mtime, size and sha256, so that only the first process
+    after an update pays for the YAML parsing and the router compilation.
+
+    :return: (raw data, router), (None, None) if the file is empty
+    """
+    snapshot_path = objects_path.with_name(f"{objects_path.name}.snapshot")
+    stat = objects_path.stat()
+
+    if snapshot := _read_objects_snapshot(snapshot_path, objects_path, stat):
+        return snapshot["data"], snapshot["router"]
+
+    raw = objects_path.read_bytes()
+    data = yaml.load(raw.decode("utf8"), Loader=_YamlLoader)
+    if not data:
+        return None, None
+
+    router = AshRouter.from_objects(
+        data.get("ashes_of_war") or {},
+        data.get("clip_candidates") or {},
+        default_model=DEFAULT_KEYPOINT_MODEL,
+    )
+    snapshot = {
+        "version": OBJECTS_SNAPSHOT_VERSION,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": len(raw),
+        "sha256": hashlib.sha256(raw).hexdigest(),
+        "data": data,
+        "router": router,
+    }
+    payload = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+    _write_objects_snapshot(snapshot_path, payload)
+
+    # Hand over the same objects a later process gets from the snapshot
+    snapshot = pickle.loads(payload)
+    return snapshot["data"], snapshot["router"]
+
+
+def _stream_download(client: httpx.Client, url: str, part_path: Path, progress: tqdm) -> str:
+    """Single connection fallback for servers without Range support"""
+    sha256 = hashlib.sha256()
+    with open(part_path, "wb") as download_file:
+        with client.stream("GET", url) as response:
+            response.raise_for_status()
+            for chunk in response.iter_bytes():
+                download_file.write(chunk)
+                sha256.update(chunk)
+                progress.update(len(chunk))
+    return sha256.hexdigest()
+
+
+def _range_download(
+    client: httpx.Client,
+    url: str,
+    part_path: Path,
+    total: int,
+    etag: str,
+    progress: tqdm,
+    *,
+    chunk_size: int,
+    workers: int,
+):
+    """
+    Download byte ranges in parallel into a preallocated `.part` file.
+    Finished chunks are recorded in `.part.json` so an interrupted download resumes.
+    """
+    state_path = part_path.with_name(f"{part_path.name}.json")
+    state = {"url": url, "total": total, "etag": etag, "chunk_size": chunk_size, "done": []}
+
+    with suppress(FileNotFoundError, JSONDecodeError):
+        previous = json.loads(state_path.read_text(encoding="utf8"))
+        if part_path.exists() and all(
+            previous.get(k) == state[k] for k in ["url", "total", "etag", "chunk_size"]
+        ):
+            state["done"] = previous.get("done", [])
+
+    if not state["done"]:
+        with open(part_path, "wb") as part_file:
+            part_file.truncate(total)
+
+    num_chunks = math.ceil(total / chunk_size)
+    done = set(state["done"])
+    progress.update(sum(min(chunk_size, total - i * chunk_size) for i in done))
+
+    state_lock = threading.Lock()
+
+    def fetch(index: int):
+        start = index * chunk_size
+        end = min(start + chunk_size, total) - 1
+        with open(part_path, "r+b") as part_file:
+            part_file.seek(start)
+            with client.stream("GET", url, headers={"Range": f"bytes={start}-{end}"}) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise httpx.RemoteProtocolError(f"Range request ignored - {url=}")
+                written = 0
+                for chunk in response.iter_bytes():
+                    part_file.write(chunk)
+                    written += len(chunk)
+                    progress.update(len(chunk))
+        if written != end - start + 1:
+            raise httpx.RemoteProtocolError(f"Incomplete chunk - {index=} {written=}")
+        with state_lock:
+            done.add(index)
+            state["done"] = sorted(done)
+            state_path.write_text(json.dumps(state), encoding="utf8")
+
+    pending = [i for i in range(num_chunks) if i not in done]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for future in [executor.submit(fetch, i) for i in pending]:
+            future.result()
+
+    state_path.unlink(missing_ok=True)
+
+
 @logger.catch
 @retry(
-    retry=retry_if_exception_type((httpx.ConnectTimeout, httpx.ConnectError)),
+    retry=retry_if_exception_type(httpx.TransportError),
     wait=wait_random_exponential(multiplier=1, max=60),
     stop=(stop_after_delay(30) | stop_after_attempt(5)),
     reraise=True,
 )
-def request_resource(url: str, save_path: Path):
+def request_resource(
+    url: str,
+    save_path: Path,
+    *,
+    sha256: str = "",
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    workers: int = DOWNLOAD_WORKERS,
+) -> Path | None:
+    """
+    Download `url` into `save_path.part`, then atomically rename it to `save_path`.
+
+    - Servers that support Range are downloaded in parallel chunks, and an interrupted
+    download resumes from the chunks already on disk.
+    - When `sha256` is given, the file is only renamed if its digest matches.
+
+    :return: save_path, or None if the download failed
+    """
     cdn_prefix = os.environ.get("MODELHUB_CDN_PREFIX", "")
 
     if cdn_prefix and cdn_prefix.startswith("https://"):
@@ -48,24 +291,73 @@ def request_resource(url: str, save_path: Path):
         url = f"{scheme}://{netloc}/{url}"
 
     headers = {
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/119.0"
+        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/119.0",
+        "accept-encoding": "identity",
     }
-    with open(save_path, "wb") as download_file:
+    save_path = Path(save_path)
+    part_path = save_path.with_name(f"{save_path.name}.part")
+
+    with _download_lock(save_path):
         with httpx.Client(headers=headers, follow_redirects=True, http2=True) as client:
-            with client.stream("GET", url) as response:
-                total = int(response.headers["Content-Length"])
-                with tqdm(
-                    total=total,
-                    unit_scale=True,
-                    unit_divisor=1024,
-                    unit="B",
-                    desc=f"Installing {save_path.parent.name}/{save_path.name}",
-                ) as progress:
-                    num_bytes_downloaded = response.num_bytes_downloaded
-                    for chunk in response.iter_bytes():
-                        download_file.write(chunk)
-                        progress.update(response.num_bytes_downloaded - num_bytes_downloaded)
-                        num_bytes_downloaded = response.num_bytes_downloaded
+            total, accept_ranges, etag = _probe_resource(client, url)
+            with tqdm(
+                total=total,
+                unit_scale=True,
+                unit_divisor=1024,
+                unit="B",
+                desc=f"Installing {save_path.parent.name}/{save_path.name}",
+            ) as progress:
+                if accept_ranges and total:
+                    _range_download(
+                        client,
+                        url,
+                        part_path,
+                        total,
+                        etag,
+                        progress,
+                        chunk_size=chunk_size,
+                        workers=workers,
+                    )
+                    digest = _file_sha256(part_path) if sha256 else ""
+                else:
+                    digest = _stream_download(client, url, part_path, progress)
+
+        if total is not None and part_path.stat().st_size != total:
+            part_path.unlink(missing_ok=True)
+            raise ValueError(f"Incomplete download - {url=} {total=}")
+        if sha256 and digest != sha256.lower():
+            part_path.unlink(missing_ok=True)
+            raise ValueError(f"SHA-256 mismatch - {url=} expected={sha256} actual={digest}")
+
+        os.replace(part_path, save_path)
+
+    return save_path
+
+
+_WARMUP_DTYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(double)": np.float64,
+    "tensor(int64)": np.int64,
+    "tensor(int32)": np.int32,
+    "tensor(uint8)": np.uint8,
+    "tensor(bool)": np.bool_,
+}
+
+
+def warmup_net(net: Net | InferenceSession | OrtNet):
+    """One inference on zeros, dynamic dimensions are taken as 1"""
+    if isinstance(net, (Net, OrtNet)):
+        # The ResNet binaries are the only models served through the cv2.dnn interface
+        net.setInput(np.zeros((1, 3, 64, 64), dtype=np.float32))
+        net.forward()
+        return
+
+    feeds = {}
+    for node in net.get_inputs():
+        shape = [dim if isinstance(dim, int) and dim > 0 else 1 for dim in node.shape]
+        feeds[node.name] = np.zeros(shape, dtype=_WARMUP_DTYPES.get(node.type, np.float32))
+    net.run(None, feeds)
 
 
 @dataclass
@@ -75,6 +367,15 @@ class ReleaseAsset:
     name: str
     size: int
     browser_download_url: str
+    digest: str = ""
+    """
+    Such as `sha256:9f86d0...`, empty for assets uploaded before GitHub exposed digests
+    """
+
+    @property
+    def sha256(self) -> str:
+        algorithm, _, value = self.digest.partition(":")
+        return value if algorithm == "sha256" else ""
 
 
 @dataclass
@@ -114,29 +415,36 @@ class Assets:
     model_name.onnx to asset_node_id
     """
 
+    _etag: str = ""
+    """
+    ETag of the release response the index was built from, sent back as If-None-Match
+    """
+
+    _fetched_at: float = 0.0
+    """
+    Unix time the index was last confirmed against the remote repository
+    """
+
+    _revalidating: threading.Lock = field(default_factory=threading.Lock)
+
     def __post_init__(self):
         for ck in [self._assets_dir, self._memory_dir]:
             ck.mkdir(mode=0o777, parents=True, exist_ok=True)
 
+    @property
+    def index_path(self) -> Path:
+        return self._assets_dir.joinpath("index.json")
+
     @classmethod
     def from_release_url(cls, release_url: str, **kwargs):
         instance = cls(release_url=release_url, **kwargs)
 
         # Assets - latest information
-        # Called only before the Assets._pull network request is initiated,
-        # and the effective local cache will replace the remote resource
-        assets = [instance._assets_dir.joinpath(i) for i in os.listdir(instance._assets_dir)]
-        if assets:
-            resp_path = assets[-1]
-            resp_ctime = datetime.fromtimestamp(resp_path.stat().st_ctime)
-            if resp_ctime + instance.cache_lifetime > datetime.now():
-                try:
-                    data = json.loads(resp_path.read_text(encoding="utf8"))
-                    instance._name2asset = {
-                        k: from_dict_to_model(ReleaseAsset, v) for k, v in data.items()
-                    }
-                except JSONDecodeError as err:
-                    logger.warning(err)
+        # Serve the local index immediately, however old it is,
+        # and revalidate it against the remote repository in the background
+        instance.load_index()
+        if instance._name2asset and not instance.is_fresh:
+            instance.revalidate(background=True)
 
         # Memory - version control
         for x in os.listdir(instance._memory_dir):
@@ -145,59 +453,128 @@ class Assets:
 
         return instance
 
+    @property
+    def is_fresh(self) -> bool:
+        return time.time() - self._fetched_at < self.cache_lifetime.total_seconds()
+
+    def load_index(self):
+        """Read the local index file"""
+        if not self.index_path.exists():
+            return
+        try:
+            index = json.loads(self.index_path.read_text(encoding="utf8"))
+            self._name2asset = {
+                k: from_dict_to_model(ReleaseAsset, v) for k, v in index["assets"].items()
+            }
+            self._etag = index.get("etag", "")
+            self._fetched_at = float(index.get("fetched_at", 0))
+        except (JSONDecodeError, KeyError, TypeError, ValueError) as err:
+            logger.warning("Drop broken assets index", err=err)
+
+    def _dump_index(self):
+        index = {
+            "etag": self._etag,
+            "fetched_at": self._fetched_at,
+            "assets": {k: v.__dict__ for k, v in self._name2asset.items()},
+        }
+        # Unique per thread, two Assets of one process may revalidate the same index at once
+        tmp_path = self.index_path.with_name(
+            f"{self.index_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        try:
+            tmp_path.write_text(json.dumps(index, ensure_ascii=True, indent=2), encoding="utf8")
+            os.replace(tmp_path, self.index_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+        # Index files of older versions, `{timestamp}.json` and `_{timestamp}.json`
+        for legacy in self._assets_dir.glob("*.json"):
+            if legacy != self.index_path:
+                legacy.unlink(missing_ok=True)
+
     def get_focus_asset(self, focus_name: str) -> ReleaseAsset:
         return self._name2asset.get(focus_name)
 
-    @logger.catch
+    def get_node_id(self, focus_name: str) -> str:
+        """node_id of the local copy of a model, empty if it was never archived"""
+        return self._name2node.get(focus_name, "")
+
     @retry(
         retry=retry_if_exception_type(httpx.ConnectTimeout),
         wait=wait_random_exponential(multiplier=1, max=60),
         stop=(stop_after_delay(30) | stop_after_attempt(5)),
         reraise=True,
     )
-    def flush_runtime_assets(self, upgrade: bool = False):
-        """Request assets index from remote repository"""
-        self._name2asset = {}
+    def _fetch_index(self, conditional: bool = True):
+        headers = {
+            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/119.0"
+        }
+        if conditional and self._etag and self._name2asset:
+            headers["if-none-match"] = self._etag
+
+        with httpx.Client(timeout=3, http2=True, headers=headers) as client:
+            resp = client.get(self.release_url)
+
+        # Not Modified, and does not count against the GitHub API rate limit
+        if resp.status_code == 304:
+            self._fetched_at = time.time()
+            self._dump_index()
+            return
 
-        if upgrade is True:
-            shutil.rmtree(self._assets_dir, ignore_errors=True)
-            self._assets_dir.mkdir(parents=True, exist_ok=True)
-
-        assets_paths = [self._assets_dir.joinpath(i) for i in os.listdir(self._assets_dir)]
-        is_outdated = False
-        if assets_paths:
-            resp_path = assets_paths[-1]
-            resp_ctime = datetime.fromtimestamp(resp_path.stat().st_ctime)
-            if resp_ctime + self.cache_lifetime < datetime.now():
-                is_outdated = True
-
-        # Request assets index from remote repository
-        if upgrade is True or not assets_paths or is_outdated:
+        resp.raise_for_status()
+        data = resp.json()[0]
+        assets: List[dict] = data.get("assets", [])
+        self._name2asset = {a["name"]: from_dict_to_model(ReleaseAsset, a) for a in assets}
+        self._etag = resp.headers.get("ETag", "")
+        self._fetched_at = time.time()
+        self._dump_index()
+
+    @logger.catch
+    def revalidate(self, *, conditional: bool = True, background: bool = False):
+        """
+        Refresh the index from the remote repository, at most one refresh at a time.
+        :param conditional: Send If-None-Match with the ETag of the local index
+        :param background: Return immediately and refresh in a daemon thread
+        """
+        if not self._revalidating.acquire(blocking=not background):
+            return
+
+        def _run():
             try:
-                headers = {
-                    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/119.0"
-                }
-                client = httpx.Client(timeout=3, http2=True, headers=headers)
-                resp = client.get(self.release_url)
-                data = resp.json()[0]
-                assets: List[dict] = data.get("assets", [])
-                for asset in assets:
-                    release_asset = from_dict_to_model(ReleaseAsset, asset)
-                    self._name2asset[asset["name"]] = release_asset
-            except (httpx.ConnectError, JSONDecodeError) as err:
+                self._fetch_index(conditional=conditional)
+            except (httpx.HTTPError, JSONDecodeError) as err:
                 logger.error(err)
-            except (AttributeError, IndexError, KeyError) as err:
+            except (AttributeError, IndexError, KeyError, OSError) as err:
                 logger.error(err)
+            except Exception as err:
+                # `logger.catch` of the caller does not reach the background thread
+                logger.exception(err)
+            finally:
+                self._revalidating.release()
+
+        if background:
+            threading.Thread(target=_run, name="assets-revalidate", daemon=True).start()
+        else:
+            _run()
 
-        # Only implemented after the Assets._pull network request is initiated,
-        # it is used to update the content and timestamp of the local cache
-        for asset_fn in os.listdir(self._assets_dir):
-            asset_src = self._assets_dir.joinpath(asset_fn)
-            asset_dst = self._assets_dir.joinpath(f"_{asset_fn.replace('_', '')}")
-            shutil.move(asset_src, asset_dst)
-        assets_path = self._assets_dir.joinpath(f"{int(time.time())}.json")
-        data = {k: v.__dict__ for k, v in self._name2asset.items()}
-        assets_path.write_text(json.dumps(data, ensure_ascii=True, indent=2))
+    def flush_runtime_assets(self, upgrade: bool = False):
+        """
+        Make sure the assets index is usable.
+
+        - upgrade: request the full index and block until it arrives
+        - no local index: block until it arrives
+        - stale local index: keep serving it and revalidate in the background
+        """
+        if upgrade is True:
+            self.revalidate(conditional=False)
+        elif not self._name2asset:
+            self.load_index()
+            if not self._name2asset:
+                self.revalidate()
+            elif not self.is_fresh:
+                self.revalidate(background=True)
+        elif not self.is_fresh:
+            self.revalidate(background=True)
 
     def archive_memory(self, focus_name: str, new_node_id: str):
         """
@@ -247,6 +624,8 @@ class ModelHub:
 
     models_dir = Path(__file__).parent.joinpath("models")
     assets_dir = models_dir.joinpath("_assets")
+    optimized_dir = models_dir.joinpath("_optimized")
+    quantized_dir = models_dir.joinpath("_quantized")
     objects_path = models_dir.joinpath("objects.yaml")
 
     lang: str = "en"
@@ -317,14 +696,96 @@ class ModelHub:
 
     assets: Assets = None
 
-    _name2net: Dict[str, Net | InferenceSession] = field(default_factory=dict)
+    pool_budget: int = DEFAULT_POOL_BUDGET
+    """
+    Bytes of ONNX weights allowed to stay resident between challenges,
+    set `MODELHUB_POOL_BUDGET_MB` to change the default
+    """
+
+    pool_policy: Literal["lru", "lfu"] = "lru"
+    """
+    Which unpinned session is evicted first once the pool exceeds its budget
+    """
+
+    session_profile: SessionProfile = field(default_factory=SessionProfile)
+    """
+    Global onnxruntime session options
+    """
+
+    session_profiles: Dict[str, SessionProfile] = field(default_factory=dict)
+    """
+    { model_name.onnx: SessionProfile } overrides `session_profile` for specific models
+    """
+
+    use_quantized: bool = True
+    """
+    Serve the INT8/FP16 variant of a model instead of the FP32 file
+    when `quantize_policy` approves one, see `ModelHub.check_quantized`
+    """
+
+    batch_resnet: bool = True
+    """
+    Serve the ResNet binaries from a dynamic batch copy (requires `onnx`),
+    so `ResNetControl.execute_batch` classifies a challenge grid in one forward pass
+    """
+
+    batch_yolo: bool = True
+    """
+    Serve the YOLO detectors from a dynamic batch copy (requires `onnx`),
+    so `YOLOv8.detect_batch` runs the images of a challenge in one `session.run`
+    """
+
+    resnet_backend: Literal["cv2", "onnxruntime", "auto"] = field(
+        default_factory=lambda: os.getenv("MODELHUB_RESNET_BACKEND", "cv2")
+    )
+    """
+    Which backend serves the ResNet binaries, YOLO and CLIP models always run on onnxruntime.
+    `auto` loads the model on both and keeps the faster one on a challenge grid,
+    set `MODELHUB_RESNET_BACKEND` to change the default
+    """
+
+    resnet_backends: Dict[str, Literal["cv2", "onnxruntime", "auto"]] = field(default_factory=dict)
+    """
+    { model_name.onnx: backend } overrides `resnet_backend` for specific models
+    """
+
+    server_address: str = field(default_factory=lambda: os.getenv("MODELHUB_SERVER", ""))
+    """
+    Unix socket of a `hcaptcha_challenger.onnx.server` process.
+    When set, match_net returns proxies to the sessions held by that server
+    instead of loading a private copy of every model
+    """
+
+    verdict_cache_path: str = field(default_factory=lambda: os.getenv("MODELHUB_VERDICT_CACHE", ""))
+    """
+    SQLite file of a `VerdictCache`, shared by the agents and workers of a host.
+    When set, the classifiers look an image up before running inference on it
+    """
+
+    _client: ModelClient | None = None
+
+    _verdicts: VerdictCache | None = None
+
+    _name2net: SessionPool = None
     """
     { model_name1.onnx: cv2.dnn.Net }
     { model_name2.onnx: onnxruntime.InferenceSession }
     """
 
+    _router: AshRouter | None = None
+
+    _quantize_policy: QuantizePolicy | None = None
+
+    _measured_backends: Dict[str, str] = field(default_factory=dict)
+    """
+    { model_file.onnx: backend } chosen by `resnet_backend="auto"`, measured once per process
+    """
+
     def __post_init__(self):
         self.assets_dir.mkdir(mode=0o777, parents=True, exist_ok=True)
+        if self._name2net is None:
+            self._name2net = SessionPool(budget=self.pool_budget, policy=self.pool_policy)
+        self._name2net.on_delete = lambda name, net: forget_unbatchable(net)
 
     @classmethod
     def from_github_repo(cls, username: str = "QIN2DIM", lang: str = "en", **kwargs):
@@ -351,7 +812,7 @@ class ModelHub:
         if not self.objects_path.exists():
             return
 
-        data = yaml.safe_load(self.objects_path.read_text(encoding="utf8"))
+        data, router = load_objects(self.objects_path)
         if not data:
             os.remove(self.objects_path)
             return
@@ -385,6 +846,9 @@ class ModelHub:
         clip_candidates = data.get("clip_candidates", {})
         self.clip_candidates = clip_candidates or {}
 
+        # The router property recompiles it if the tables above did not come from `data`
+        self._router = router
+
     def pull_model(self, focus_name: str):
         """
         1. node_id: Record the insertion point
@@ -405,17 +869,104 @@ class ModelHub:
 
         # Matching conditions to trigger download tasks
         model_path = self.models_dir.joinpath(focus_name)
-        if (
-            not model_path.exists()
-            or model_path.stat().st_size != focus_asset.size
-            or self.assets.is_outdated(focus_name)
-        ):
-            try:
-                request_resource(focus_asset.browser_download_url, model_path.absolute())
-            except httpx.ConnectTimeout as err:
-                logger.error("Failed to download resource, try again", err=err)
-            else:
-                self.assets.archive_memory(focus_name, focus_asset.node_id)
+        with _download_lock(model_path):
+            if (
+                not model_path.exists()
+                or model_path.stat().st_size != focus_asset.size
+                or self.assets.is_outdated(focus_name)
+            ):
+                if request_resource(
+                    focus_asset.browser_download_url,
+                    model_path.absolute(),
+                    sha256=focus_asset.sha256,
+                ):
+                    self.assets.archive_memory(focus_name, focus_asset.node_id)
+                else:
+                    logger.error("Failed to download resource, try again", focus_name=focus_name)
+
+    def pull_models(self, focus_names: Iterable[str], max_workers: int = 4):
+        """Download several models concurrently"""
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self.pull_model, focus_names))
+
+    def get_session_profile(self, focus_name: str) -> SessionProfile:
+        return self.session_profiles.get(focus_name, self.session_profile)
+
+    def get_resnet_backend(self, focus_name: str) -> Literal["cv2", "onnxruntime", "auto"]:
+        return self.resnet_backends.get(focus_name, self.resnet_backend)
+
+    def _create_session(self, focus_name: str, model_path: Path) -> InferenceSession:
+        profile = self.get_session_profile(focus_name)
+        cache_name = profile.cache_name(model_path.name, self._get_node_id(focus_name), model_path)
+        return profile.create_session(
+            model_path, cache_path=self.optimized_dir.joinpath(cache_name)
+        )
+
+    def _load_net(self, focus_name: str, model_path: Path) -> Net | InferenceSession | OrtNet:
+        if "yolo" in focus_name.lower():
+            if self.batch_yolo:
+                model_path = self._get_batch_model(model_path, verify=verify_session)
+            return self._create_session(focus_name, model_path)
+        if "clip" in focus_name.lower():
+            return self._create_session(focus_name, model_path)
+
+        if self.batch_resnet:
+            model_path = self._get_batch_model(model_path)
+
+        loaders = {
+            "cv2": lambda: cv2.dnn.readNetFromONNX(str(model_path)),
+            "onnxruntime": lambda: OrtNet(self._create_session(focus_name, model_path)),
+        }
+        backend = self.get_resnet_backend(focus_name)
+        if backend == "auto":
+            backend = self._measured_backends.get(model_path.name, backend)
+        if backend in loaders:
+            return loaders[backend]()
+        if backend != "auto":
+            raise ValueError(
+                f"Unknown ResNet backend {backend!r}, expected cv2, onnxruntime or auto"
+            )
+
+        # A challenge grid, one image if the model has a fixed batch size
+        batch_size = 9 if model_path.name.endswith(".batch.onnx") else 1
+        blob = np.zeros((batch_size, 3, 64, 64), dtype=np.float32)
+        backend, net, timings = select_backend(loaders, blob)
+        self._measured_backends[model_path.name] = backend
+        logger.debug(
+            "Selected ResNet backend",
+            name=model_path.name,
+            backend=backend,
+            timings={k: f"{v * 1000:.2f}ms" for k, v in timings.items()},
+        )
+        return net
+
+    def _get_batch_model(self, model_path: Path, **kwargs) -> Path:
+        """
+        The dynamic batch copy of a model, the model itself if it cannot be built.
+
+        A failed export leaves a `.batch.failed` marker, the next loads of the same model
+        skip the rewrite and the verification until the model file changes.
+        """
+        batch_path = self.optimized_dir.joinpath(batch_name(model_path))
+        failed_path = batch_path.with_suffix(".failed")
+        model_mtime = model_path.stat().st_mtime
+        if batch_path.exists() and batch_path.stat().st_mtime >= model_mtime:
+            return batch_path
+        if failed_path.exists() and failed_path.stat().st_mtime >= model_mtime:
+            return model_path
+        try:
+            return export_dynamic_batch(model_path, batch_path, **kwargs)
+        except ImportError:
+            return model_path
+        except Exception as err:
+            logger.debug("Serve the model without a batch copy", name=model_path.name, err=err)
+            with suppress(OSError):
+                failed_path.parent.mkdir(parents=True, exist_ok=True)
+                failed_path.write_text(f"{type(err).__name__}: {err}", encoding="utf8")
+            return model_path
+
+    def _get_node_id(self, focus_name: str) -> str:
+        return self.assets.get_node_id(focus_name) if self.assets else ""
 
     def active_net(self, focus_name: str) -> Net | InferenceSession | None:
         """Load and register an existing model"""
@@ -425,13 +976,17 @@ class ModelHub:
             and model_path.stat().st_size
             and not self.assets.is_outdated(focus_name)
         ):
-            if "yolo" in focus_name.lower() or "clip" in focus_name.lower():
-                net = onnxruntime.InferenceSession(
-                    model_path, providers=onnxruntime.get_available_providers()
-                )
-            else:
-                net = cv2.dnn.readNetFromONNX(str(model_path))
-            self._name2net[focus_name] = net
+            net = None
+            if variant := self.get_quantized_variant(focus_name):
+                variant_path = self.quantized_dir.joinpath(variant.name)
+                try:
+                    net = self._load_net(focus_name, variant_path)
+                    model_path = variant_path
+                except Exception as err:
+                    logger.warning("Failed to load quantized model", name=variant.name, err=err)
+            if net is None:
+                net = self._load_net(focus_name, model_path)
+            self._name2net.put(focus_name, net, size=model_path.stat().st_size)
             return net
 
     def match_net(
@@ -462,79 +1017,263 @@ class ModelHub:
         :return:
         """
         net = self._name2net.get(focus_name)
-        if not net:
+        if net is None and self.server_address:
+            try:
+                return self._match_remote_net(focus_name, install_only=install_only)
+            except ModelServerError as err:
+                logger.warning(
+                    "Model server cannot serve the model, load it locally",
+                    server_address=self.server_address,
+                    focus_name=focus_name,
+                    err=err,
+                )
+        if net is None:
             self.pull_model(focus_name)
             if not install_only:
                 net = self.active_net(focus_name)
         return net
 
-    def unplug(self):
-        for ash in self.ashes_of_war:
-            if ash not in self._name2net:
-                continue
-            del self._name2net[ash]
-            gc.collect()
+    def _match_remote_net(self, focus_name: str, *, install_only: bool = False):
+        if self._client is None:
+            self._client = ModelClient(self.server_address, on_disconnect=self._drop_remote_nets)
+        net = self._client.load(focus_name, install_only=install_only)
+        if net is not None:
+            # The weights live in the server, the proxy costs nothing against the budget
+            self._name2net.put(focus_name, net, size=0)
+        return net
+
+    def _drop_remote_nets(self):
+        """The server went away, the next match_net of its models loads them locally"""
+        for focus_name in self._name2net.keys():
+            with suppress(KeyError):
+                if isinstance(self._name2net[focus_name], (RemoteSession, RemoteNet)):
+                    self._name2net.evict(focus_name)
+        client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+    @property
+    def quantize_policy(self) -> QuantizePolicy:
+        if self._quantize_policy is None:
+            self._quantize_policy = QuantizePolicy.from_path(
+                self.quantized_dir.joinpath("policy.json")
+            )
+        return self._quantize_policy
+
+    def get_quantized_variant(self, focus_name: str) -> QuantizedVariant | None:
+        """The approved variant built from the current release of the model, if any"""
+        if not self.use_quantized:
+            return
+        variant = self.quantize_policy.select(focus_name, self._get_node_id(focus_name))
+        if variant and self.quantized_dir.joinpath(variant.name).exists():
+            return variant
+
+    def quantize(
+        self,
+        focus_name: str,
+        mode: QuantizeMode = "dynamic",
+        *,
+        calibration: Iterable[Dict[str, np.ndarray]] | None = None,
+    ) -> Path:
+        """Build (or reuse) the quantized variant of a downloaded model"""
+        model_path = self.models_dir.joinpath(focus_name)
+        variant_path = self.quantized_dir.joinpath(variant_name(focus_name, mode))
+        if (
+            variant_path.exists()
+            and variant_path.stat().st_size
+            and variant_path.stat().st_mtime >= model_path.stat().st_mtime
+        ):
+            return variant_path
+        return quantize_model(model_path, variant_path, mode, calibration=calibration)
+
+    def check_quantized(
+        self,
+        focus_name: str,
+        mode: QuantizeMode,
+        samples: List[Any],
+        predict: Callable[[Net | InferenceSession, Any], Any],
+        *,
+        compare: Callable[[Any, Any], bool] | None = None,
+        threshold: float = DEFAULT_AGREEMENT_THRESHOLD,
+        calibration: Iterable[Dict[str, np.ndarray]] | None = None,
+    ) -> QuantizedVariant:
+        """
+        Offline accuracy gate.
+        Run the FP32 model and its variant over `samples` and record the agreement
+        in `quantize_policy`, the variant is served from then on only if it stays above `threshold`.
+
+        :param predict: `predict(net, sample)` the answer a challenge would submit
+        """
+        variant_path = self.quantize(focus_name, mode, calibration=calibration)
+        variant = QuantizedVariant(
+            focus_name=focus_name,
+            mode=mode,
+            node_id=self._get_node_id(focus_name),
+            threshold=threshold,
+            samples=len(samples),
+        )
 
-        for m in [self.DEFAULT_CLIP_TEXTUAL_MODEL, self.DEFAULT_CLIP_VISUAL_MODEL]:
-            if m in self._name2net:
-                del self._name2net[m]
-                gc.collect()
+        reference = self._load_net(focus_name, self.models_dir.joinpath(focus_name))
+        try:
+            candidate = self._load_net(focus_name, variant_path)
+        except Exception as err:
+            logger.warning("Quantized model cannot be served", name=variant.name, err=err)
+        else:
+            variant.agreement = measure_agreement(
+                lambda sample: predict(reference, sample),
+                lambda sample: predict(candidate, sample),
+                samples,
+                compare=compare,
+            )
+
+        self.quantize_policy.record(variant)
+        if focus_name in self._name2net and focus_name not in self._name2net.pinned:
+            del self._name2net[focus_name]
+
+        logger.debug(
+            "Quantized model checked",
+            name=variant.name,
+            agreement=f"{variant.agreement:.4f}",
+            threshold=threshold,
+            approved=variant.approved,
+        )
+        return variant
+
+    def unplug(self, *, force: bool = False):
+        """
+        Release sessions after a challenge.
+
+        By default only the least recently (or frequently) used sessions are dropped
+        until the pool fits `pool_budget` again, so the next challenge does not reload
+        the same models from disk. `force=True` drops every unpinned session.
+        """
+        self._name2net.trim(budget=-1 if force else None)
+
+    def enumerate_models(
+        self,
+        kinds: Iterable[Literal["resnet", "yolo", "clip"]] = ("resnet", "yolo", "clip"),
+        *,
+        downloaded_only: bool = False,
+    ) -> List[str]:
+        """
+        Every model objects.yaml can route a challenge to, call `parse_objects` first.
+
+        :param kinds: resnet (label_alias, nested_categories), yolo (ashes_of_war, circle_seg),
+            clip (DEFAULT_CLIP_VISUAL_MODEL, DEFAULT_CLIP_TEXTUAL_MODEL)
+        :param downloaded_only: skip models that are not in models_dir yet
+        """
+        focus_names = []
+        if "resnet" in kinds:
+            focus_names += [f"{model_name}.onnx" for model_name in self.label_alias.values()]
+            focus_names += [m for models in self.nested_categories.values() for m in models]
+        if "yolo" in kinds:
+            focus_names += list(self.ashes_of_war)
+            if isinstance(self.circle_segment_model, str):
+                focus_names.append(self.circle_segment_model)
+        if "clip" in kinds:
+            focus_names += [self.DEFAULT_CLIP_VISUAL_MODEL, self.DEFAULT_CLIP_TEXTUAL_MODEL]
+
+        focus_names = list(dict.fromkeys(focus_names))
+        if downloaded_only:
+            focus_names = [m for m in focus_names if self.models_dir.joinpath(m).exists()]
+        return focus_names
+
+    def preload(
+        self, focus_names: Iterable[str] | None = None, *, warmup: bool = True, pin: bool = True
+    ) -> List[str]:
+        """
+        Load models ahead of the first challenge.
+
+        :param focus_names: defaults to every downloaded model of `enumerate_models`
+        :param warmup: run one inference so that lazily allocated buffers exist
+        :param pin: keep them resident regardless of `pool_budget`
+        :return: the models that are now resident
+        """
+        if focus_names is None:
+            focus_names = self.enumerate_models(downloaded_only=True)
+
+        resident = []
+        for focus_name in focus_names:
+            net = self.match_net(focus_name)
+            if net is None:
+                continue
+            if pin:
+                self.pin(focus_name)
+            if warmup:
+                try:
+                    warmup_net(net)
+                except Exception as err:
+                    logger.warning("Failed to warm up model", focus_name=focus_name, err=err)
+            resident.append(focus_name)
+        return resident
+
+    def pin(self, focus_name: str):
+        """Keep a hot model resident regardless of the pool budget, until as many `unpin`"""
+        self._name2net.pin(focus_name)
+
+    def unpin(self, focus_name: str):
+        self._name2net.unpin(focus_name)
+
+    @property
+    def pool_stats(self) -> PoolStats:
+        """Hits, misses and evictions of the session pool"""
+        return self._name2net.stats
+
+    @property
+    def verdicts(self) -> VerdictCache | None:
+        """The verdict cache at `verdict_cache_path`, None if it is not configured"""
+        if self._verdicts is None and self.verdict_cache_path:
+            self._verdicts = VerdictCache(self.verdict_cache_path)
+        return self._verdicts
+
+    @property
+    def verdict_stats(self) -> VerdictStats | None:
+        """Hits, misses, writes and evictions of the verdict cache in this process"""
+        if self._verdicts is not None:
+            return self._verdicts.stats
+
+    def lookup_name(self, net: Any) -> str | None:
+        """The focus_name a resident model was loaded for"""
+        for focus_name in self._name2net.keys():
+            with suppress(KeyError):
+                if self._name2net[focus_name] is net:
+                    return focus_name
+
+    def model_version(self, focus_name: str) -> str:
+        """
+        Identity of the weights that answer for `focus_name`,
+        a new release or another approved quantized variant changes it.
+        Models without a release node_id are versioned by their file, see `file_identity`.
+        """
+        version = self._get_node_id(focus_name)
+        if not version:
+            model_path = self.models_dir.joinpath(focus_name)
+            version = f"local-{file_identity(model_path)}" if model_path.exists() else "local"
+        if variant := self.get_quantized_variant(focus_name):
+            version = f"{version}.{variant.mode}"
+        return version
+
+    @property
+    def router(self) -> AshRouter:
+        """Routing rules compiled from `ashes_of_war` and `clip_candidates`"""
+        router = self._router
+        if (
+            router is None
+            or router.ashes_of_war is not self.ashes_of_war
+            or router.clip_candidates is not self.clip_candidates
+        ):
+            router = AshRouter.from_objects(
+                self.ashes_of_war, self.clip_candidates, default_model=DEFAULT_KEYPOINT_MODEL
+            )
+            self._router = router
+        return router
 
     def apply_ash_of_war(self, ash: str) -> Tuple[str, List[str]]:
-        # Prelude - pending DensePose
-        if "head of " in ash and "animal" in ash:
-            for model_name, covered_class in self.ashes_of_war.items():
-                if "head" not in model_name:
-                    continue
-                for class_name in covered_class:
-                    if class_name.replace("-head", "") in ash:
-                        return model_name, covered_class
-
-        # Prelude - Ordered dictionary
-        for model_name, covered_class in self.ashes_of_war.items():
-            for class_name in covered_class:
-                if class_name in ash:
-                    return model_name, covered_class
-
-        # catch-all rules
-        return DEFAULT_KEYPOINT_MODEL, self.ashes_of_war[DEFAULT_KEYPOINT_MODEL]
+        return self.router.apply(ash)
 
     def lookup_ash_of_war(self, ash: str):  # fixme
         """catch-all default cases"""
-        if "can be eaten" in ash:
-            for model_name, covered_class in self.ashes_of_war.items():
-                if "can_be_eaten" in model_name:
-                    yield model_name, covered_class
-
-        if "not an animal" in ash:
-            for model_name, covered_class in self.ashes_of_war.items():
-                if "notanimal" in model_name:
-                    yield model_name, covered_class
-
-        if "head of " in ash and "animal" in ash:
-            for model_name, covered_class in self.ashes_of_war.items():
-                if "head" in model_name:
-                    yield model_name, covered_class
-
-        if "animal" in ash and "not belong to the sea" in ash:
-            for model_name, covered_class in self.ashes_of_war.items():
-                if (
-                    "notseaanimal" in model_name
-                    or "fantasia_elephant" in model_name
-                    or "fantasia_cat" in model_name
-                ):
-                    yield model_name, covered_class
-
-        for model_name, covered_class in self.ashes_of_war.items():
-            binder = model_name.split("_")
-            if len(binder) > 2 and binder[-2].isdigit():
-                binder = " ".join(model_name.split("_")[:-2])
-                if binder in ash:
-                    yield model_name, covered_class
-            else:
-                for class_name in covered_class:
-                    if class_name in ash:
-                        yield model_name, covered_class
+        yield from self.router.lookup(ash)
 
 
 @dataclass
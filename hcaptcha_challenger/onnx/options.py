@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/3 11:42
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: onnxruntime session options
+from __future__ import annotations
+
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Literal
+
+import onnxruntime
+from loguru import logger
+from onnxruntime import InferenceSession, SessionOptions, GraphOptimizationLevel, ExecutionMode
+
+_GRAPH_OPTIMIZATION_LEVEL = {
+    "disable": GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_EXECUTION_MODE = {
+    "sequential": ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ExecutionMode.ORT_PARALLEL,
+}
+
+
+def file_identity(path: Path | str) -> str:
+    """A short digest of the size and mtime of a file, it changes when the file is replaced"""
+    stat = os.stat(path)
+    return hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf8")).hexdigest()[:8]
+
+
+@dataclass
+class SessionProfile:
+    """
+    How ModelHub builds an onnxruntime.InferenceSession.
+
+    A profile can be set globally (`ModelHub.session_profile`)
+    or per model (`ModelHub.session_profiles[model_name.onnx]`).
+    """
+
+    intra_op_num_threads: int = 0
+    """
+    0 lets onnxruntime pick the number of physical cores
+    """
+
+    inter_op_num_threads: int = 0
+
+    graph_optimization_level: Literal["disable", "basic", "extended", "all"] = "all"
+
+    execution_mode: Literal["sequential", "parallel"] = "sequential"
+
+    enable_cpu_mem_arena: bool = True
+
+    enable_mem_pattern: bool = True
+
+    providers: List[str] | None = None
+    """
+    Defaults to onnxruntime.get_available_providers()
+    """
+
+    cache_optimized_graph: bool = True
+    """
+    Serialize the optimized graph in ORT format on the first load,
+    later loads read it back and skip graph optimization.
+    The cache is specific to the host it was built on.
+    """
+
+    def get_providers(self) -> List[str]:
+        return self.providers or onnxruntime.get_available_providers()
+
+    def to_session_options(self) -> SessionOptions:
+        options = SessionOptions()
+        options.intra_op_num_threads = self.intra_op_num_threads
+        options.inter_op_num_threads = self.inter_op_num_threads
+        options.graph_optimization_level = _GRAPH_OPTIMIZATION_LEVEL[self.graph_optimization_level]
+        options.execution_mode = _EXECUTION_MODE[self.execution_mode]
+        options.enable_cpu_mem_arena = self.enable_cpu_mem_arena
+        options.enable_mem_pattern = self.enable_mem_pattern
+        return options
+
+    def cache_name(self, focus_name: str, node_id: str, model_path: Path | None = None) -> str:
+        """
+        The optimized graph depends on the model version, the onnxruntime build,
+        the optimization level and the execution providers.
+
+        Models without a release node_id are versioned by the identity of `model_path`,
+        a local model replaced under the same name is optimized again.
+        """
+        fingerprint = "|".join(
+            [onnxruntime.__version__, self.graph_optimization_level, *self.get_providers()]
+        )
+        digest = hashlib.sha1(fingerprint.encode("utf8")).hexdigest()[:8]
+        if not node_id:
+            node_id = f"local-{file_identity(model_path)}" if model_path else "local"
+        return f"{focus_name}.{node_id}.{digest}.ort"
+
+    def create_session(
+        self, model_path: Path | str, *, cache_path: Path | None = None
+    ) -> InferenceSession:
+        providers = self.get_providers()
+
+        if not self.cache_optimized_graph or cache_path is None:
+            options = self.to_session_options()
+            return InferenceSession(str(model_path), options, providers=providers)
+
+        if cache_path.exists() and cache_path.stat().st_size:
+            options = self.to_session_options()
+            options.graph_optimization_level = GraphOptimizationLevel.ORT_DISABLE_ALL
+            try:
+                return InferenceSession(str(cache_path), options, providers=providers)
+            except Exception as err:
+                logger.warning("Drop broken optimized graph", path=cache_path, err=err)
+                cache_path.unlink(missing_ok=True)
+
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+
+        options = self.to_session_options()
+        options.optimized_model_filepath = str(tmp_path)
+        options.add_session_config_entry("session.save_model_format", "ORT")
+        try:
+            session = InferenceSession(str(model_path), options, providers=providers)
+        except Exception as err:
+            # e.g. graphs over 2GB cannot be serialized in ORT format
+            logger.warning("Failed to cache optimized graph", path=model_path, err=err)
+            tmp_path.unlink(missing_ok=True)
+            options = self.to_session_options()
+            return InferenceSession(str(model_path), options, providers=providers)
+
+        if tmp_path.exists():
+            # Older versions of the same model under this profile,
+            # `{focus_name}.{node_id}.{digest}.ort` with the same digest and another node_id.
+            # Graphs of other profiles and providers stay.
+            focus_name, _, digest, _ = cache_path.name.rsplit(".", 3)
+            for stale in cache_path.parent.glob(f"*.{digest}.ort"):
+                if stale != cache_path and stale.name.rsplit(".", 3)[0] == focus_name:
+                    stale.unlink(missing_ok=True)
+            os.replace(tmp_path, cache_path)
+
+        return session
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/2 15:06
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: memory-budgeted session pool
+from __future__ import annotations
+
+import gc
+import os
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Literal, Set
+
+from loguru import logger
+
+DEFAULT_POOL_BUDGET = int(os.environ.get("MODELHUB_POOL_BUDGET_MB", 1536)) * 1024 * 1024
+
+
+@dataclass
+class PoolStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class SessionPool:
+    """
+    Keep loaded models (cv2.dnn.Net / onnxruntime.InferenceSession) resident
+    until the pool exceeds its byte budget.
+
+    The cost of a session is the size of the ONNX file it was loaded from,
+    which tracks the RSS the weights occupy closely enough to budget against.
+    Pinned sessions are never evicted. Pins are counted, a session stays pinned
+    until every `pin` is matched by an `unpin`.
+    """
+
+    def __init__(self, budget: int = DEFAULT_POOL_BUDGET, policy: Literal["lru", "lfu"] = "lru"):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy - {policy=}")
+
+        self.budget = budget
+        self.policy = policy
+        self.stats = PoolStats()
+
+        self._sessions: OrderedDict[str, Any] = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._freqs: Dict[str, int] = {}
+        self._pinned: Counter[str] = Counter()
+        self._lock = threading.RLock()
+
+        self.on_delete: Callable[[str, Any], None] | None = None
+        """Called with the name and the session whenever a session leaves the pool"""
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sessions
+
+    def __getitem__(self, name: str):
+        return self._sessions[name]
+
+    def __setitem__(self, name: str, session: Any):
+        self.put(name, session)
+
+    def __delitem__(self, name: str):
+        with self._lock:
+            session = self._sessions.pop(name)
+            self._sizes.pop(name, None)
+            self._freqs.pop(name, None)
+            if self.on_delete is not None:
+                self.on_delete(name, session)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._sessions))
+
+    def keys(self) -> List[str]:
+        return list(self._sessions)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._sizes.values())
+
+    @property
+    def pinned(self) -> Set[str]:
+        return set(self._pinned)
+
+    def get(self, name: str, default=None):
+        """Look up a session and record a hit or a miss"""
+        with self._lock:
+            session = self._sessions.get(name)
+            if session is None:
+                self.stats.misses += 1
+                return default
+            self.stats.hits += 1
+            self._freqs[name] = self._freqs.get(name, 0) + 1
+            self._sessions.move_to_end(name)
+            return session
+
+    def put(self, name: str, session: Any, size: int = 0):
+        """Register a session, then evict others until the pool fits its budget again"""
+        with self._lock:
+            self._sessions[name] = session
+            self._sessions.move_to_end(name)
+            self._sizes[name] = max(int(size), 0)
+            self._freqs.setdefault(name, 1)
+            self.trim(keep=name)
+
+    def pin(self, name: str):
+        with self._lock:
+            self._pinned[name] += 1
+
+    def unpin(self, name: str):
+        with self._lock:
+            if self._pinned[name] > 1:
+                self._pinned[name] -= 1
+            else:
+                self._pinned.pop(name, None)
+
+    def _victims(self, keep: str = "") -> List[str]:
+        candidates = [n for n in self._sessions if n not in self._pinned and n != keep]
+        if self.policy == "lfu":
+            # Ties are broken by recency, the order of `self._sessions`
+            candidates.sort(key=lambda n: self._freqs.get(n, 0))
+        return candidates
+
+    def evict(self, name: str) -> bool:
+        with self._lock:
+            if name not in self._sessions:
+                return False
+            del self[name]
+            self.stats.evictions += 1
+            logger.debug("evict session", name=name, pool_bytes=self.nbytes)
+            return True
+
+    def trim(self, budget: int | None = None, *, keep: str = "") -> List[str]:
+        """
+        Evict unpinned sessions until the pool fits the budget
+        :param budget: Defaults to the pool budget. Pass -1 to drop every unpinned session.
+        :param keep: Session that must survive this round, usually the one just inserted
+        :return: Names of evicted sessions
+        """
+        budget = self.budget if budget is None else budget
+        evicted = []
+        with self._lock:
+            for name in self._victims(keep):
+                if self.nbytes <= budget:
+                    break
+                self.evict(name)
+                evicted.append(name)
+        if evicted:
+            gc.collect()
+        return evicted
+
+    def clear(self, *, include_pinned: bool = False) -> List[str]:
+        if include_pinned:
+            with self._lock:
+                self._pinned.clear()
+        return self.trim(budget=-1)
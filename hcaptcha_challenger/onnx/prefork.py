@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/10 10:12
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: pre-fork workers that share the model weights copy-on-write
+from __future__ import annotations
+
+import gc
+import os
+import sys
+import traceback
+from dataclasses import replace
+from typing import Any, Callable, Dict, Iterable, List
+
+from loguru import logger
+from onnxruntime import InferenceSession
+
+from hcaptcha_challenger.onnx.backend import OrtNet
+from hcaptcha_challenger.onnx.modelhub import ModelHub
+
+
+def prepare_for_fork(modelhub: ModelHub):
+    """
+    onnxruntime does not survive a fork with its intra-op thread pool,
+    the threads of the parent are gone in the children while the pool still waits for them.
+    Sessions built for pre-fork run single-threaded, the workers provide the parallelism.
+    """
+    modelhub.session_profile = replace(
+        modelhub.session_profile, intra_op_num_threads=1, inter_op_num_threads=1
+    )
+    for focus_name, profile in modelhub.session_profiles.items():
+        modelhub.session_profiles[focus_name] = replace(
+            profile, intra_op_num_threads=1, inter_op_num_threads=1
+        )
+
+    loaded = [
+        name
+        for name in modelhub._name2net
+        if isinstance(modelhub._name2net[name], (InferenceSession, OrtNet))
+    ]
+    if loaded:
+        logger.warning(
+            "Sessions loaded before prepare_for_fork may hang in the workers, unplug them first",
+            loaded=loaded,
+        )
+
+
+def spawn_workers(
+    target: Callable[[ModelHub, int], Any],
+    workers: int,
+    *,
+    modelhub: ModelHub,
+    focus_names: Iterable[str] | None = None,
+    warmup: bool = True,
+) -> List[int]:
+    """
+    Load the models once, then fork `workers` processes that run `target(modelhub, index)`.
+
+    The parent resolves and warms every session before forking and freezes the heap with
+    `gc.freeze()`, so the collector of a worker never writes to the pages holding the
+    parent's objects and the weights stay shared until a worker touches them.
+
+    :param target: runs in each worker, its return value is ignored, an exception exits with 1
+    :param focus_names: defaults to every downloaded model of `ModelHub.enumerate_models`
+    :return: pids of the workers, see `wait_workers`
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("Pre-fork mode requires os.fork, which is not available on this OS")
+
+    prepare_for_fork(modelhub)
+
+    gc.disable()
+    resident = modelhub.preload(focus_names, warmup=warmup, pin=True)
+    logger.debug("Models resident before fork", count=len(resident))
+
+    gc.collect()
+    gc.freeze()
+
+    # Anything buffered now would be written by the parent and every worker
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pids = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            gc.enable()
+            exit_code = 0
+            try:
+                target(modelhub, index)
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        pids.append(pid)
+
+    gc.enable()
+    return pids
+
+
+def wait_workers(pids: Iterable[int]) -> Dict[int, int]:
+    """Block until the workers exit, returns { pid: exit code }"""
+    exit_codes = {}
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        if os.WIFEXITED(status):
+            exit_codes[pid] = os.WEXITSTATUS(status)
+        else:
+            exit_codes[pid] = -os.WTERMSIG(status)
+    return exit_codes
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 10:20
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: reusable NCHW input tensors of the YOLO detectors
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+# The gray ultralytics pads letterboxed images with
+LETTERBOX_PAD = 114
+
+
+@dataclass(frozen=True)
+class Letterbox:
+    """
+    Where an image landed in the model input.
+
+    Without letterboxing the image is stretched over the whole input,
+    i.e. the content is the input and there is no padding.
+    """
+
+    img_height: int
+    img_width: int
+    content_height: int
+    content_width: int
+    pad_top: int = 0
+    pad_left: int = 0
+
+    def unmap(self, boxes: np.ndarray) -> np.ndarray:
+        """Boxes (x, y, w, h) in input pixels -> boxes (x, y, w, h) in image pixels"""
+        if self.pad_top or self.pad_left:
+            boxes = boxes - np.array([self.pad_left, self.pad_top, 0, 0], dtype=boxes.dtype)
+        content_shape = np.array(
+            [self.content_width, self.content_height, self.content_width, self.content_height]
+        )
+        boxes = np.divide(boxes, content_shape, dtype=np.float32)
+        boxes *= np.array([self.img_width, self.img_height, self.img_width, self.img_height])
+        return boxes
+
+    def map(self, boxes: np.ndarray) -> np.ndarray:
+        """Boxes (x1, y1, x2, y2) in image pixels -> boxes (x1, y1, x2, y2) in input pixels"""
+        image_shape = np.array([self.img_width, self.img_height, self.img_width, self.img_height])
+        boxes = np.divide(boxes, image_shape, dtype=np.float32)
+        boxes *= np.array(
+            [self.content_width, self.content_height, self.content_width, self.content_height]
+        )
+        boxes += np.array([self.pad_left, self.pad_top, self.pad_left, self.pad_top])
+        return boxes
+
+
+class InputTensor:
+    """
+    A float32 NCHW buffer the images of a detector are written into.
+
+    `cv2.cvtColor` + `cv2.resize` + `/ 255.0` + `transpose` + `astype(np.float32)`
+    leave four full size temporaries per image, one of them float64.
+    Here an image is resized into a reused uint8 buffer, and each channel is scaled
+    straight into its plane of the tensor, swapping BGR to RGB on the way.
+    The buffer grows to the largest batch seen and is reused afterwards.
+
+    The tensor returned by `fill` is a view of the buffer, it is overwritten by the next call.
+    """
+
+    def __init__(self, height: int, width: int, *, letterbox: bool = False):
+        self.height = height
+        self.width = width
+        self.letterbox = letterbox
+
+        self._tensor = np.empty((0, 3, height, width), dtype=np.float32)
+        self._resized = np.empty((0, 0, 3), dtype=np.uint8)
+
+    def _fit(self, image: np.ndarray) -> Letterbox:
+        img_height, img_width = image.shape[:2]
+        if not self.letterbox:
+            return Letterbox(img_height, img_width, self.height, self.width)
+
+        ratio = min(self.height / img_height, self.width / img_width)
+        content_height = max(1, min(self.height, round(img_height * ratio)))
+        content_width = max(1, min(self.width, round(img_width * ratio)))
+        pad_top = (self.height - content_height) // 2
+        pad_left = (self.width - content_width) // 2
+        return Letterbox(img_height, img_width, content_height, content_width, pad_top, pad_left)
+
+    def _resize(self, image: np.ndarray, letterbox: Letterbox) -> np.ndarray:
+        size = (letterbox.content_height, letterbox.content_width, 3)
+        if self._resized.shape != size:
+            self._resized = np.empty(size, dtype=np.uint8)
+        return cv2.resize(
+            image, (letterbox.content_width, letterbox.content_height), dst=self._resized
+        )
+
+    def write(self, image: np.ndarray, out: np.ndarray) -> Letterbox:
+        """Write a BGR image into `out`, a (3, height, width) plane of the tensor"""
+        letterbox = self._fit(image)
+        resized = self._resize(image, letterbox)
+
+        top, left = letterbox.pad_top, letterbox.pad_left
+        if letterbox.content_height != self.height or letterbox.content_width != self.width:
+            out.fill(np.float32(LETTERBOX_PAD / 255.0))
+        content = out[
+            :, top : top + letterbox.content_height, left : left + letterbox.content_width
+        ]
+        for channel in range(3):
+            np.divide(
+                resized[:, :, 2 - channel],
+                np.float32(255.0),
+                out=content[channel],
+                dtype=np.float32,
+            )
+        return letterbox
+
+    def fill(self, images: List[np.ndarray]) -> Tuple[np.ndarray, List[Letterbox]]:
+        """The (N, 3, height, width) input of N BGR images and where each of them landed"""
+        if len(self._tensor) < len(images):
+            self._tensor = np.empty((len(images), 3, self.height, self.width), dtype=np.float32)
+        tensor = self._tensor[: len(images)]
+        letterboxes = [self.write(image, tensor[i]) for i, image in enumerate(images)]
+        return tensor, letterboxes
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/8 10:36
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: INT8/FP16 model variants and the policy that approves them
+from __future__ import annotations
+
+import json
+import os
+import time
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Literal
+
+import numpy as np
+from loguru import logger
+
+QuantizeMode = Literal["dynamic", "static", "fp16"]
+
+QUANTIZE_MODES = ("dynamic", "static", "fp16")
+
+DEFAULT_AGREEMENT_THRESHOLD = 0.98
+
+
+def variant_name(focus_name: str, mode: QuantizeMode) -> str:
+    """`bee_2309_yolov8n.onnx` -> `bee_2309_yolov8n.dynamic.onnx`"""
+    return f"{Path(focus_name).stem}.{mode}.onnx"
+
+
+def _quantize_dynamic(model_path: Path, output_path: Path):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(str(model_path), str(output_path), weight_type=QuantType.QInt8)
+
+
+def _quantize_static(
+    model_path: Path, output_path: Path, calibration: Iterable[Dict[str, np.ndarray]]
+):
+    from onnxruntime.quantization import (
+        quantize_static,
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+    )
+
+    class FeedsReader(CalibrationDataReader):
+        def __init__(self):
+            self._feeds = iter(calibration)
+
+        def get_next(self):
+            return next(self._feeds, None)
+
+    # QDQ keeps the graph readable by cv2.dnn, which serves the ResNet binaries
+    quantize_static(
+        str(model_path),
+        str(output_path),
+        FeedsReader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+    )
+
+
+def _convert_fp16(model_path: Path, output_path: Path):
+    import onnx
+    from onnxconverter_common import float16
+
+    model = onnx.load(str(model_path))
+    # Inputs and outputs stay float32, the callers keep feeding the same tensors
+    model = float16.convert_float_to_float16(model, keep_io_types=True)
+    onnx.save(model, str(output_path))
+
+
+def quantize_model(
+    model_path: Path,
+    output_path: Path,
+    mode: QuantizeMode = "dynamic",
+    *,
+    calibration: Iterable[Dict[str, np.ndarray]] | None = None,
+) -> Path:
+    """
+    Write a quantized copy of `model_path` to `output_path`.
+
+    Requires the `onnx` package (`pip install hcaptcha-challenger[quantize]`),
+    `fp16` additionally requires `onnxconverter-common`.
+
+    :param mode:
+        - dynamic: INT8 weights, activations quantized at runtime, no calibration needed
+        - static: INT8 weights and activations, calibrated on `calibration`
+        - fp16: half precision weights
+    :param calibration: model feeds `{input_name: tensor}`, required by `static`
+    """
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantize mode {mode!r}, expected one of {QUANTIZE_MODES}")
+    if mode == "static" and calibration is None:
+        raise ValueError("Static quantization requires calibration feeds")
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_name(f"{output_path.stem}.{os.getpid()}.tmp.onnx")
+
+    try:
+        if mode == "dynamic":
+            _quantize_dynamic(model_path, tmp_path)
+        elif mode == "static":
+            _quantize_static(model_path, tmp_path, calibration)
+        else:
+            _convert_fp16(model_path, tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    logger.debug(
+        "Quantized model",
+        mode=mode,
+        src=model_path.name,
+        size=f"{model_path.stat().st_size} -> {output_path.stat().st_size}",
+    )
+    return output_path
+
+
+def measure_agreement(
+    reference: Callable[[Any], Any],
+    candidate: Callable[[Any], Any],
+    samples: Iterable[Any],
+    *,
+    compare: Callable[[Any, Any], bool] | None = None,
+) -> float:
+    """
+    Share of samples on which the quantized model answers like the FP32 model.
+
+    :param reference: FP32 prediction, e.g. `ResNetControl.execute`
+    :param candidate: the same prediction served by the quantized model
+    :param compare: defaults to `==`
+    """
+    compare = compare or (lambda a, b: a == b)
+
+    total = agreed = 0
+    for sample in samples:
+        total += 1
+        agreed += bool(compare(reference(sample), candidate(sample)))
+    return agreed / total if total else 0.0
+
+
+@dataclass
+class QuantizedVariant:
+    focus_name: str
+    mode: QuantizeMode
+    node_id: str = ""
+    """
+    The node_id of the FP32 model the variant was built from,
+    a new release of the model invalidates the variant
+    """
+
+    agreement: float = 0.0
+    threshold: float = DEFAULT_AGREEMENT_THRESHOLD
+    samples: int = 0
+    checked_at: float = 0.0
+
+    @property
+    def approved(self) -> bool:
+        return self.samples > 0 and self.agreement >= self.threshold
+
+    @property
+    def name(self) -> str:
+        return variant_name(self.focus_name, self.mode)
+
+
+@dataclass
+class QuantizePolicy:
+    """
+    Per-model record of the accuracy checks, stored as `policy.json` next to the variants.
+    ModelHub serves a variant only while it is approved and built from the current model.
+    """
+
+    path: Path
+    variants: Dict[str, List[QuantizedVariant]] = field(default_factory=dict)
+    """
+    { model_name.onnx: [QuantizedVariant, ...] }
+    """
+
+    @classmethod
+    def from_path(cls, path: Path) -> QuantizePolicy:
+        policy = cls(path=path)
+        if not path.exists():
+            return policy
+        try:
+            data = json.loads(path.read_text(encoding="utf8"))
+            for focus_name, variants in data.items():
+                policy.variants[focus_name] = [QuantizedVariant(**v) for v in variants]
+        except (ValueError, TypeError) as err:
+            logger.warning("Ignore broken quantize policy", path=path, err=err)
+        return policy
+
+    def dump(self):
+        data = {k: [asdict(v) for v in vs] for k, vs in self.variants.items()}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf8")
+        os.replace(tmp_path, self.path)
+
+    def record(self, variant: QuantizedVariant):
+        variant.checked_at = variant.checked_at or time.time()
+        variants = [v for v in self.variants.get(variant.focus_name, []) if v.mode != variant.mode]
+        variants.append(variant)
+        self.variants[variant.focus_name] = variants
+        self.dump()
+
+    def select(self, focus_name: str, node_id: str = "") -> QuantizedVariant | None:
+        """The approved variant with the best agreement, FP32 if there is none"""
+        candidates = [
+            v for v in self.variants.get(focus_name, []) if v.approved and v.node_id == node_id
+        ]
+        if candidates:
+            return max(candidates, key=lambda v: (v.agreement, -QUANTIZE_MODES.index(v.mode)))
@@ -5,8 +5,12 @@
 # Description:
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Any, Tuple
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, List, Literal, Tuple
 
 import cv2
 import numpy as np
@@ -14,6 +18,21 @@ from cv2.dnn import Net
 from loguru import logger
 from scipy.special import expit
 
+from hcaptcha_challenger.onnx.batching import is_unbatchable, mark_unbatchable
+
+DenoiseStrategy = Literal["nlmeans", "downscale", "bilateral", "median", "none"]
+
+DENOISE_STRATEGIES = ("nlmeans", "downscale", "bilateral", "median", "none")
+
+DENOISE_CACHE_SIZE = 256
+"""
+Watermarked images preprocessed recently, keyed by content.
+rank_models runs every example through several models of the same nested category
+"""
+
+_denoised: OrderedDict[Tuple[str, bytes], np.ndarray] = OrderedDict()
+_denoised_lock = threading.Lock()
+
 
 class ChallengeStyle:
     WATERMARK = 144  # onTrigger 128x128
@@ -21,22 +40,101 @@ class ChallengeStyle:
     GAN = 144
 
 
+def default_denoise_strategy() -> DenoiseStrategy:
+    return os.getenv("RESNET_DENOISE_STRATEGY", "nlmeans")
+
+
+def denoise(img: np.ndarray, strategy: DenoiseStrategy = "nlmeans") -> np.ndarray:
+    """
+    Remove the watermark noise of a challenge image and shrink it to the 64x64 input.
+
+    - nlmeans: non-local means on the full image, the reference the models were trained on
+    - downscale: non-local means after shrinking to 64x64, about 5x less pixels to search
+    - bilateral: edge-preserving bilateral filter on the full image
+    - median: 5x5 median filter on the full image
+    - none: shrink only
+    """
+    if strategy == "nlmeans":
+        img = cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21)
+    elif strategy == "downscale":
+        img = cv2.resize(img, (64, 64), interpolation=cv2.INTER_AREA)
+        img = cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21)
+    elif strategy == "bilateral":
+        img = cv2.bilateralFilter(img, 9, 75, 75)
+    elif strategy == "median":
+        img = cv2.medianBlur(img, 5)
+    elif strategy != "none":
+        raise ValueError(f"Unknown denoise strategy {strategy!r}, expected {DENOISE_STRATEGIES}")
+    return cv2.resize(img, (64, 64))
+
+
+def _denoise_cached(img_stream: bytes, img: np.ndarray, strategy: DenoiseStrategy) -> np.ndarray:
+    key = (strategy, hashlib.blake2b(img_stream, digest_size=16).digest())
+    with _denoised_lock:
+        if (cached := _denoised.get(key)) is not None:
+            _denoised.move_to_end(key)
+            return cached
+
+    img = denoise(img, strategy)
+    img.flags.writeable = False
+
+    with _denoised_lock:
+        _denoised[key] = img
+        while len(_denoised) > DENOISE_CACHE_SIZE:
+            _denoised.popitem(last=False)
+    return img
+
+
 @dataclass
 class ResNetControl:
     net: Net
 
+    denoise_strategy: DenoiseStrategy = field(default_factory=default_denoise_strategy)
+    """
+    How watermarked (144px) images are cleaned before classification, see `denoise()`.
+    Set `RESNET_DENOISE_STRATEGY` to change the default,
+    `automation/denoise_report.py` compares the strategies on the labelled assets
+    """
+
     @classmethod
     def from_pluggable_model(cls, net: Net):
         return cls(net=net)
 
-    def binary_classify(self, img_stream: Any) -> bool | Tuple[bool, np.ndarray]:
+    @property
+    def _batchable(self) -> bool:
+        """
+        Whether the net accepts more than one image per forward pass,
+        cleared the first time a batch is rejected, see `ModelHub.batch_resnet`.
+        Kept per net, the controls built around it for later challenges skip the probe
+        """
+        return not is_unbatchable(self.net)
+
+    @staticmethod
+    def preprocess(img_stream: Any, strategy: DenoiseStrategy | None = None) -> np.ndarray | None:
+        """Decode and resize a challenge image, None if it cannot be decoded"""
+        strategy = strategy or default_denoise_strategy()
         img_arr = np.frombuffer(img_stream, np.uint8)
-        img = cv2.imdecode(img_arr, flags=1)
+        if not img_arr.size or (img := cv2.imdecode(img_arr, flags=1)) is None:
+            return
 
         if img.shape[0] == ChallengeStyle.WATERMARK:
-            img = cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21)
+            return _denoise_cached(bytes(img_stream), img, strategy)
+
+        return cv2.resize(img, (64, 64))
+
+    @staticmethod
+    def _verdict(logit: np.ndarray) -> Tuple[bool, np.ndarray]:
+        return not np.argmax(logit), expit(logit)
 
-        img = cv2.resize(img, (64, 64))
+    def _forward(self, images: List[np.ndarray]) -> np.ndarray:
+        blob = cv2.dnn.blobFromImages(
+            images, 1 / 255.0, (64, 64), (0, 0, 0), swapRB=True, crop=False
+        )
+        self.net.setInput(blob)
+        return self.net.forward()
+
+    def binary_classify(self, img_stream: Any) -> bool | Tuple[bool, np.ndarray]:
+        img = self.preprocess(img_stream, self.denoise_strategy)
         blob = cv2.dnn.blobFromImage(img, 1 / 255.0, (64, 64), (0, 0, 0), swapRB=True, crop=False)
 
         # Use the delayed reflection mechanism
@@ -46,11 +144,24 @@ class ResNetControl:
             return False
         self.net.setInput(blob)
         out = self.net.forward()
-        logit = out[0]
-        proba = expit(logit)
-        if not np.argmax(out, axis=1)[0]:
-            return True, proba
-        return False, proba
+        return self._verdict(out[0])
+
+    def classify_batch(self, images: List[np.ndarray]) -> List[Tuple[bool, np.ndarray]]:
+        """
+        Classify preprocessed images in one forward pass,
+        one pass per image if the net was exported with a fixed batch size
+        """
+        if not images:
+            return []
+        if self._batchable and len(images) > 1:
+            try:
+                out = self._forward(images)
+                if len(out) == len(images):
+                    return [self._verdict(logit) for logit in out]
+            except Exception as err:
+                logger.debug("The net rejects batches, fall back to one image per pass", err=err)
+            mark_unbatchable(self.net)
+        return [self._verdict(self._forward([img])[0]) for img in images]
 
     def execute(self, img_stream: bytes, **kwargs) -> bool | Tuple[bool, np.ndarray]:
         """Implementation process of solution"""
@@ -63,3 +174,28 @@ class ResNetControl:
             if get_proba is True:
                 return prediction, confidence
             return prediction
+
+    def execute_batch(
+        self, img_streams: List[bytes], **kwargs
+    ) -> List[bool | Tuple[bool, np.ndarray] | None]:
+        """
+        Same answers as `[execute(img_stream) for img_stream in img_streams]`
+        from a single forward pass, None for the images that cannot be decoded.
+        """
+        get_proba = kwargs.get("proba", False)
+        if self.net is None:
+            logger.debug("The remote network does not exist or the local cache has expired.")
+            return [False] * len(img_streams)
+
+        images = [self.preprocess(img_stream, self.denoise_strategy) for img_stream in img_streams]
+        decoded = [img for img in images if img is not None]
+        verdicts = iter(self.classify_batch(decoded))
+
+        results = []
+        for img in images:
+            if img is None:
+                results.append(None)
+                continue
+            prediction, confidence = next(verdicts)
+            results.append((prediction, confidence) if get_proba is True else prediction)
+        return results
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/6 21:14
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: prompt-to-model routing
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Set, Tuple
+
+# Fixed keywords of the catch-all rules in `AshRouter.lookup`
+CAN_BE_EATEN = "can be eaten"
+NOT_AN_ANIMAL = "not an animal"
+HEAD_OF = "head of "
+ANIMAL = "animal"
+NOT_BELONG_TO_THE_SEA = "not belong to the sea"
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton.
+
+    One pass over the text reports every registered pattern that occurs in it as a substring,
+    i.e. the same answer as `pattern in text` for each pattern.
+    """
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        self._patterns: Dict[str, int] = {}
+        self._empty: List[int] = []
+
+    def add(self, pattern: str) -> int:
+        """Register a pattern and return its id, registering a pattern twice returns the same id"""
+        if pattern in self._patterns:
+            return self._patterns[pattern]
+
+        pid = len(self._patterns)
+        self._patterns[pattern] = pid
+
+        # The empty string is a substring of everything
+        if not pattern:
+            self._empty.append(pid)
+            return pid
+
+        state = 0
+        for char in pattern:
+            if char not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][char] = len(self._goto) - 1
+            state = self._goto[state][char]
+        self._out[state].append(pid)
+        return pid
+
+    def build(self):
+        """Compute failure links, call it after the last `add`"""
+        queue = deque()
+        for nxt in self._goto[0].values():
+            self._fail[nxt] = 0
+            queue.append(nxt)
+
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+        return self
+
+    def search(self, text: str) -> Set[int]:
+        goto, fail, out = self._goto, self._fail, self._out
+
+        matched = set(self._empty)
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                matched.update(out[state])
+        return matched
+
+
+@dataclass
+class AshRouter:
+    """
+    Routing rules of `ashes_of_war` and `clip_candidates` compiled into one automaton
+    and a few lookup tables, built once per `ModelHub.parse_objects`.
+    """
+
+    ashes_of_war: Dict[str, List[str]] = field(default_factory=dict)
+    clip_candidates: Dict[str, List[str]] = field(default_factory=dict)
+    default_model: str = ""
+
+    _automaton: Automaton = field(default_factory=Automaton)
+    _models: List[str] = field(default_factory=list)
+    _keywords: Dict[str, int] = field(default_factory=dict)
+
+    # pattern_id -> index of the first model that covers it
+    _apply_head: Dict[int, int] = field(default_factory=dict)
+    _apply: Dict[int, int] = field(default_factory=dict)
+
+    # pattern_id -> (model_index, class_index) positions in `ashes_of_war`
+    _lookup: Dict[int, List[Tuple[int, int]]] = field(default_factory=dict)
+    _lookup_rules: Dict[str, List[int]] = field(default_factory=dict)
+
+    # pattern_ids that satisfy `is_matched_ash_of_war` for some class
+    _matched_head: Set[int] = field(default_factory=set)
+    _matched: Set[int] = field(default_factory=set)
+
+    # pattern_id -> position of the key in `clip_candidates`
+    _clip: Dict[int, int] = field(default_factory=dict)
+    _clip_keys: List[str] = field(default_factory=list)
+
+    @classmethod
+    def from_objects(
+        cls,
+        ashes_of_war: Dict[str, List[str]],
+        clip_candidates: Dict[str, List[str]] | None = None,
+        default_model: str = "",
+    ):
+        router = cls(
+            ashes_of_war=ashes_of_war,
+            clip_candidates=clip_candidates or {},
+            default_model=default_model,
+        )
+        router._compile()
+        return router
+
+    def _compile(self):
+        automaton = self._automaton
+        self._models = list(self.ashes_of_war)
+
+        for keyword in [CAN_BE_EATEN, NOT_AN_ANIMAL, HEAD_OF, ANIMAL, NOT_BELONG_TO_THE_SEA]:
+            self._keywords[keyword] = automaton.add(keyword)
+
+        self._lookup_rules = {
+            CAN_BE_EATEN: [],
+            NOT_AN_ANIMAL: [],
+            HEAD_OF: [],
+            NOT_BELONG_TO_THE_SEA: [],
+        }
+
+        for i, (model_name, covered_class) in enumerate(self.ashes_of_war.items()):
+            if "can_be_eaten" in model_name:
+                self._lookup_rules[CAN_BE_EATEN].append(i)
+            if "notanimal" in model_name:
+                self._lookup_rules[NOT_AN_ANIMAL].append(i)
+            if "head" in model_name:
+                self._lookup_rules[HEAD_OF].append(i)
+            if (
+                "notseaanimal" in model_name
+                or "fantasia_elephant" in model_name
+                or "fantasia_cat" in model_name
+            ):
+                self._lookup_rules[NOT_BELONG_TO_THE_SEA].append(i)
+
+            for class_name in covered_class:
+                pid = automaton.add(class_name)
+                self._apply.setdefault(pid, i)
+                self._matched.add(pid)
+                if "head" in model_name:
+                    pid = automaton.add(class_name.replace("-head", ""))
+                    self._apply_head.setdefault(pid, i)
+                if "head" in class_name:
+                    pid = automaton.add(class_name.replace("-head", "").strip())
+                    self._matched_head.add(pid)
+
+            binder = model_name.split("_")
+            if len(binder) > 2 and binder[-2].isdigit():
+                pid = automaton.add(" ".join(binder[:-2]))
+                self._lookup.setdefault(pid, []).append((i, 0))
+            else:
+                for j, class_name in enumerate(covered_class):
+                    pid = automaton.add(class_name)
+                    self._lookup.setdefault(pid, []).append((i, j))
+
+        self._clip_keys = list(self.clip_candidates)
+        for i, ket in enumerate(self._clip_keys):
+            candidates = self.clip_candidates[ket]
+            if candidates and len(candidates) > 2:
+                self._clip[automaton.add(ket)] = i
+
+        automaton.build()
+
+    def _has(self, matched: Set[int], keyword: str) -> bool:
+        return self._keywords[keyword] in matched
+
+    def _item(self, index: int) -> Tuple[str, List[str]]:
+        model_name = self._models[index]
+        return model_name, self.ashes_of_war[model_name]
+
+    def apply(self, ash: str) -> Tuple[str, List[str]]:
+        """Same result as the nested loops of `ModelHub.apply_ash_of_war`"""
+        matched = self._automaton.search(ash)
+
+        # Prelude - pending DensePose
+        if self._has(matched, HEAD_OF) and self._has(matched, ANIMAL):
+            hits = [self._apply_head[pid] for pid in matched if pid in self._apply_head]
+            if hits:
+                return self._item(min(hits))
+
+        # Prelude - Ordered dictionary
+        hits = [self._apply[pid] for pid in matched if pid in self._apply]
+        if hits:
+            return self._item(min(hits))
+
+        # catch-all rules
+        return self.default_model, self.ashes_of_war[self.default_model]
+
+    def lookup(self, ash: str) -> List[Tuple[str, List[str]]]:
+        """Same sequence as the generator `ModelHub.lookup_ash_of_war` yields"""
+        matched = self._automaton.search(ash)
+
+        indices = []
+        if self._has(matched, CAN_BE_EATEN):
+            indices.extend(self._lookup_rules[CAN_BE_EATEN])
+        if self._has(matched, NOT_AN_ANIMAL):
+            indices.extend(self._lookup_rules[NOT_AN_ANIMAL])
+        if self._has(matched, HEAD_OF) and self._has(matched, ANIMAL):
+            indices.extend(self._lookup_rules[HEAD_OF])
+        if self._has(matched, ANIMAL) and self._has(matched, NOT_BELONG_TO_THE_SEA):
+            indices.extend(self._lookup_rules[NOT_BELONG_TO_THE_SEA])
+
+        positions = sorted(p for pid in matched for p in self._lookup.get(pid, []))
+        indices.extend(i for i, _ in positions)
+
+        return [self._item(i) for i in indices]
+
+    def is_matched(self, ash: str) -> bool:
+        """Same result as `any(is_matched_ash_of_war(ash, c) for c in ModelHub.yolo_names)`"""
+        matched = self._automaton.search(ash)
+        if self._has(matched, HEAD_OF):
+            return not self._matched_head.isdisjoint(matched)
+        return not self._matched.isdisjoint(matched)
+
+    def match_clip_candidates(self, label: str) -> str | None:
+        """The last key of `clip_candidates` found in the label with more than two candidates"""
+        matched = self._automaton.search(label)
+        hits = [self._clip[pid] for pid in matched if pid in self._clip]
+        if hits:
+            return self._clip_keys[max(hits)]
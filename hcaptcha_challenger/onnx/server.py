@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/9 11:05
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: share one set of sessions between the agents of a host
+"""
+A local inference server that holds the models of one ModelHub,
+and the proxies that let the agents of the same host use them.
+
+    python -m hcaptcha_challenger.onnx.server --socket /tmp/modelhub.sock
+    MODELHUB_SERVER=/tmp/modelhub.sock python my_agent.py
+
+Control messages are length-prefixed JSON over a Unix socket,
+tensors travel through one shared memory segment per connection and direction.
+`RemoteSession` and `RemoteNet` mimic the parts of `onnxruntime.InferenceSession`
+and `cv2.dnn.Net` used by YOLOv8, YOLOv8Seg, MossCLIP and ResNetControl,
+so those run unchanged on top of `ModelHub.match_net`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import weakref
+from dataclasses import dataclass
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Set, Tuple, TYPE_CHECKING
+
+import numpy as np
+from loguru import logger
+
+if TYPE_CHECKING:
+    from hcaptcha_challenger.onnx.modelhub import ModelHub
+
+DEFAULT_SOCKET_PATH = Path(tempfile.gettempdir()).joinpath("hcaptcha-challenger-modelhub.sock")
+
+_HEADER = struct.Struct("!I")
+_ALIGNMENT = 64
+
+
+class ModelServerError(RuntimeError):
+    """The server failed to serve a request"""
+
+
+class ModelServerUnavailable(ModelServerError):
+    """The server cannot be reached or went away"""
+
+
+def _send(sock: socket.socket, message: dict):
+    data = json.dumps(message).encode("utf8")
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes | None:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    while view:
+        n = sock.recv_into(view)
+        if not n:
+            return
+        view = view[n:]
+    return bytes(buffer)
+
+
+def _recv(sock: socket.socket) -> dict | None:
+    head = _recv_exactly(sock, _HEADER.size)
+    if head is None:
+        return
+    data = _recv_exactly(sock, _HEADER.unpack(head)[0])
+    if data is None:
+        return
+    return json.loads(data)
+
+
+# Segments created by the outboxes of this process
+_created: Set[str] = set()
+
+
+def _attach(name: str) -> SharedMemory:
+    """Map a segment created by the peer without taking over its lifetime"""
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers every attached segment with the resource tracker,
+        # which would unlink the peer's segment when this process exits.
+        # A peer in the same process (server thread) shares the registration of the owner
+        shm = SharedMemory(name=name)
+        if shm._name not in _created:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class _Outbox:
+    """The shared memory segment one side of a connection writes its tensors to"""
+
+    def __init__(self):
+        self._shm: SharedMemory | None = None
+
+    def write(self, tensors: Dict[str, np.ndarray]) -> dict:
+        layout, offset = [], 0
+        arrays = {}
+        for name, tensor in tensors.items():
+            array = np.ascontiguousarray(tensor)
+            arrays[name] = array
+            layout.append(
+                {
+                    "name": name,
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape),
+                    "offset": offset,
+                }
+            )
+            offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+
+        if not layout:
+            return {"shm": "", "tensors": []}
+
+        if self._shm is None or self._shm.size < offset:
+            size = max(offset, 2 * self._shm.size if self._shm else 0)
+            self.close()
+            self._shm = SharedMemory(create=True, size=size)
+            _created.add(self._shm._name)
+
+        for item in layout:
+            array = arrays[item["name"]]
+            target = np.ndarray(array.shape, array.dtype, self._shm.buf, item["offset"])
+            target[...] = array
+        return {"shm": self._shm.name, "tensors": layout}
+
+    def close(self):
+        if self._shm is not None:
+            _created.discard(self._shm._name)
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+class _Inbox:
+    """Read side of the peer's outbox"""
+
+    def __init__(self):
+        self._shm: SharedMemory | None = None
+
+    def read(self, payload: dict | None, *, copy: bool) -> Dict[str, np.ndarray]:
+        if not payload or not payload["tensors"]:
+            return {}
+        if self._shm is None or self._shm.name.lstrip("/") != payload["shm"].lstrip("/"):
+            # The peer outgrew its previous segment
+            self.close()
+            self._shm = _attach(payload["shm"])
+
+        tensors = {}
+        for item in payload["tensors"]:
+            array = np.ndarray(
+                item["shape"], np.dtype(item["dtype"]), self._shm.buf, item["offset"]
+            )
+            tensors[item["name"]] = array.copy() if copy else array
+        return tensors
+
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+
+@dataclass
+class NodeArg:
+    """What `InferenceSession.get_inputs()` and `get_outputs()` describe"""
+
+    name: str
+    shape: List[int | str | None]
+    type: str
+
+
+def _describe(node_arg) -> dict:
+    return {"name": node_arg.name, "shape": node_arg.shape, "type": node_arg.type}
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    server: ModelServer
+
+    def handle(self):
+        inbox, outbox = _Inbox(), _Outbox()
+        try:
+            while (request := _recv(self.request)) is not None:
+                _send(self.request, self._serve(request, inbox, outbox))
+        except OSError as err:
+            logger.debug("Client disconnected", err=err)
+        finally:
+            inbox.close()
+            outbox.close()
+
+    def _serve(self, request: dict, inbox: _Inbox, outbox: _Outbox) -> dict:
+        try:
+            # The inputs are views into the client segment, they must not outlive the request
+            tensors = inbox.read(request.get("payload"), copy=False)
+            reply, outputs = self.server.dispatch(request, tensors)
+            reply["payload"] = outbox.write(outputs)
+            return reply
+        except Exception as err:
+            logger.exception(err)
+            return {"error": f"{type(err).__name__}: {err}"}
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serve the sessions of one ModelHub to every agent on the host"""
+
+    daemon_threads = True
+
+    def __init__(self, modelhub: ModelHub, socket_path: Path | str = DEFAULT_SOCKET_PATH):
+        self.modelhub = modelhub
+        self.socket_path = Path(socket_path)
+        self.socket_path.unlink(missing_ok=True)
+        self._net_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        super().__init__(str(self.socket_path), _ConnectionHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.socket_path.unlink(missing_ok=True)
+
+    def _net_lock(self, focus_name: str) -> threading.Lock:
+        # cv2.dnn.Net keeps its input between setInput() and forward()
+        with self._lock:
+            return self._net_locks.setdefault(focus_name, threading.Lock())
+
+    def _match_net(self, focus_name: str):
+        net = self.modelhub.match_net(focus_name)
+        if net is None:
+            raise ModelServerError(f"Model is not available - {focus_name=}")
+        return net
+
+    def dispatch(
+        self, request: dict, tensors: Dict[str, np.ndarray]
+    ) -> Tuple[dict, Dict[str, np.ndarray]]:
+        from onnxruntime import InferenceSession
+
+        op = request.get("op")
+        focus_name = request.get("model", "")
+
+        if op == "ping":
+            return {"models": list(self.modelhub._name2net.keys())}, {}
+
+        if op == "load":
+            install_only = request.get("install_only", False)
+            net = self.modelhub.match_net(focus_name, install_only=install_only)
+            if net is None:
+                return {"kind": None}, {}
+            if isinstance(net, InferenceSession):
+                return {
+                    "kind": "session",
+                    "inputs": [_describe(a) for a in net.get_inputs()],
+                    "outputs": [_describe(a) for a in net.get_outputs()],
+                }, {}
+            return {"kind": "net"}, {}
+
+        if op == "run":
+            session = self._match_net(focus_name)
+            outputs = session.run(request.get("output_names"), tensors)
+            return {}, {str(i): output for i, output in enumerate(outputs)}
+
+        if op == "forward":
+            net = self._match_net(focus_name)
+            with self._net_lock(focus_name):
+                net.setInput(tensors["blob"])
+                output = net.forward()
+            return {}, {"0": output}
+
+        raise ModelServerError(f"Unknown operation - {op=}")
+
+
+class _Connection:
+    def __init__(self, socket_path: str):
+        self.pid = os.getpid()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.inbox, self.outbox = _Inbox(), _Outbox()
+
+    def close(self):
+        with_pid = self.pid == os.getpid()
+        self.sock.close()
+        self.inbox.close()
+        # A forked child must not unlink the segment its parent still uses
+        if with_pid:
+            self.outbox.close()
+
+
+class ModelClient:
+    """One connection per thread (and per process after a fork) to a ModelServer"""
+
+    def __init__(
+        self,
+        socket_path: Path | str = DEFAULT_SOCKET_PATH,
+        *,
+        on_disconnect: Callable[[], None] | None = None,
+    ):
+        """
+        :param on_disconnect: called once the server cannot be reached,
+            before the call raises ModelServerUnavailable
+        """
+        self.socket_path = str(socket_path)
+        self.on_disconnect = on_disconnect
+        self._local = threading.local()
+        self._connections: List[_Connection] = []
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, ModelClient._close_all, self._connections)
+
+    @staticmethod
+    def _close_all(connections: List[_Connection]):
+        for connection in connections:
+            connection.close()
+        connections.clear()
+
+    def close(self):
+        with self._lock:
+            self._close_all(self._connections)
+        self._local = threading.local()
+
+    def _connection(self) -> _Connection:
+        connection: _Connection | None = getattr(self._local, "connection", None)
+        if connection is None or connection.pid != os.getpid():
+            connection = _Connection(self.socket_path)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def call(
+        self, request: dict, tensors: Dict[str, np.ndarray] | None = None
+    ) -> Tuple[dict, Dict[str, np.ndarray]]:
+        try:
+            connection = self._connection()
+            request["payload"] = connection.outbox.write(tensors or {})
+            _send(connection.sock, request)
+            reply = _recv(connection.sock)
+        except OSError as err:
+            self._disconnected()
+            raise ModelServerUnavailable(f"The model server is unreachable - {err}") from err
+        if reply is None:
+            self._disconnected()
+            raise ModelServerUnavailable("The model server closed the connection")
+        if reply.get("error"):
+            raise ModelServerError(reply["error"])
+        # The server reuses its segment on the next request, hand over copies
+        return reply, connection.inbox.read(reply.get("payload"), copy=True)
+
+    def _disconnected(self):
+        connection: _Connection | None = getattr(self._local, "connection", None)
+        if connection is not None:
+            self._local.connection = None
+            with self._lock:
+                if connection in self._connections:
+                    self._connections.remove(connection)
+            connection.close()
+        if self.on_disconnect is not None:
+            self.on_disconnect()
+
+    def ping(self) -> List[str]:
+        reply, _ = self.call({"op": "ping"})
+        return reply["models"]
+
+    def load(
+        self, focus_name: str, *, install_only: bool = False
+    ) -> RemoteSession | RemoteNet | None:
+        """Counterpart of ModelHub.match_net, the server pulls and loads the model"""
+        reply, _ = self.call({"op": "load", "model": focus_name, "install_only": install_only})
+        if reply["kind"] == "session":
+            return RemoteSession(
+                client=self,
+                focus_name=focus_name,
+                inputs=[NodeArg(**i) for i in reply["inputs"]],
+                outputs=[NodeArg(**o) for o in reply["outputs"]],
+            )
+        if reply["kind"] == "net":
+            return RemoteNet(client=self, focus_name=focus_name)
+
+
+@dataclass
+class RemoteSession:
+    """Stands in for onnxruntime.InferenceSession"""
+
+    client: ModelClient
+    focus_name: str
+    inputs: List[NodeArg]
+    outputs: List[NodeArg]
+
+    def get_inputs(self) -> List[NodeArg]:
+        return self.inputs
+
+    def get_outputs(self) -> List[NodeArg]:
+        return self.outputs
+
+    def run(
+        self, output_names: List[str] | None, input_feed: Dict[str, Any], run_options=None
+    ) -> List[np.ndarray]:
+        request = {"op": "run", "model": self.focus_name, "output_names": output_names}
+        tensors = {name: np.asarray(value) for name, value in input_feed.items()}
+        _, outputs = self.client.call(request, tensors)
+        return [outputs[str(i)] for i in range(len(outputs))]
+
+
+@dataclass
+class RemoteNet:
+    """Stands in for cv2.dnn.Net"""
+
+    client: ModelClient
+    focus_name: str
+
+    def __post_init__(self):
+        self._blob = threading.local()
+
+    def setInput(self, blob: np.ndarray, name: str = "", *args, **kwargs):
+        self._blob.value = blob
+
+    def forward(self, *args, **kwargs) -> np.ndarray:
+        request = {"op": "forward", "model": self.focus_name}
+        _, outputs = self.client.call(request, {"blob": self._blob.value})
+        return outputs["0"]
+
+
+def serve(socket_path: Path | str = DEFAULT_SOCKET_PATH, modelhub: ModelHub | None = None):
+    if modelhub is None:
+        from hcaptcha_challenger.onnx.modelhub import ModelHub
+
+        modelhub = ModelHub.from_github_repo()
+        modelhub.parse_objects()
+    # This process is the one holding the models
+    modelhub.server_address = ""
+
+    with ModelServer(modelhub, socket_path) as server:
+        logger.info("Model server is listening", socket=str(server.socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default=str(DEFAULT_SOCKET_PATH))
+    serve(parser.parse_args().socket)
@@ -6,6 +6,7 @@
 from __future__ import annotations
 
 import os
+from typing import Literal, Tuple
 
 import cv2
 import importlib_metadata
@@ -45,6 +46,11 @@ def is_transformers_available():
 
 is_cuda_pipline_available = is_torch_available() and is_transformers_available()
 
+NMSBackend = Literal["numpy", "cv2"]
+
+# Pairwise IoU elements computed at once by `batched_nms`, bounds its temporaries to a few MiB
+NMS_TILE = 1 << 16
+
 
 def nms(boxes, scores, iou_threshold):
     # Sort by score
@@ -83,6 +89,111 @@ def multiclass_nms(boxes, scores, class_ids, iou_threshold):
     return keep_boxes
 
 
+def batched_nms(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    class_ids: np.ndarray | None,
+    iou_threshold: float,
+    *,
+    backend: NMSBackend = "numpy",
+) -> np.ndarray:
+    """
+    Same indices as `multiclass_nms` (`nms` if class_ids is None), i.e. ordered by class,
+    then by descending score, up to the order of exactly tied scores.
+
+    The candidates are sorted once by (class, score). Within a class, the IoU of a tile of
+    the best surviving boxes against all surviving boxes is computed at once, and the
+    greedy pass only loops over rows that actually overlap something. Suppressed boxes
+    drop out of the next tiles. The IoU is computed exactly as `compute_iou` does,
+    boxes with an undefined IoU (zero area) are suppressed as well.
+
+    backend="cv2" runs `cv2.dnn.NMSBoxesBatched`, which offsets the boxes of each class
+    so that boxes of different classes never overlap and runs one NMS over all of them.
+    It keeps boxes whose IoU equals the threshold, where `nms` drops them.
+
+    :param boxes: (N, 4) x1, y1, x2, y2
+    """
+    if backend not in ("numpy", "cv2"):
+        raise ValueError(f"Unknown NMS backend {backend!r}, expected numpy or cv2")
+    n = len(scores)
+    if not n:
+        return np.empty(0, dtype=np.int64)
+    groups = np.zeros(n, dtype=np.int64) if class_ids is None else np.asarray(class_ids)
+
+    if backend == "cv2":
+        keep = _cv2_nms(boxes, scores, groups, iou_threshold)
+        return keep[np.lexsort((-np.arange(n)[keep], -scores[keep], groups[keep]))]
+
+    # Class ascending, score descending, ties like the reversed argsort of `nms`
+    order = np.lexsort((-np.arange(n), -scores, groups))
+    sorted_boxes = boxes[order]
+    bounds = np.flatnonzero(np.diff(groups[order])) + 1
+
+    keep = [
+        [start] if end - start == 1 else start + _greedy_nms(sorted_boxes[start:end], iou_threshold)
+        for start, end in zip(np.r_[0, bounds], np.r_[bounds, n])
+    ]
+    return order[np.concatenate(keep)]
+
+
+def _greedy_nms(boxes: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """Indices of the boxes kept by a greedy NMS, the boxes are sorted by descending score"""
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    suppressed = np.zeros(len(boxes), dtype=bool)
+
+    start = 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        while (alive := np.flatnonzero(~suppressed[start:]) + start).size:
+            rows = alive[: max(1, NMS_TILE // alive.size)]
+            xmin = np.maximum(x1[rows, None], x1[alive])
+            ymin = np.maximum(y1[rows, None], y1[alive])
+            xmax = np.minimum(x2[rows, None], x2[alive])
+            ymax = np.minimum(y2[rows, None], y2[alive])
+
+            intersection_area = np.maximum(0, xmax - xmin) * np.maximum(0, ymax - ymin)
+            union_area = areas[rows, None] + areas[alive] - intersection_area
+            overlaps = ~(intersection_area / union_area < iou_threshold)
+            # Every row overlaps itself, a surviving row overlaps no surviving row before it
+            overlaps[np.arange(rows.size), np.arange(rows.size)] = False
+
+            for i in np.flatnonzero(overlaps.any(axis=1)):
+                if not suppressed[rows[i]]:
+                    suppressed[alive[overlaps[i]]] = True
+            start = rows[-1] + 1
+
+    return np.flatnonzero(~suppressed)
+
+
+def _cv2_nms(boxes, scores, class_ids, iou_threshold) -> np.ndarray:
+    xywh = np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+    keep = cv2.dnn.NMSBoxesBatched(
+        xywh.tolist(), scores.tolist(), class_ids.tolist(), 0.0, iou_threshold
+    )
+    return np.asarray(keep, dtype=np.int64).reshape(-1)
+
+
+def decode_predictions(
+    output: np.ndarray, conf_threshold: float, num_classes: int | None = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Candidates of a YOLOv8 head without transposing it.
+
+    :param output: (4 + classes (+ masks), anchors) of one image
+    :return: boxes (N, 4) x, y, w, h, scores, class_ids, the remaining rows (N, masks)
+    """
+    num_classes = len(output) - 4 if num_classes is None else num_classes
+    class_scores = output[4 : 4 + num_classes]
+
+    scores = np.max(class_scores, axis=0)
+    candidates = np.flatnonzero(scores > conf_threshold)
+    class_ids = np.argmax(class_scores[:, candidates], axis=0)
+
+    boxes = output[:4, candidates].T
+    extra = output[4 + num_classes :, candidates].T
+    return boxes, scores[candidates], class_ids, extra
+
+
 def compute_iou(box, boxes):
     # Compute xmin, ymin, xmax, ymax for both boxes
     xmin = np.maximum(box[0], boxes[:, 0])
@@ -104,8 +215,14 @@ def compute_iou(box, boxes):
     return iou
 
 
-def xywh2xyxy(x):
+def xywh2xyxy(x, *, inplace: bool = False):
     # Convert bounding box (x, y, w, h) to bounding box (x1, y1, x2, y2)
+    if inplace:
+        half = x[..., 2:4] / 2
+        x[..., 2:4] = x[..., 0:2] + half
+        x[..., 0:2] -= half
+        return x
+
     y = np.copy(x)
     y[..., 0] = x[..., 0] - x[..., 2] / 2
     y[..., 1] = x[..., 1] - x[..., 3] / 2
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/13 14:36
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description: content-addressed verdict cache shared by the worker processes of a host
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import suppress
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Literal
+
+import numpy as np
+from loguru import logger
+
+VerdictKind = Literal["resnet", "point", "bounding_box", "clip"]
+
+DEFAULT_VERDICT_BUDGET = int(os.environ.get("MODELHUB_VERDICT_BUDGET_MB", 64)) * 1024 * 1024
+
+# Evictions scan the table, check the budget every so many writes
+EVICT_EVERY = 64
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    image TEXT NOT NULL,
+    model TEXT NOT NULL,
+    version TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (image, model, version, prompt, kind)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS verdicts_accessed ON verdicts (accessed);
+"""
+
+
+def image_digest(image: bytes) -> str:
+    """The MD5 `download_challenge_images` names the challenge images after"""
+    return hashlib.md5(image).hexdigest()
+
+
+def _to_json(obj: Any):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _tuplify(obj: Any):
+    """JSON has no tuples, the detections are nested tuples"""
+    if isinstance(obj, list):
+        return tuple(_tuplify(item) for item in obj)
+    return obj
+
+
+@dataclass
+class VerdictStats:
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class VerdictCache:
+    """
+    What a model answered on an image, keyed by (image MD5, model, model version, prompt).
+
+    Identical challenge images recur across sessions, a hit skips decoding and inference.
+    The store is a SQLite database in WAL mode, so the agents and pre-fork workers of a host
+    read and write it concurrently. Each process (and thread) opens its own connection.
+    Entries untouched for the longest time are evicted once the stored verdicts exceed `budget`.
+    """
+
+    def __init__(self, path: Path | str, budget: int = DEFAULT_VERDICT_BUDGET):
+        self.path = Path(path)
+        self.budget = budget
+        self.stats = VerdictStats()
+
+        self._local = threading.local()
+        self._writes_since_evict = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn: sqlite3.Connection | None = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, image: str, model: str, version: str, prompt: str, kind: VerdictKind):
+        """The cached verdict, None on a miss"""
+        key = (image, model, version, prompt, kind)
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT value FROM verdicts "
+                "WHERE image=? AND model=? AND version=? AND prompt=? AND kind=?",
+                key,
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE verdicts SET accessed=? "
+                    "WHERE image=? AND model=? AND version=? AND prompt=? AND kind=?",
+                    (time.time(), *key),
+                )
+        except sqlite3.Error as err:
+            logger.warning("Verdict cache is unavailable", path=self.path, err=err)
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.stats.misses += 1
+                return
+            self.stats.hits += 1
+        return _tuplify(json.loads(row[0]))
+
+    def put(self, image: str, model: str, version: str, prompt: str, kind: VerdictKind, value):
+        data = json.dumps(value, default=_to_json, ensure_ascii=False)
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (image, model, version, prompt, kind, data, len(data), time.time()),
+            )
+        except sqlite3.Error as err:
+            logger.warning("Verdict cache is unavailable", path=self.path, err=err)
+            return
+
+        with self._lock:
+            self.stats.writes += 1
+            self._writes_since_evict += 1
+            evict = self._writes_since_evict >= EVICT_EVERY
+            if evict:
+                self._writes_since_evict = 0
+        if evict:
+            self.evict()
+
+    def nbytes(self) -> int:
+        row = self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM verdicts").fetchone()
+        return row[0]
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+
+    def evict(self):
+        """Drop the least recently used verdicts until the store fits 90% of `budget`"""
+        with suppress(sqlite3.Error):
+            conn = self._connection()
+            total = self.nbytes()
+            if total <= self.budget:
+                return
+            excess = total - int(self.budget * 0.9)
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT image, model, version, prompt, kind, size FROM verdicts "
+                    "ORDER BY accessed"
+                )
+                stale, freed = [], 0
+                for *key, size in rows:
+                    if freed >= excess:
+                        break
+                    stale.append(key)
+                    freed += size
+                rows.close()
+                conn.executemany(
+                    "DELETE FROM verdicts "
+                    "WHERE image=? AND model=? AND version=? AND prompt=? AND kind=?",
+                    stale,
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+            with self._lock:
+                self.stats.evictions += len(stale)
+
+    def clear(self):
+        self._connection().execute("DELETE FROM verdicts")
+
+    def close(self):
+        conn: sqlite3.Connection | None = getattr(self._local, "conn", None)
+        if conn is not None and getattr(self._local, "pid", None) == os.getpid():
+            conn.close()
+        self._local = threading.local()
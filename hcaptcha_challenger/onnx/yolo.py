@@ -6,17 +6,123 @@
 from __future__ import annotations
 
 import math
+import threading
 import time
+import weakref
 from dataclasses import dataclass, field
+from functools import cached_property
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 from typing import Literal
 
 import cv2
 import numpy as np
+from loguru import logger
 from onnxruntime import InferenceSession
 
-from .utils import nms, xywh2xyxy, draw_detections, sigmoid, multiclass_nms
+from .batching import is_unbatchable, mark_unbatchable
+from .preprocess import InputTensor, Letterbox
+from .utils import xywh2xyxy, draw_detections, sigmoid, batched_nms, decode_predictions, NMSBackend
+
+
+def _respond(
+    classes: List[str], boxes, scores, class_ids, shape_type: Literal["point", "bounding_box"]
+):
+    response = []
+    if shape_type == "point":
+        for i, class_id in enumerate(class_ids):
+            x1, y1, x2, y2 = boxes[i]
+            center_x, center_y = int((x2 - x1) / 2 + x1), int((y2 - y1) / 2 + y1)
+            response.append((classes[class_id], (center_x, center_y), scores[i]))
+    elif shape_type == "bounding_box":
+        for i, class_id in enumerate(class_ids):
+            x1, y1, x2, y2 = boxes[i]
+            point_start, point_end = (x1, y1), (x2, y2)
+            response.append((classes[class_id], point_start, point_end, scores[i]))
+    return response
+
+
+@dataclass(frozen=True)
+class SessionMeta:
+    """The input and output names and shapes of a session, the same for every wrapper of it"""
+
+    input_names: List[str]
+    input_shape: list
+    output_names: List[str]
+
+    @property
+    def input_height(self):
+        return self.input_shape[2]
+
+    @property
+    def input_width(self):
+        return self.input_shape[3]
+
+
+_session_metas: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_session_metas_lock = threading.Lock()
+
+
+def session_meta(session: InferenceSession) -> SessionMeta:
+    """
+    `SessionMeta` of a session, read once per session.
+
+    `match_model` and the agents wrap a session in a new detector for every challenge,
+    the metadata lives as long as the session does.
+    """
+    with _session_metas_lock:
+        try:
+            if (meta := _session_metas.get(session)) is not None:
+                return meta
+        except TypeError:
+            pass
+
+    model_inputs = session.get_inputs()
+    model_outputs = session.get_outputs()
+    meta = SessionMeta(
+        input_names=[model_input.name for model_input in model_inputs],
+        input_shape=model_inputs[0].shape,
+        output_names=[model_output.name for model_output in model_outputs],
+    )
+
+    with _session_metas_lock:
+        try:
+            _session_metas[session] = meta
+        except TypeError:
+            # Not weakly referenceable, read again by the next wrapper
+            pass
+    return meta
+
+
+@dataclass
+class Detections:
+    """
+    The objects a detector found in one image.
+
+    Returned by the stateless `YOLOv8.detect` paths instead of being kept on the detector,
+    so that one detector can serve several threads at once.
+    """
+
+    boxes: np.ndarray | list
+    """(n, 4) x1, y1, x2, y2 in image pixels"""
+
+    scores: np.ndarray | list
+    class_ids: np.ndarray | list
+
+    letterbox: Letterbox
+    """Where the image landed in the model input, it also knows the size of the image"""
+
+    @property
+    def img_height(self) -> int:
+        return self.letterbox.img_height
+
+    @property
+    def img_width(self) -> int:
+        return self.letterbox.img_width
+
+    def respond(self, classes: List[str], shape_type: Literal["point", "bounding_box"] = "point"):
+        """The answers of `__call__`"""
+        return _respond(classes, self.boxes, self.scores, self.class_ids, shape_type)
 
 
 @dataclass
@@ -27,30 +133,79 @@ class YOLOv8:
 
     session: InferenceSession = None
 
+    letterbox: bool = False
+    """
+    Fit the images into the input keeping their aspect ratio and pad the rest,
+    as ultralytics does, instead of stretching them over the input
+    """
+
+    nms_backend: NMSBackend = "numpy"
+    """
+    `batched_nms` in numpy, or `cv2.dnn.NMSBoxesBatched`
+    """
+
     input_names = None
     input_shape = None
     input_height = None
     input_width = None
     output_names = None
 
-    img_height = None
-    img_width = None
+    _local: threading.local = field(default_factory=threading.local, repr=False, compare=False)
+    """
+    The input buffer, the last `Detections` and the last `Letterbox` of each thread
+    """
 
-    def __post_init__(self):
-        model_inputs = self.session.get_inputs()
-        self.input_names = [model_inputs[i].name for i in range(len(model_inputs))]
-
-        self.input_shape = model_inputs[0].shape
-        self.input_height = self.input_shape[2]
-        self.input_width = self.input_shape[3]
+    @property
+    def _batchable(self) -> bool:
+        """
+        Whether the session accepts more than one image per run,
+        cleared the first time a batch is rejected, see `ModelHub.batch_yolo`.
+        Kept per session, the detectors built around it for later challenges skip the probe
+        """
+        return not is_unbatchable(self.session)
 
-        model_outputs = self.session.get_outputs()
-        self.output_names = [model_outputs[i].name for i in range(len(model_outputs))]
+    def __post_init__(self):
+        meta = session_meta(self.session)
+        self.input_names = meta.input_names
+        self.input_shape = meta.input_shape
+        self.input_height = meta.input_height
+        self.input_width = meta.input_width
+        self.output_names = meta.output_names
 
     @classmethod
     def from_pluggable_model(cls, session: InferenceSession, classes: List[str]):
         return cls(session=session, classes=classes)
 
+    @property
+    def dynamic_batch(self) -> bool:
+        """The batch dimension of the input is symbolic, e.g. `N` of a `ModelHub.batch_yolo` copy"""
+        return not isinstance(self.input_shape[0], int)
+
+    @property
+    def _inputs(self) -> InputTensor:
+        """The input buffer of the calling thread, a run never reads another thread's tensor"""
+        inputs: InputTensor | None = getattr(self._local, "inputs", None)
+        if inputs is None:
+            inputs = InputTensor(self.input_height, self.input_width, letterbox=self.letterbox)
+            self._local.inputs = inputs
+        return inputs
+
+    @property
+    def _letterbox(self) -> Letterbox | None:
+        """Where the last image of this thread landed in the input"""
+        return getattr(self._local, "letterbox", None)
+
+    @property
+    def img_height(self) -> int | None:
+        """Height of the last image `detect_objects` saw in this thread"""
+        last: Detections | None = getattr(self._local, "last", None)
+        return last.img_height if last else None
+
+    @property
+    def img_width(self) -> int | None:
+        last: Detections | None = getattr(self._local, "last", None)
+        return last.img_width if last else None
+
     def __call__(self, image: Path | bytes, shape_type: Literal["point", "bounding_box"] = "point"):
         if isinstance(image, Path):
             image = image.read_bytes()
@@ -58,80 +213,111 @@ class YOLOv8:
         np_array = np.frombuffer(image, np.uint8)
         image = cv2.imdecode(np_array, flags=1)
 
-        boxes, scores, class_ids = self.detect_objects(image)
-
-        response = []
-        if shape_type == "point":
-            for i, class_id in enumerate(class_ids):
-                x1, y1, x2, y2 = boxes[i]
-                center_x, center_y = int((x2 - x1) / 2 + x1), int((y2 - y1) / 2 + y1)
-                response.append((self.classes[class_id], (center_x, center_y), scores[i]))
-        elif shape_type == "bounding_box":
-            for i, class_id in enumerate(class_ids):
-                x1, y1, x2, y2 = boxes[i]
-                point_start, point_end = (x1, y1), (x2, y2)
-                response.append((self.classes[class_id], point_start, point_end, scores[i]))
+        detections = self._local.last = self.detect(image)
+
+        return detections.respond(self.classes, shape_type)
+
+    def detect_batch(
+        self, images: List[Path | bytes], shape_type: Literal["point", "bounding_box"] = "point"
+    ) -> List[list | None]:
+        """
+        Same answers as `[self(image, shape_type) for image in images]` from a single
+        `session.run` when the model has a dynamic batch dimension,
+        None for the images that cannot be decoded.
+        """
+        decoded = [decode_image(image) for image in images]
+        indices = [i for i, image in enumerate(decoded) if image is not None]
+
+        response: List[list | None] = [None] * len(images)
+        results = self.detect_many([decoded[i] for i in indices])
+        if results:
+            self._local.last = results[-1]
+        for i, detections in zip(indices, results):
+            response[i] = detections.respond(self.classes, shape_type)
         return response
 
-    def detect_objects(self, image: np.ndarray):
-        self.img_height, self.img_width = image.shape[:2]
-
-        input_tensor = self._prepare_input(image)
+    def detect(self, image: np.ndarray) -> Detections:
+        """The objects of a BGR image, nothing is kept on the detector"""
+        input_tensor, [letterbox] = self._inputs.fill([image])
 
         # Perform inference on the image
         outputs = self.session.run(self.output_names, {self.input_names[0]: input_tensor})
 
-        boxes, scores, class_ids = self._process_output(outputs)
-
-        return boxes, scores, class_ids
-
-    def _prepare_input(self, image):
-        input_img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return self._process_output(outputs, letterbox)
+
+    def detect_many(self, images: List[np.ndarray]) -> List[Detections]:
+        """`detect` of each image, one run for all of them if the session allows it"""
+        if self._batchable and self.dynamic_batch and len(images) > 1:
+            input_tensor, letterboxes = self._inputs.fill(images)
+            try:
+                outputs = self.session.run(self.output_names, {self.input_names[0]: input_tensor})
+            except Exception as err:
+                logger.debug("The session rejects batches, fall back to one image per run", err=err)
+                mark_unbatchable(self.session)
+            else:
+                return [
+                    self._process_output([outputs[0][i : i + 1]], letterbox)
+                    for i, letterbox in enumerate(letterboxes)
+                ]
+        return [self.detect(image) for image in images]
 
-        # Resize input image
-        input_img = cv2.resize(input_img, (self.input_width, self.input_height))
+    def detect_objects(self, image: np.ndarray):
+        detections = self._local.last = self.detect(image)
+        return detections.boxes, detections.scores, detections.class_ids
 
-        # Scale input pixel values to 0 to 1
-        input_img = input_img / 255.0
-        input_img = input_img.transpose(2, 0, 1)
-        input_tensor = input_img[np.newaxis, :, :, :].astype(np.float32)
+    def detect_objects_batch(self, images: List[np.ndarray]) -> List[Tuple]:
+        """`detect_objects` of each image, one run for all of them if the session allows it"""
+        results = self.detect_many(images)
+        if results:
+            self._local.last = results[-1]
+        return [(d.boxes, d.scores, d.class_ids) for d in results]
 
+    def _prepare_input(self, image):
+        """The input tensor of a BGR image, `_process_output` defaults to its letterbox"""
+        input_tensor, [self._local.letterbox] = self._inputs.fill([image])
         return input_tensor
 
-    def _process_output(self, output):
-        predictions = np.squeeze(output[0]).T
+    def _process_output(self, output, letterbox: Letterbox | None = None) -> Detections:
+        letterbox = self._local.letterbox = _resolve_letterbox(self, letterbox)
 
-        # Filter out object confidence scores below threshold
-        scores = np.max(predictions[:, 4:], axis=1)
-        predictions = predictions[scores > self.conf_threshold, :]
-        scores = scores[scores > self.conf_threshold]
+        # Filter out object confidence scores below threshold,
+        # get the class with the highest confidence and the boxes of the candidates
+        boxes, scores, class_ids, _ = decode_predictions(output[0][0], self.conf_threshold)
 
         if len(scores) == 0:
-            return [], [], []
-
-        # Get the class with the highest confidence
-        class_ids = np.argmax(predictions[:, 4:], axis=1)
+            return Detections([], [], [], letterbox)
 
-        # Get bounding boxes for each object
-        # Extract boxes from predictions
-        boxes = predictions[:, :4]
-
-        # Scale boxes to original image dimensions
         # Rescale boxes to original image dimensions
-        input_shape = np.array(
-            [self.input_width, self.input_height, self.input_width, self.input_height]
-        )
-        boxes = np.divide(boxes, input_shape, dtype=np.float32)
-        boxes *= np.array([self.img_width, self.img_height, self.img_width, self.img_height])
+        boxes = letterbox.unmap(boxes)
 
         # Convert boxes to xyxy format
-        boxes = xywh2xyxy(boxes)
+        boxes = xywh2xyxy(boxes, inplace=True)
 
         # Apply non-maxima suppression to suppress weak, overlapping bounding boxes
-        # indices = nms(boxes, scores, self.iou_threshold)
-        indices = multiclass_nms(boxes, scores, class_ids, self.iou_threshold)
+        indices = batched_nms(
+            boxes, scores, class_ids, self.iou_threshold, backend=self.nms_backend
+        )
 
-        return boxes[indices], scores[indices], class_ids[indices]
+        return Detections(boxes[indices], scores[indices], class_ids[indices], letterbox)
+
+
+def _resolve_letterbox(detector: YOLOv8 | YOLOv8Seg, letterbox: Letterbox | None) -> Letterbox:
+    """The given letterbox, else the last one of the calling thread"""
+    if letterbox is None:
+        letterbox = detector._letterbox
+    if letterbox is None:
+        raise ValueError("No image was prepared in this thread, pass the letterbox of the image")
+    return letterbox
+
+
+def decode_image(image: Path | bytes) -> np.ndarray | None:
+    """BGR image of a challenge image, None if it cannot be decoded"""
+    if isinstance(image, Path):
+        image = image.read_bytes()
+    np_array = np.frombuffer(image, np.uint8)
+    if not np_array.size:
+        return
+    return cv2.imdecode(np_array, flags=1)
 
 
 def is_matched_ash_of_war(ash: str, class_name: str):
@@ -160,6 +346,104 @@ def finetune_keypoint(name: str, point: List[int, int]) -> List[int, int]:
     return point
 
 
+@dataclass(frozen=True)
+class CropMask:
+    """
+    The binary mask of a detection, local to the crop of its box.
+
+    The full size map of the image is `mask` pasted at (`x1`, `y1`) over zeros, see `paste`.
+    """
+
+    x1: int
+    y1: int
+    mask: np.ndarray
+    """(y2 - y1, x2 - x1) uint8 of 0 and 1, empty for boxes clipped to nothing"""
+
+    def paste(self, mask_map: np.ndarray) -> np.ndarray:
+        height, width = self.mask.shape
+        mask_map[self.y1 : self.y1 + height, self.x1 : self.x1 + width] = self.mask
+        return mask_map
+
+
+@dataclass
+class Segmentation(Detections):
+    """
+    `Detections` of `YOLOv8Seg` whose masks are computed on the first read of `masks`,
+    the points and boxes of `__call__` never compute them.
+    """
+
+    mask_predictions: np.ndarray = field(default=None, repr=False)
+    """(n, num_masks) mask coefficients of the detections"""
+
+    mask_output: np.ndarray = field(default=None, repr=False)
+    """(1, num_masks, mask_height, mask_width) mask prototypes of the image"""
+
+    input_shape: Tuple[int, int] = None
+    letterboxed: bool = False
+
+    @cached_property
+    def masks(self) -> List[CropMask]:
+        """The `CropMask` of each detection"""
+        if self.mask_predictions is None or self.mask_predictions.shape[0] == 0:
+            return []
+
+        mask_output = np.squeeze(self.mask_output)
+
+        # Calculate the mask maps for each box
+        num_mask, mask_height, mask_width = mask_output.shape  # CHW
+        masks = self.mask_predictions @ mask_output.reshape((num_mask, -1))
+        masks = masks.reshape((-1, mask_height, mask_width))
+
+        # Downscale the boxes to match the mask size
+        if self.letterboxed:
+            scale_boxes = YOLOv8Seg.rescale_boxes(
+                self.letterbox.map(self.boxes), self.input_shape, (mask_height, mask_width)
+            )
+        else:
+            scale_boxes = YOLOv8Seg.rescale_boxes(
+                self.boxes, (self.img_height, self.img_width), (mask_height, mask_width)
+            )
+
+        # For every box/mask pair, get the mask within the box,
+        # only the crop of the box is activated, resized and blurred
+        crop_masks = []
+        blur_size = (int(self.img_width / mask_width), int(self.img_height / mask_height))
+        for i in range(len(scale_boxes)):
+            scale_x1 = int(math.floor(scale_boxes[i][0]))
+            scale_y1 = int(math.floor(scale_boxes[i][1]))
+            scale_x2 = int(math.ceil(scale_boxes[i][2]))
+            scale_y2 = int(math.ceil(scale_boxes[i][3]))
+
+            x1 = int(math.floor(self.boxes[i][0]))
+            y1 = int(math.floor(self.boxes[i][1]))
+            x2 = int(math.ceil(self.boxes[i][2]))
+            y2 = int(math.ceil(self.boxes[i][3]))
+
+            scale_crop_mask = masks[i][scale_y1:scale_y2, scale_x1:scale_x2]
+            # Boxes clipped to nothing, e.g. predicted on the padding of a letterboxed input
+            if not scale_crop_mask.size or x2 <= x1 or y2 <= y1:
+                crop_masks.append(CropMask(x1, y1, np.zeros((0, 0), dtype=np.uint8)))
+                continue
+            crop_mask = cv2.resize(
+                sigmoid(scale_crop_mask), (x2 - x1, y2 - y1), interpolation=cv2.INTER_CUBIC
+            )
+
+            crop_mask = cv2.blur(crop_mask, blur_size)
+
+            crop_mask = (crop_mask > 0.5).astype(np.uint8)
+            crop_masks.append(CropMask(x1, y1, crop_mask))
+
+        return crop_masks
+
+    @property
+    def mask_maps(self) -> np.ndarray:
+        """(n, img_height, img_width) uint8 maps of `masks`, what `draw_masks` paints"""
+        mask_maps = np.zeros((len(self.masks), self.img_height, self.img_width), dtype=np.uint8)
+        for mask, mask_map in zip(self.masks, mask_maps):
+            mask.paste(mask_map)
+        return mask_maps
+
+
 @dataclass
 class YOLOv8Seg:
     conf_threshold: float = 0.71
@@ -167,6 +451,8 @@ class YOLOv8Seg:
     num_masks: int = 32
     classes: List[str] = field(default_factory=list)
     session: InferenceSession = None
+    letterbox: bool = False
+    nms_backend: NMSBackend = "numpy"
 
     input_names = None
     input_shape = None
@@ -174,25 +460,26 @@ class YOLOv8Seg:
     input_width = None
     output_names = None
 
-    img_height = None
-    img_width = None
-    boxes = None
-    scores = None
-    class_ids = None
-    mask_maps = None
-
     colors = None
 
-    def __post_init__(self):
-        model_inputs = self.session.get_inputs()
-        self.input_names = [model_inputs[i].name for i in range(len(model_inputs))]
+    _local: threading.local = field(default_factory=threading.local, repr=False, compare=False)
 
-        self.input_shape = model_inputs[0].shape
-        self.input_height = self.input_shape[2]
-        self.input_width = self.input_shape[3]
+    @property
+    def _batchable(self) -> bool:
+        """
+        Whether the session accepts more than one image per run,
+        cleared the first time a batch is rejected, see `ModelHub.batch_yolo`.
+        Kept per session, the detectors built around it for later challenges skip the probe
+        """
+        return not is_unbatchable(self.session)
 
-        model_outputs = self.session.get_outputs()
-        self.output_names = [model_outputs[i].name for i in range(len(model_outputs))]
+    def __post_init__(self):
+        meta = session_meta(self.session)
+        self.input_names = meta.input_names
+        self.input_shape = meta.input_shape
+        self.input_height = meta.input_height
+        self.input_width = meta.input_width
+        self.output_names = meta.output_names
 
         if not self.colors:
             rng = np.random.default_rng(3)
@@ -211,45 +498,149 @@ class YOLOv8Seg:
         np_array = np.frombuffer(image, np.uint8)
         image = cv2.imdecode(np_array, flags=1)
 
-        boxes, scores, class_ids, mask_maps = self.segment_objects(image)
-
-        response = []
-        if shape_type == "point":
-            for i, class_id in enumerate(class_ids):
-                x1, y1, x2, y2 = boxes[i]
-                center_x, center_y = int((x2 - x1) / 2 + x1), int((y2 - y1) / 2 + y1)
-                response.append((self.classes[class_id], (center_x, center_y), scores[i]))
-        elif shape_type == "bounding_box":
-            for i, class_id in enumerate(class_ids):
-                x1, y1, x2, y2 = boxes[i]
-                point_start, point_end = (x1, y1), (x2, y2)
-                response.append((self.classes[class_id], point_start, point_end, scores[i]))
+        # Kept for `draw_masks`, which reads the masks of the last image of this thread
+        segmentation = self._local.last = self.segment(image)
+
+        return segmentation.respond(self.classes, shape_type)
+
+    @property
+    def dynamic_batch(self) -> bool:
+        return not isinstance(self.input_shape[0], int)
+
+    @property
+    def _inputs(self) -> InputTensor:
+        """See `YOLOv8._inputs`"""
+        inputs: InputTensor | None = getattr(self._local, "inputs", None)
+        if inputs is None:
+            inputs = InputTensor(self.input_height, self.input_width, letterbox=self.letterbox)
+            self._local.inputs = inputs
+        return inputs
+
+    @property
+    def _last(self) -> Segmentation | None:
+        """The last image `__call__` or `segment_objects` segmented in this thread"""
+        return getattr(self._local, "last", None)
+
+    @property
+    def _letterbox(self) -> Letterbox | None:
+        """See `YOLOv8._letterbox`"""
+        return getattr(self._local, "letterbox", None)
+
+    @property
+    def img_height(self) -> int | None:
+        return self._last.img_height if self._last else None
+
+    @property
+    def img_width(self) -> int | None:
+        return self._last.img_width if self._last else None
+
+    @property
+    def boxes(self):
+        return self._last.boxes if self._last else None
+
+    @property
+    def scores(self):
+        return self._last.scores if self._last else None
+
+    @property
+    def class_ids(self):
+        return self._last.class_ids if self._last else None
+
+    @property
+    def masks(self) -> List[CropMask] | None:
+        """The `CropMask` of each detection of the last image, computed on first read"""
+        return self._last.masks if self._last else None
+
+    @property
+    def mask_maps(self) -> np.ndarray | None:
+        return self._last.mask_maps if self._last else None
+
+    def detect_batch(
+        self, images: List[Path | bytes], shape_type: Literal["point", "bounding_box"] = "point"
+    ) -> List[list | None]:
+        """See `YOLOv8.detect_batch`"""
+        decoded = [decode_image(image) for image in images]
+        indices = [i for i, image in enumerate(decoded) if image is not None]
+
+        response: List[list | None] = [None] * len(images)
+        results = self.segment_many([decoded[i] for i in indices])
+        if results:
+            self._local.last = results[-1]
+        for i, segmentation in zip(indices, results):
+            response[i] = segmentation.respond(self.classes, shape_type)
         return response
 
-    def segment_objects(self, image):
-        input_tensor = self.prepare_input(image)
+    def segment(self, image: np.ndarray) -> Segmentation:
+        """The objects of a BGR image and their lazy masks, nothing is kept on the detector"""
+        input_tensor, [letterbox] = self._inputs.fill([image])
 
         # Perform inference on the image
         outputs = self.inference(input_tensor)
 
-        self.boxes, self.scores, self.class_ids, mask_pred = self.process_box_output(outputs[0])
-        self.mask_maps = self.process_mask_output(mask_pred, outputs[1])
-
-        return self.boxes, self.scores, self.class_ids, self.mask_maps
-
-    def prepare_input(self, image):
-        self.img_height, self.img_width = image.shape[:2]
+        return self._process_outputs(outputs, letterbox)
+
+    def segment_many(self, images: List[np.ndarray]) -> List[Segmentation]:
+        """`segment` of each image, one run for all of them if the session allows it"""
+        if self._batchable and self.dynamic_batch and len(images) > 1:
+            input_tensor, letterboxes = self._inputs.fill(images)
+            try:
+                outputs = self.inference(input_tensor)
+            except Exception as err:
+                logger.debug("The session rejects batches, fall back to one image per run", err=err)
+                mark_unbatchable(self.session)
+            else:
+                return [
+                    self._process_outputs([output[i : i + 1] for output in outputs], letterbox)
+                    for i, letterbox in enumerate(letterboxes)
+                ]
+        return [self.segment(image) for image in images]
+
+    def segment_objects(self, image, *, masks: bool = True):
+        """
+        Boxes, scores, class ids and the `CropMask` of each detection.
+
+        With masks=False the masks are left to the first read of `masks` (None is returned
+        in their place).
+        """
+        segmentation = self._local.last = self.segment(image)
+        return self._unpack(segmentation, masks)
+
+    def segment_objects_batch(self, images: List[np.ndarray], *, masks: bool = True) -> List[Tuple]:
+        """`segment_objects` of each image, one run for all of them if the session allows it"""
+        results = self.segment_many(images)
+        if results:
+            self._local.last = results[-1]
+        return [self._unpack(segmentation, masks) for segmentation in results]
 
-        input_img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-        # Resize input image
-        input_img = cv2.resize(input_img, (self.input_width, self.input_height))
+    @staticmethod
+    def _unpack(segmentation: Segmentation, masks: bool) -> Tuple:
+        return (
+            segmentation.boxes,
+            segmentation.scores,
+            segmentation.class_ids,
+            segmentation.masks if masks else None,
+        )
 
-        # Scale input pixel values to 0 to 1
-        input_img = input_img / 255.0
-        input_img = input_img.transpose(2, 0, 1)
-        input_tensor = input_img[np.newaxis, :, :, :].astype(np.float32)
+    def _process_outputs(self, outputs, letterbox: Letterbox) -> Segmentation:
+        self._local.letterbox = letterbox
+        boxes, scores, class_ids, mask_pred = self.process_box_output(outputs[0], letterbox)
+        return Segmentation(
+            boxes,
+            scores,
+            class_ids,
+            letterbox,
+            mask_predictions=mask_pred,
+            mask_output=outputs[1],
+            input_shape=(self.input_height, self.input_width),
+            letterboxed=self.letterbox,
+        )
 
+    def prepare_input(self, image):
+        """
+        The input tensor of a BGR image for `inference`,
+        the post-processing of this thread defaults to its letterbox
+        """
+        input_tensor, [self._local.letterbox] = self._inputs.fill([image])
         return input_tensor
 
     def inference(self, input_tensor):
@@ -259,91 +650,62 @@ class YOLOv8Seg:
         # print(f"Inference time: {(time.perf_counter() - start)*1000:.2f} ms")
         return outputs
 
-    def process_box_output(self, box_output):
-        predictions = np.squeeze(box_output).T
+    def process_box_output(self, box_output, letterbox: Letterbox | None = None):
+        letterbox = _resolve_letterbox(self, letterbox)
         num_classes = box_output.shape[1] - self.num_masks - 4
 
-        # Filter out object confidence scores below threshold
-        scores = np.max(predictions[:, 4 : 4 + num_classes], axis=1)
-        predictions = predictions[scores > self.conf_threshold, :]
-        scores = scores[scores > self.conf_threshold]
+        # Filter out object confidence scores below threshold,
+        # get the class with the highest confidence and the mask coefficients of the candidates
+        box_predictions, scores, class_ids, mask_predictions = decode_predictions(
+            box_output[0], self.conf_threshold, num_classes
+        )
 
         if len(scores) == 0:
             return [], [], [], np.array([])
 
-        box_predictions = predictions[..., : num_classes + 4]
-        mask_predictions = predictions[..., num_classes + 4 :]
-
-        # Get the class with the highest confidence
-        class_ids = np.argmax(box_predictions[:, 4:], axis=1)
-
         # Get bounding boxes for each object
-        boxes = self.extract_boxes(box_predictions)
+        boxes = self.extract_boxes(box_predictions, letterbox)
 
         # Apply non-maxima suppression to suppress weak, overlapping bounding boxes
-        indices = nms(boxes, scores, self.iou_threshold)
+        indices = batched_nms(boxes, scores, None, self.iou_threshold, backend=self.nms_backend)
 
         return boxes[indices], scores[indices], class_ids[indices], mask_predictions[indices]
 
-    def process_mask_output(self, mask_predictions, mask_output):
-        if mask_predictions.shape[0] == 0:
-            return []
-
-        mask_output = np.squeeze(mask_output)
-
-        # Calculate the mask maps for each box
-        num_mask, mask_height, mask_width = mask_output.shape  # CHW
-        masks = sigmoid(mask_predictions @ mask_output.reshape((num_mask, -1)))
-        masks = masks.reshape((-1, mask_height, mask_width))
-
-        # Downscale the boxes to match the mask size
-        scale_boxes = self.rescale_boxes(
-            self.boxes, (self.img_height, self.img_width), (mask_height, mask_width)
+    def process_mask_output(
+        self, mask_predictions, mask_output, boxes=None, letterbox: Letterbox | None = None
+    ) -> List[CropMask]:
+        """
+        The `CropMask` of each detection, see `Segmentation.masks`.
+
+        The boxes and the letterbox default to the last image of this thread.
+        """
+        segmentation = Segmentation(
+            self.boxes if boxes is None else boxes,
+            [],
+            [],
+            _resolve_letterbox(self, letterbox),
+            mask_predictions=mask_predictions,
+            mask_output=mask_output,
+            input_shape=(self.input_height, self.input_width),
+            letterboxed=self.letterbox,
         )
+        return segmentation.masks
 
-        # For every box/mask pair, get the mask map
-        mask_maps = np.zeros((len(scale_boxes), self.img_height, self.img_width))
-        blur_size = (int(self.img_width / mask_width), int(self.img_height / mask_height))
-        for i in range(len(scale_boxes)):
-            scale_x1 = int(math.floor(scale_boxes[i][0]))
-            scale_y1 = int(math.floor(scale_boxes[i][1]))
-            scale_x2 = int(math.ceil(scale_boxes[i][2]))
-            scale_y2 = int(math.ceil(scale_boxes[i][3]))
+    def extract_boxes(self, box_predictions, letterbox: Letterbox | None = None):
+        letterbox = _resolve_letterbox(self, letterbox)
 
-            x1 = int(math.floor(self.boxes[i][0]))
-            y1 = int(math.floor(self.boxes[i][1]))
-            x2 = int(math.ceil(self.boxes[i][2]))
-            y2 = int(math.ceil(self.boxes[i][3]))
-
-            scale_crop_mask = masks[i][scale_y1:scale_y2, scale_x1:scale_x2]
-            crop_mask = cv2.resize(
-                scale_crop_mask, (x2 - x1, y2 - y1), interpolation=cv2.INTER_CUBIC
-            )
-
-            crop_mask = cv2.blur(crop_mask, blur_size)
-
-            crop_mask = (crop_mask > 0.5).astype(np.uint8)
-            mask_maps[i, y1:y2, x1:x2] = crop_mask
-
-        return mask_maps
-
-    def extract_boxes(self, box_predictions):
         # Extract boxes from predictions
         boxes = box_predictions[:, :4]
 
         # Scale boxes to original image dimensions
-        boxes = self.rescale_boxes(
-            boxes, (self.input_height, self.input_width), (self.img_height, self.img_width)
-        )
+        boxes = letterbox.unmap(boxes)
 
         # Convert boxes to xyxy format
-        boxes = xywh2xyxy(boxes)
+        boxes = xywh2xyxy(boxes, inplace=True)
 
         # Check the boxes are within the image
-        boxes[:, 0] = np.clip(boxes[:, 0], 0, self.img_width)
-        boxes[:, 1] = np.clip(boxes[:, 1], 0, self.img_height)
-        boxes[:, 2] = np.clip(boxes[:, 2], 0, self.img_width)
-        boxes[:, 3] = np.clip(boxes[:, 3], 0, self.img_height)
+        np.clip(boxes[:, 0::2], 0, letterbox.img_width, out=boxes[:, 0::2])
+        np.clip(boxes[:, 1::2], 0, letterbox.img_height, out=boxes[:, 1::2])
 
         return boxes
 
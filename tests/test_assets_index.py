@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/5 13:02
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import json
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from hcaptcha_challenger.onnx.modelhub import Assets
+
+ETAG = '"release-v1"'
+RELEASES = [
+    {
+        "assets": [
+            {
+                "id": 1,
+                "node_id": "RA_node1",
+                "name": "COCO2020_yolov8m.onnx",
+                "size": 1024,
+                "browser_download_url": "https://example.com/COCO2020_yolov8m.onnx",
+                "digest": "sha256:" + "a" * 64,
+            }
+        ]
+    }
+]
+
+
+class ReleasesHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if_none_match = self.headers.get("If-None-Match", "")
+        self.requests.append(if_none_match)
+        if if_none_match == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(RELEASES).encode()
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture()
+def release_url():
+    ReleasesHandler.requests = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ReleasesHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}/releases"
+    httpd.shutdown()
+
+
+def _assets(release_url: str, tmp_path: Path) -> Assets:
+    return Assets.from_release_url(
+        release_url,
+        _assets_dir=tmp_path.joinpath("_assets"),
+        _memory_dir=tmp_path.joinpath("_memory"),
+        cache_lifetime=timedelta(hours=2),
+    )
+
+
+def test_first_flush_blocks(release_url: str, tmp_path: Path):
+    assets = _assets(release_url, tmp_path)
+    assert not assets.get_focus_asset("COCO2020_yolov8m.onnx")
+
+    assets.flush_runtime_assets()
+
+    focus_asset = assets.get_focus_asset("COCO2020_yolov8m.onnx")
+    assert focus_asset.sha256 == "a" * 64
+    assert [p.name for p in tmp_path.joinpath("_assets").iterdir()] == ["index.json"]
+    assert ReleasesHandler.requests == [""]
+
+
+def test_stale_index_is_served_and_revalidated(release_url: str, tmp_path: Path):
+    _assets(release_url, tmp_path).flush_runtime_assets()
+
+    # Age the index past its lifetime
+    index_path = tmp_path.joinpath("_assets", "index.json")
+    index = json.loads(index_path.read_text())
+    index["fetched_at"] -= timedelta(hours=3).total_seconds()
+    index_path.write_text(json.dumps(index))
+
+    assets = _assets(release_url, tmp_path)
+    assert assets.get_focus_asset("COCO2020_yolov8m.onnx")
+
+    for _ in range(50):
+        if assets.is_fresh:
+            break
+        time.sleep(0.1)
+    assert assets.is_fresh
+    assert ReleasesHandler.requests == ["", ETAG]
+
+
+def test_fresh_index_skips_network(release_url: str, tmp_path: Path):
+    _assets(release_url, tmp_path).flush_runtime_assets()
+
+    assets = _assets(release_url, tmp_path)
+    assets.flush_runtime_assets()
+
+    assert assets.get_focus_asset("COCO2020_yolov8m.onnx")
+    assert ReleasesHandler.requests == [""]
+
+
+def test_background_revalidate_logs_errors(release_url: str, tmp_path: Path, monkeypatch):
+    assets = _assets(release_url, tmp_path)
+    unhandled = []
+    monkeypatch.setattr(threading, "excepthook", unhandled.append)
+
+    for err in [OSError("Read-only file system"), RuntimeError("unexpected")]:
+
+        def dump_index(err_=err):
+            raise err_
+
+        monkeypatch.setattr(assets, "_dump_index", dump_index)
+        assets.revalidate(conditional=False, background=True)
+        # Released by the background thread once it is done
+        assert assets._revalidating.acquire(timeout=10)
+        assets._revalidating.release()
+    assert not unhandled
+
+
+def test_concurrent_index_dumps(release_url: str, tmp_path: Path):
+    first = _assets(release_url, tmp_path)
+    first.flush_runtime_assets()
+    second = _assets(release_url, tmp_path)
+
+    errors = []
+
+    def dump(assets: Assets):
+        try:
+            for _ in range(50):
+                assets._dump_index()
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=dump, args=(a,)) for a in [first, second] * 2]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    index_path = tmp_path.joinpath("_assets", "index.json")
+    assert json.loads(index_path.read_text())["etag"] == ETAG
+    assert [p.name for p in index_path.parent.iterdir()] == ["index.json"]
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/12 11:02
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import shutil
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.onnx.backend import OrtNet, select_backend
+from hcaptcha_challenger.onnx.modelhub import ModelHub, Assets, warmup_net
+from hcaptcha_challenger.onnx.resnet import ResNetControl
+
+this_dir = Path(__file__).parent
+model_path = this_dir.joinpath("goose2309.onnx")
+images = [p.read_bytes() for p in sorted(this_dir.joinpath("goose").glob("*.png"))]
+
+
+@pytest.fixture()
+def modelhub(tmp_path: Path) -> ModelHub:
+    shutil.copyfile(model_path, tmp_path.joinpath("goose2309.onnx"))
+
+    modelhub = ModelHub()
+    modelhub.models_dir = tmp_path
+    modelhub.optimized_dir = tmp_path.joinpath("_optimized")
+    modelhub.assets = Assets(release_url="", _assets_dir=tmp_path, _memory_dir=tmp_path)
+    return modelhub
+
+
+def _reference():
+    control = ResNetControl.from_pluggable_model(cv2.dnn.readNetFromONNX(str(model_path)))
+    return [control.execute(image, proba=True) for image in images]
+
+
+@pytest.mark.parametrize("batch_resnet", [True, False])
+def test_onnxruntime_backend(modelhub: ModelHub, batch_resnet: bool):
+    modelhub.batch_resnet = batch_resnet
+    modelhub.resnet_backends["goose2309.onnx"] = "onnxruntime"
+
+    net = modelhub.match_net("goose2309.onnx")
+    assert isinstance(net, OrtNet)
+    warmup_net(net)
+
+    results = ResNetControl.from_pluggable_model(net).execute_batch(images, proba=True)
+    for (prediction, confidence), (prediction_, confidence_) in zip(results, _reference()):
+        assert prediction is prediction_
+        assert np.allclose(confidence, confidence_, atol=1e-4)
+
+
+def test_auto_backend(modelhub: ModelHub):
+    modelhub.resnet_backend = "auto"
+
+    net = modelhub.match_net("goose2309.onnx")
+    assert isinstance(net, (cv2.dnn.Net, OrtNet))
+    [(model_file, backend)] = modelhub._measured_backends.items()
+    assert backend == ("onnxruntime" if isinstance(net, OrtNet) else "cv2")
+
+    # The measurement is not repeated when the model is loaded again
+    modelhub.unplug(force=True)
+    assert type(modelhub.match_net("goose2309.onnx")) is type(net)
+    assert modelhub._measured_backends == {model_file: backend}
+
+    modelhub.resnet_backend = "tensorrt"
+    modelhub.unplug(force=True)
+    with pytest.raises(ValueError):
+        modelhub.match_net("goose2309.onnx")
+
+
+def test_select_backend():
+    def broken():
+        raise RuntimeError("not available")
+
+    blob = np.zeros((1, 3, 64, 64), dtype=np.float32)
+    loaders = {"cv2": lambda: cv2.dnn.readNetFromONNX(str(model_path)), "onnxruntime": broken}
+    backend, net, timings = select_backend(loaders, blob, rounds=2)
+    assert backend == "cv2"
+    assert isinstance(net, cv2.dnn.Net)
+    assert list(timings) == ["cv2"]
+
+    with pytest.raises(RuntimeError):
+        select_backend({"onnxruntime": broken}, blob)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 22:30
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from hcaptcha_challenger.onnx import clip
+from hcaptcha_challenger.onnx.clip import Preprocessor
+
+this_dir = Path(__file__).parent
+rng = np.random.default_rng(2312)
+arrays = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for h, w in [(300, 200), (64, 480)]]
+
+batches = {
+    "goose": [Image.open(p) for p in sorted(this_dir.joinpath("goose").glob("*.png"))],
+    "uint8": arrays,
+    "float": [array / 255 for array in arrays],
+    "int64": [array.astype(np.int64) for array in arrays],
+    "gray": [Image.fromarray(array).convert("L") for array in arrays],
+}
+
+
+@pytest.mark.parametrize("name", list(batches))
+@pytest.mark.parametrize("validate", [False, True])
+def test_batch_matches_reference(name: str, validate: bool, record_property):
+    preprocessor = Preprocessor()
+    images = batches[name]
+
+    expected = np.concatenate([preprocessor(image) for image in images])
+    tensor = preprocessor.batch(images, validate=validate)
+    mad = float(np.abs(tensor - expected).mean())
+    record_property("mean_absolute_difference", mad)
+    print(f"{name} validate={validate} MAD={mad:.3g}")
+
+    assert tensor.shape == (len(images), 3, 224, 224) and tensor.dtype == np.float32
+    assert mad == 0
+
+
+def test_batch_validate():
+    preprocessor = Preprocessor()
+
+    for image in [np.full((32, 32, 3), -1, np.int16), np.full((32, 32, 3), np.nan)]:
+        with pytest.raises(ValueError):
+            preprocessor.batch([image], validate=True)
+    for image in [np.zeros((32, 32, 4), np.uint8), np.zeros((0, 32, 3), np.uint8)]:
+        with pytest.raises(ValueError):
+            preprocessor.batch([image])
+    with pytest.raises(TypeError):
+        preprocessor.batch([b"image"])
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_batch_reuses_tensor(workers: int, monkeypatch):
+    monkeypatch.setattr(clip, "PREPROCESS_WORKERS", workers)
+    preprocessor = Preprocessor()
+    images = batches["goose"]
+
+    expected = np.concatenate([preprocessor(image) for image in images])
+    tensor = preprocessor.batch(images)
+    assert np.array_equal(tensor, expected)
+    assert preprocessor.batch(images[:2]).base is tensor.base
+
+
+def test_preprocess_executor_after_fork(monkeypatch):
+    monkeypatch.setattr(clip, "PREPROCESS_WORKERS", 2)
+    executor = clip._get_preprocess_executor()
+    assert clip._get_preprocess_executor() is executor
+
+    # The threads of the parent do not exist in a forked child
+    monkeypatch.setattr(clip, "_preprocess_executor", (-1, executor))
+    assert clip._get_preprocess_executor() is not executor
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 20:10
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from hcaptcha_challenger.components.common import zero_shot, zero_shot_images
+from hcaptcha_challenger.components import zero_shot_image_classifier
+from hcaptcha_challenger.components.zero_shot_image_classifier import (
+    ZeroShotImageClassifier,
+    format_datalake,
+    register_pipline,
+    release_pipline,
+)
+from hcaptcha_challenger.onnx import clip
+from hcaptcha_challenger.onnx.clip import MossCLIP
+from hcaptcha_challenger.onnx.modelhub import Assets, DataLake, ModelHub
+
+this_dir = Path(__file__).parent
+images = [Image.open(p) for p in sorted(this_dir.joinpath("goose").glob("*.png"))]
+
+EMBEDDING_SIZE = 16
+VOCAB_SIZE = 49408
+
+
+def _export_clip(tmp_path: Path):
+    """
+    Tiny stand-ins of the CLIP towers:
+    visual [N, 3, 224, 224] -> pooled RGB @ W, textual [N, 77] -> mean token embedding
+    """
+    onnx = pytest.importorskip("onnx")
+    from onnx import helper, numpy_helper, TensorProto
+
+    rng = np.random.default_rng(2312)
+    visual = helper.make_graph(
+        [
+            helper.make_node("GlobalAveragePool", ["image"], ["pooled"]),
+            helper.make_node("Flatten", ["pooled"], ["flat"]),
+            helper.make_node("MatMul", ["flat", "w"], ["image_embeds"]),
+        ],
+        "visual",
+        [helper.make_tensor_value_info("image", TensorProto.FLOAT, ["N", 3, 224, 224])],
+        [helper.make_tensor_value_info("image_embeds", TensorProto.FLOAT, ["N", EMBEDDING_SIZE])],
+        [numpy_helper.from_array(rng.normal(size=(3, EMBEDDING_SIZE)).astype(np.float32), "w")],
+    )
+    textual = helper.make_graph(
+        [
+            helper.make_node("Gather", ["table", "input_ids"], ["tokens"]),
+            helper.make_node("ReduceMean", ["tokens"], ["text_embeds"], axes=[1], keepdims=0),
+        ],
+        "textual",
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT32, ["N", 77])],
+        [helper.make_tensor_value_info("text_embeds", TensorProto.FLOAT, ["N", EMBEDDING_SIZE])],
+        [
+            numpy_helper.from_array(
+                rng.normal(size=(VOCAB_SIZE, EMBEDDING_SIZE)).astype(np.float32), "table"
+            )
+        ],
+    )
+
+    paths = []
+    for graph in [visual, textual]:
+        model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+        model.ir_version = 8
+        paths.append(tmp_path.joinpath(f"{graph.name}.onnx"))
+        onnx.save(model, str(paths[-1]))
+    return paths
+
+
+class CountingSession:
+    def __init__(self, session):
+        self.session = session
+        self.runs = 0
+
+    def get_inputs(self):
+        return self.session.get_inputs()
+
+    def run(self, output_names, input_feed):
+        self.runs += 1
+        return self.session.run(output_names, input_feed)
+
+
+@pytest.fixture()
+def sessions(tmp_path: Path):
+    from onnxruntime import InferenceSession
+
+    visual_path, textual_path = _export_clip(tmp_path)
+    visual = InferenceSession(str(visual_path), providers=["CPUExecutionProvider"])
+    textual = CountingSession(
+        InferenceSession(str(textual_path), providers=["CPUExecutionProvider"])
+    )
+    clip._text_features.clear()
+    yield visual, textual
+    clip._text_features.clear()
+
+
+def legacy_predict(model: MossCLIP, image, candidate_labels):
+    """`MossCLIP.__call__` before the text features were prepared once"""
+    image_features = model.encode_image([image])
+    text_features = model.encode_text(candidate_labels)
+    image_features /= np.linalg.norm(image_features, axis=1, keepdims=True)
+    text_features /= np.linalg.norm(text_features, axis=1, keepdims=True)
+    text_probs = 100 * image_features @ text_features.T
+    text_probs = np.exp(text_probs) / np.sum(np.exp(text_probs), axis=1, keepdims=True)
+    return [
+        {"score": score, "label": label}
+        for score, label in sorted(zip(text_probs[0], candidate_labels), key=lambda x: -x[0])
+    ]
+
+
+def test_text_features_prepared_once(sessions):
+    visual, textual = sessions
+    model = MossCLIP.from_pluggable_model(visual, textual, textual_name="textual.onnx")
+    tool = ZeroShotImageClassifier.from_datalake(DataLake.from_challenge_prompt("duck"))
+
+    expected = [legacy_predict(model, image, tool.candidate_labels) for image in images]
+    textual.runs = 0
+    assert [tool(model, image) for image in images] == expected
+    assert textual.runs == 1
+
+    # A new pipeline of the same textual model, e.g. `register_pipline` of the next challenge
+    model_ = MossCLIP.from_pluggable_model(visual, textual, textual_name="textual.onnx")
+    tool_ = ZeroShotImageClassifier.from_datalake(DataLake.from_challenge_prompt("duck"))
+    assert tool_(model_, images[0]) == expected[0]
+    assert textual.runs == 1
+
+    # Labels changed in place are encoded again
+    tool_.candidate_labels.reverse()
+    tool_(model_, images[0])
+    assert textual.runs == 2
+
+    features = model.text_features(tool.candidate_labels)
+    assert not features.flags.writeable
+    with pytest.raises(ValueError):
+        features /= 2
+
+
+def test_text_features_unnamed(sessions):
+    visual, textual = sessions
+    model = MossCLIP.from_pluggable_model(visual, textual)
+    labels = ["This is a picture that looks like duck."]
+
+    features = model.text_features(labels)
+    assert np.array_equal(model.text_features(labels), features)
+    assert textual.runs == 2 and not clip._text_features
+
+
+def test_text_features_lru(sessions, monkeypatch):
+    visual, textual = sessions
+    model = MossCLIP.from_pluggable_model(visual, textual, textual_name="textual.onnx")
+    monkeypatch.setattr(clip, "TEXT_FEATURES_CACHE_SIZE", 2)
+
+    for label in ["duck", "goose", "duck", "swan"]:
+        model.text_features([label])
+    assert textual.runs == 3
+    assert [labels for _, labels in clip._text_features] == [("duck",), ("swan",)]
+
+
+def test_format_datalake_cached():
+    dl = DataLake(positive_labels=["duck"], raw_prompt="please click each image containing a goose")
+
+    positive_labels, candidate_labels = format_datalake(dl)
+    assert positive_labels == [
+        "This is a picture that looks like duck.",
+        "This is a picture that looks like goose.",
+    ]
+    assert candidate_labels[-1] == "This is a picture that don't look like goose."
+    assert dl.positive_labels == ["duck"] and dl.negative_labels == []
+
+    # Callers get lists of their own
+    positive_labels.clear()
+    assert format_datalake(dl) == (candidate_labels[:2], candidate_labels)
+
+
+def test_batch_matches_per_image(sessions):
+    visual, textual = sessions
+    visual = CountingSession(visual)
+    model = MossCLIP.from_pluggable_model(visual, textual, textual_name="textual.onnx")
+    tool = ZeroShotImageClassifier.from_datalake(DataLake.from_challenge_prompt("duck"))
+
+    expected = [legacy_predict(model, image, tool.candidate_labels) for image in images]
+    visual.runs = 0
+    scores = tool.batch(model, images)
+    assert scores.shape == (len(images), len(tool.candidate_labels))
+    assert visual.runs == 1
+
+    for row, predictions in zip(scores, expected):
+        ranked = tool.rank(row)
+        assert [r["label"] for r in ranked] == [p["label"] for p in predictions]
+        # Batched float32 pooling differs in the last bits, amplified by the logit scale
+        scores_ = [p["score"] for p in predictions]
+        assert np.allclose([r["score"] for r in ranked], scores_, atol=1e-4)
+
+    assert tool.batch(model, []).shape == (0, len(tool.candidate_labels))
+
+
+@pytest.fixture()
+def modelhub(sessions, tmp_path: Path) -> ModelHub:
+    modelhub = ModelHub()
+    modelhub.models_dir = tmp_path
+    modelhub.optimized_dir = tmp_path.joinpath("_optimized")
+    modelhub.assets = Assets(release_url="", _assets_dir=tmp_path, _memory_dir=tmp_path)
+    modelhub.verdict_cache_path = str(tmp_path.joinpath("verdicts.db"))
+    # The ONNX pipeline of `register_pipline` loads the models named after CLIP
+    for name in ["visual", "textual"]:
+        tmp_path.joinpath(f"{name}.onnx").rename(tmp_path.joinpath(f"clip_{name}.onnx"))
+    modelhub.DEFAULT_CLIP_VISUAL_MODEL = "clip_visual.onnx"
+    modelhub.DEFAULT_CLIP_TEXTUAL_MODEL = "clip_textual.onnx"
+    yield modelhub
+    release_pipline()
+
+
+def test_zero_shot_images(modelhub: ModelHub, tmp_path: Path, monkeypatch):
+    visual = modelhub.match_net("clip_visual.onnx")
+    textual = modelhub.match_net("clip_textual.onnx")
+    model = MossCLIP.from_pluggable_model(visual, textual, textual_name="clip_textual.onnx")
+    tool = ZeroShotImageClassifier.from_datalake(DataLake.from_challenge_prompt("duck"))
+
+    broken = tmp_path.joinpath("broken.png")
+    broken.write_bytes(b"not an image")
+    image_paths = sorted(this_dir.joinpath("goose").glob("*.png"))
+    expected = [zero_shot(tool, model, p, modelhub) for p in image_paths]
+    modelhub._verdicts = None
+    modelhub.verdict_cache_path = str(tmp_path.joinpath("batch.db"))
+
+    results = zero_shot_images(tool, model, image_paths + [broken], modelhub)
+    assert results[-1] is None
+    for actual, predictions in zip(results, expected):
+        assert [r["label"] for r in actual] == [p["label"] for p in predictions]
+        scores = [p["score"] for p in predictions]
+        assert np.allclose([r["score"] for r in actual], scores, atol=1e-4)
+    assert modelhub.verdict_stats.writes == len(image_paths)
+
+    def batch(detector, images_):
+        assert not images_, "Cached images must skip inference"
+        return np.zeros((0, len(tool.candidate_labels)))
+
+    monkeypatch.setattr(tool, "batch", batch)
+    assert zero_shot_images(tool, model, image_paths, modelhub) == results[:-1]
+    assert modelhub.verdict_stats.hits == len(image_paths)
+
+
+def test_zero_shot_textual_version(modelhub: ModelHub, monkeypatch):
+    visual = modelhub.match_net("clip_visual.onnx")
+    textual = modelhub.match_net("clip_textual.onnx")
+    model = MossCLIP.from_pluggable_model(visual, textual, textual_name="clip_textual.onnx")
+    tool = ZeroShotImageClassifier.from_datalake(DataLake.from_challenge_prompt("duck"))
+    image_paths = sorted(this_dir.joinpath("goose").glob("*.png"))
+
+    zero_shot_images(tool, model, image_paths, modelhub)
+    assert modelhub.verdict_stats.writes == len(image_paths)
+
+    # A new release of the textual model only, under the same file name
+    released = modelhub.model_version
+
+    def model_version(focus_name: str) -> str:
+        version = released(focus_name)
+        return f"{version}.new" if focus_name == "clip_textual.onnx" else version
+
+    monkeypatch.setattr(modelhub, "model_version", model_version)
+    zero_shot_images(tool, model, image_paths, modelhub)
+    assert zero_shot(tool, model, image_paths[0], modelhub)
+    assert modelhub.verdict_stats.hits == 1
+    assert modelhub.verdict_stats.writes == 2 * len(image_paths)
+
+
+def test_register_pipline_shared(modelhub: ModelHub):
+    model = register_pipline(modelhub, fmt="onnx")
+    assert register_pipline(modelhub, fmt="onnx") is model
+    assert modelhub._name2net.pinned == {"clip_visual.onnx", "clip_textual.onnx"}
+
+    # The sessions of a registered pipeline survive the cleanup after a challenge
+    modelhub.unplug(force=True)
+    assert register_pipline(modelhub, fmt="onnx") is model
+    assert modelhub.lookup_name(model.visual_session) == "clip_visual.onnx"
+
+    assert release_pipline(idle=3600) == 0
+    assert release_pipline(model) == 1
+    assert not modelhub._name2net.pinned
+    modelhub.unplug(force=True)
+    assert len(modelhub._name2net) == 0
+
+    model_ = register_pipline(modelhub, fmt="onnx")
+    assert model_ is not model
+    assert release_pipline(idle=0) == 1
+
+    # Sessions evicted behind the back of the registry are not served again
+    model = register_pipline(modelhub, fmt="onnx")
+    modelhub._name2net.clear(include_pinned=True)
+    assert register_pipline(modelhub, fmt="onnx") is not model
+
+
+def test_register_pipline_shared_pins(modelhub: ModelHub, tmp_path: Path):
+    shutil.copyfile(tmp_path.joinpath("clip_textual.onnx"), tmp_path.joinpath("clip_textual2.onnx"))
+    modelhub.pin("clip_textual.onnx")
+
+    model = register_pipline(modelhub, fmt="onnx")
+    model_ = register_pipline(modelhub, fmt="onnx", textual_model="clip_textual2.onnx")
+    assert model_ is not model
+    assert model_.visual_session is model.visual_session
+
+    # The visual model stays pinned for the other pipeline, the textual one for the caller
+    assert release_pipline(model) == 1
+    assert modelhub._name2net.pinned == {
+        "clip_visual.onnx",
+        "clip_textual.onnx",
+        "clip_textual2.onnx",
+    }
+    modelhub.unplug(force=True)
+    assert register_pipline(modelhub, fmt="onnx", textual_model="clip_textual2.onnx") is model_
+
+    assert release_pipline(model_) == 1
+    assert modelhub._name2net.pinned == {"clip_textual.onnx"}
+
+
+def test_register_pipline_builds_outside_lock(modelhub: ModelHub, tmp_path: Path, monkeypatch):
+    shutil.copyfile(tmp_path.joinpath("clip_textual.onnx"), tmp_path.joinpath("clip_textual2.onnx"))
+    create_pipline = zero_shot_image_classifier._create_pipline
+    building, resume = threading.Event(), threading.Event()
+
+    def slow_create_pipline(modelhub_, fmt, **kwargs):
+        if kwargs.get("textual_model") == "clip_textual2.onnx":
+            building.set()
+            assert resume.wait(timeout=30)
+        return create_pipline(modelhub_, fmt, **kwargs)
+
+    monkeypatch.setattr(zero_shot_image_classifier, "_create_pipline", slow_create_pipline)
+    slow = []
+    thread = threading.Thread(
+        target=lambda: slow.append(
+            register_pipline(modelhub, fmt="onnx", textual_model="clip_textual2.onnx")
+        )
+    )
+    thread.start()
+    try:
+        assert building.wait(timeout=30)
+        # Another pipeline registers while the first one is still being built
+        model = register_pipline(modelhub, fmt="onnx")
+        assert isinstance(model, MossCLIP)
+    finally:
+        resume.set()
+        thread.join()
+    assert isinstance(slow[0], MossCLIP)
+    assert register_pipline(modelhub, fmt="onnx", textual_model="clip_textual2.onnx") is slow[0]
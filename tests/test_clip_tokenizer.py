@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 21:40
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+import yaml
+
+from hcaptcha_challenger.onnx import clip
+from hcaptcha_challenger.onnx.clip import (
+    FastTokenizer,
+    Tokenizer,
+    compile_bpe,
+    default_bpe,
+    merges_path,
+)
+from hcaptcha_challenger.onnx.modelhub import DataLake
+
+this_dir = Path(__file__).parent
+project_dir = this_dir.parent
+
+
+def _corpus():
+    """Labels of objects.yaml and the prompts of tests, as they reach the textual model"""
+    data = yaml.safe_load(project_dir.joinpath("src/objects.yaml").read_text(encoding="utf8"))
+    labels = json.loads(this_dir.joinpath("prompts.json").read_text(encoding="utf8"))
+    for lang_to_prompts in data["label_alias"].values():
+        labels += [prompt for prompts in lang_to_prompts.values() for prompt in prompts]
+    labels += [name for names in data["ashes_of_war"].values() for name in names]
+    labels += [label for labels_ in data["clip_candidates"].values() for label in labels_]
+    for dl in data["datalake"].values():
+        labels += dl.get("positive_labels", []) + dl.get("negative_labels", [])
+
+    labels = list(dict.fromkeys(labels))
+    texts = labels + [DataLake.PREMISED_YES.format(label) for label in labels]
+    texts += [DataLake.PREMISED_BAD.format(label) for label in labels]
+    # Empty, truncated, special tokens, non-ASCII and HTML entities
+    texts += ["", " ".join(["goose"] * 100), "<|startoftext|> duck", "café 日本語 😀 &amp; ok"]
+    return texts
+
+
+corpus = _corpus()
+
+
+@pytest.fixture(scope="module", autouse=True)
+def bpe_cache_dir(tmp_path_factory) -> Path:
+    cache_dir = tmp_path_factory.mktemp("bpe_cache")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(clip, "BPE_CACHE_DIR", cache_dir)
+        yield cache_dir
+
+
+@pytest.fixture(scope="module")
+def bpe_path(tmp_path_factory) -> str:
+    bpe_path = tmp_path_factory.mktemp("bpe").joinpath(Path(default_bpe()).name)
+    bpe_path.write_bytes(Path(default_bpe()).read_bytes())
+    return str(bpe_path)
+
+
+@pytest.fixture(scope="module")
+def tokenizers(bpe_path: str):
+    return Tokenizer(bpe_path), FastTokenizer(bpe_path)
+
+
+def test_fast_tokenizer_matches(tokenizers):
+    reference, fast = tokenizers
+
+    expected = reference(corpus)
+    assert np.array_equal(fast(corpus), expected)
+    # Cached texts come back the same
+    assert np.array_equal(fast(corpus), expected)
+    assert fast(corpus).dtype == np.int32
+    assert np.array_equal(fast(corpus[0], context_length=16), reference(corpus[0], 16))
+    assert fast(corpus[:0]).shape == (0, 77)
+
+    for text in corpus[:100]:
+        tokens = reference.encode(text)
+        assert fast.encode(text) == tokens
+        assert fast.decode(tokens) == reference.decode(tokens)
+
+
+def test_fast_tokenizer_lru(tokenizers, bpe_path: str):
+    reference, _ = tokenizers
+    fast = FastTokenizer(bpe_path, cache_size=4)
+
+    assert np.array_equal(fast(corpus), reference(corpus))
+    assert len(fast._words) == 4 and len(fast._texts) == 4
+    assert list(fast._texts) == corpus[-4:]
+
+
+def test_compile_bpe(tmp_path: Path, bpe_cache_dir: Path):
+    bpe_path = tmp_path.joinpath(Path(default_bpe()).name)
+    bpe_path.write_bytes(Path(default_bpe()).read_bytes())
+
+    # The artifact is compiled into the cache dir on first use and read afterwards
+    FastTokenizer(str(bpe_path))
+    artifact_path = merges_path(str(bpe_path))
+    assert artifact_path.parent == bpe_cache_dir
+    assert artifact_path.exists()
+    assert not list(tmp_path.glob("*.merges"))
+    assert compile_bpe(str(bpe_path)) == artifact_path
+
+    artifact_path.write_text("#clip-bpe-merges v1 48894\na b", encoding="utf8")
+    assert len(FastTokenizer(str(bpe_path)).merge_ranks) == 48894
+    # The corrupted artifact is dropped and compiled again
+    assert not artifact_path.exists()
+    FastTokenizer(str(bpe_path))
+    assert artifact_path.exists()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/12 16:10
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.onnx.resnet import (
+    ResNetControl,
+    ChallengeStyle,
+    DENOISE_STRATEGIES,
+    denoise,
+)
+
+this_dir = Path(__file__).parent
+
+
+def _watermarked() -> bytes:
+    for image_path in sorted(this_dir.joinpath("goose").glob("*.png")):
+        img_stream = image_path.read_bytes()
+        img = cv2.imdecode(np.frombuffer(img_stream, np.uint8), flags=1)
+        if img.shape[0] == ChallengeStyle.WATERMARK:
+            return img_stream
+    pytest.skip("No watermarked sample")
+
+
+@pytest.mark.parametrize("strategy", DENOISE_STRATEGIES)
+def test_denoise_strategies(strategy: str):
+    img_stream = _watermarked()
+    img = cv2.imdecode(np.frombuffer(img_stream, np.uint8), flags=1)
+
+    denoised = denoise(img, strategy)
+    assert denoised.shape == (64, 64, 3)
+    assert denoised.dtype == np.uint8
+
+    preprocessed = ResNetControl.preprocess(img_stream, strategy)
+    assert np.array_equal(preprocessed, denoised)
+    # Watermarked images are denoised once per strategy
+    assert ResNetControl.preprocess(img_stream, strategy) is preprocessed
+
+
+def test_denoise_reference():
+    img_stream = _watermarked()
+    img = cv2.imdecode(np.frombuffer(img_stream, np.uint8), flags=1)
+
+    expected = cv2.resize(cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21), (64, 64))
+    assert np.array_equal(ResNetControl.preprocess(img_stream), expected)
+
+    with pytest.raises(ValueError):
+        denoise(img, "gaussian")
+
+
+def test_denoise_strategy_of_control(monkeypatch):
+    monkeypatch.setenv("RESNET_DENOISE_STRATEGY", "median")
+    assert ResNetControl.from_pluggable_model(None).denoise_strategy == "median"
+    monkeypatch.delenv("RESNET_DENOISE_STRATEGY")
+    assert ResNetControl.from_pluggable_model(None).denoise_strategy == "nlmeans"
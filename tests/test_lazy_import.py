@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/7 15:48
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import hcaptcha_challenger as solver
+
+project_dir = Path(__file__).parent.parent
+
+HEAVY_MODULES = ["cv2", "onnxruntime", "pydantic", "PIL", "ftfy", "sklearn", "skimage", "httpx"]
+
+
+def _loaded_after(code: str):
+    script = (
+        f"import sys, json\n{code}\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    output = subprocess.check_output([sys.executable, "-c", script], cwd=project_dir, text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_import_is_light():
+    assert _loaded_after("import hcaptcha_challenger") == []
+
+
+def test_prompt_handler_is_light():
+    code = "from hcaptcha_challenger import split_prompt_message, label_cleaning, handle"
+    assert _loaded_after(code) == []
+
+
+def test_lazy_attrs_resolve():
+    for name in solver.__all__:
+        assert getattr(solver, name) is not None
+    assert solver.BinaryClassifier.__name__ == "Classifier"
+    assert set(solver.__all__) <= set(dir(solver))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/9 16:31
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import multiprocessing
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.onnx.modelhub import ModelHub, Assets
+from hcaptcha_challenger.onnx.resnet import ResNetControl
+from hcaptcha_challenger.onnx.server import (
+    ModelServer,
+    ModelServerUnavailable,
+    RemoteNet,
+    RemoteSession,
+)
+
+this_dir = Path(__file__).parent
+
+
+def _modelhub(models_dir: Path, server_address: str = "") -> ModelHub:
+    modelhub = ModelHub(server_address=server_address)
+    modelhub.models_dir = models_dir
+    modelhub.optimized_dir = models_dir.joinpath("_optimized")
+    modelhub.assets = Assets(
+        release_url="", _assets_dir=models_dir, _memory_dir=models_dir.joinpath("_memory")
+    )
+    return modelhub
+
+
+@pytest.fixture()
+def models_dir(tmp_path: Path) -> Path:
+    shutil.copyfile(this_dir.joinpath("goose2309.onnx"), tmp_path.joinpath("goose2309.onnx"))
+    # Any name with `yolo` is served by onnxruntime
+    shutil.copyfile(this_dir.joinpath("goose2309.onnx"), tmp_path.joinpath("goose_yolov8n.onnx"))
+    return tmp_path
+
+
+def _serve(models_dir: Path, socket_path: Path):
+    ModelServer(_modelhub(models_dir), socket_path).serve_forever()
+
+
+@pytest.fixture()
+def server(models_dir: Path):
+    socket_path = models_dir.joinpath("modelhub.sock")
+    server = ModelServer(_modelhub(models_dir), socket_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield str(socket_path)
+    server.shutdown()
+    server.server_close()
+
+
+def test_remote_net(server: str, models_dir: Path):
+    local = _modelhub(models_dir)
+    remote = _modelhub(models_dir, server_address=server)
+
+    net = remote.match_net("goose2309.onnx")
+    assert isinstance(net, RemoteNet)
+
+    for image_path in sorted(this_dir.joinpath("goose").glob("*.png")):
+        image = image_path.read_bytes()
+        expected = ResNetControl.from_pluggable_model(local.match_net("goose2309.onnx"))
+        actual = ResNetControl.from_pluggable_model(net)
+        assert actual.execute(image, proba=True)[0] == expected.execute(image, proba=True)[0]
+
+    assert remote.match_net("missing.onnx") is None
+
+
+def test_remote_session(server: str, models_dir: Path):
+    local = _modelhub(models_dir).match_net("goose_yolov8n.onnx")
+    session = _modelhub(models_dir, server_address=server).match_net("goose_yolov8n.onnx")
+    assert isinstance(session, RemoteSession)
+    assert [i.name for i in session.get_inputs()] == [i.name for i in local.get_inputs()]
+
+    errors = []
+
+    def worker(seed: int):
+        rng = np.random.default_rng(seed)
+        try:
+            for _ in range(5):
+                feed = {"input.1": rng.random((1, 3, 64, 64), dtype=np.float32)}
+                expected = local.run(None, feed)
+                actual = session.run(None, feed)
+                np.testing.assert_allclose(actual[0], expected[0], rtol=1e-5)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+
+def test_unreachable_server_falls_back(models_dir: Path):
+    modelhub = _modelhub(models_dir, server_address=str(models_dir.joinpath("nowhere.sock")))
+    net = modelhub.match_net("goose2309.onnx")
+    assert net is not None
+    assert not isinstance(net, RemoteNet)
+
+
+def test_server_load_error_falls_back(models_dir: Path, tmp_path_factory):
+    # The server holds a broken copy of the model, the client a working one
+    server_dir = tmp_path_factory.mktemp("server")
+    server_dir.joinpath("goose2309.onnx").write_bytes(b"not an onnx graph")
+    socket_path = server_dir.joinpath("modelhub.sock")
+    server = ModelServer(_modelhub(server_dir), socket_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        net = _modelhub(models_dir, server_address=str(socket_path)).match_net("goose2309.onnx")
+        assert net is not None
+        assert not isinstance(net, RemoteNet)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_dead_server_falls_back(models_dir: Path):
+    socket_path = models_dir.joinpath("modelhub.sock")
+    process = multiprocessing.get_context("spawn").Process(
+        target=_serve, args=(models_dir, socket_path), daemon=True
+    )
+    process.start()
+    deadline = time.monotonic() + 60
+    while not socket_path.exists():
+        assert time.monotonic() < deadline and process.is_alive()
+        time.sleep(0.05)
+
+    modelhub = _modelhub(models_dir, server_address=str(socket_path))
+    remote = modelhub.match_net("goose_yolov8n.onnx")
+    assert isinstance(remote, RemoteSession)
+    feed = {"input.1": np.zeros((1, 3, 64, 64), dtype=np.float32)}
+    expected = remote.run(None, feed)
+
+    process.terminate()
+    process.join()
+
+    with pytest.raises(ModelServerUnavailable):
+        remote.run(None, feed)
+    assert "goose_yolov8n.onnx" not in modelhub._name2net
+
+    local = modelhub.match_net("goose_yolov8n.onnx")
+    assert local is not None
+    assert not isinstance(local, RemoteSession)
+    np.testing.assert_allclose(local.run(None, feed)[0], expected[0], rtol=1e-5)
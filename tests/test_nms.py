@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 15:10
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.onnx import utils
+from hcaptcha_challenger.onnx.utils import (
+    batched_nms,
+    decode_predictions,
+    multiclass_nms,
+    nms,
+    xywh2xyxy,
+)
+
+
+def _candidates(seed: int, n_objects: int = 12, per_object: int = 30, noise: int = 200):
+    """Clusters of jittered boxes around some objects plus scattered low score boxes"""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(40, 600, (n_objects, 2))
+    sizes = rng.uniform(16, 200, (n_objects, 2))
+
+    jitter = rng.normal(0, 0.1, (n_objects, per_object, 4))
+    xy = centers[:, None] + jitter[..., :2] * sizes[:, None]
+    wh = sizes[:, None] * (1 + jitter[..., 2:])
+    clustered = np.concatenate([xy, wh], axis=-1).reshape(-1, 4)
+    scattered = np.concatenate(
+        [rng.uniform(0, 640, (noise, 2)), rng.uniform(4, 120, (noise, 2))], axis=1
+    )
+    boxes = xywh2xyxy(np.concatenate([clustered, scattered]).astype(np.float32))
+
+    scores = np.concatenate(
+        [rng.uniform(0.3, 0.95, len(clustered)), rng.uniform(0.01, 0.3, noise)]
+    ).astype(np.float32)
+    class_ids = rng.integers(0, 5, len(scores))
+    return boxes, scores, class_ids
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("iou_threshold", [0.3, 0.5, 0.7])
+def test_batched_nms_matches_legacy(seed: int, iou_threshold: float, monkeypatch):
+    boxes, scores, class_ids = _candidates(seed)
+
+    expected = multiclass_nms(boxes, scores, class_ids, iou_threshold)
+    assert np.array_equal(batched_nms(boxes, scores, class_ids, iou_threshold), expected)
+
+    expected = nms(boxes, scores, iou_threshold)
+    assert np.array_equal(batched_nms(boxes, scores, None, iou_threshold), expected)
+
+    # A tile of a single row is the greedy loop of `nms`
+    monkeypatch.setattr(utils, "NMS_TILE", 1)
+    expected = multiclass_nms(boxes, scores, class_ids, iou_threshold)
+    assert np.array_equal(batched_nms(boxes, scores, class_ids, iou_threshold), expected)
+
+
+def test_batched_nms_degenerate_boxes():
+    boxes, scores, class_ids = _candidates(0, noise=20)
+    # Zero area boxes have an undefined IoU with each other, `nms` suppresses them
+    boxes[::7, 2:] = boxes[::7, :2]
+    with np.errstate(invalid="ignore"):
+        expected = multiclass_nms(boxes, scores, class_ids, 0.5)
+    assert np.array_equal(batched_nms(boxes, scores, class_ids, 0.5), expected)
+
+    assert batched_nms(boxes[:0], scores[:0], class_ids[:0], 0.5).size == 0
+    with pytest.raises(ValueError):
+        batched_nms(boxes, scores, class_ids, 0.5, backend="torchvision")
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_batched_nms_cv2(seed: int):
+    boxes, scores, class_ids = _candidates(seed)
+
+    expected = multiclass_nms(boxes, scores, class_ids, 0.5)
+    assert np.array_equal(batched_nms(boxes, scores, class_ids, 0.5, backend="cv2"), expected)
+
+
+def test_decode_predictions():
+    rng = np.random.default_rng(1)
+    num_classes, num_masks = 3, 8
+    output = rng.uniform(0, 1, (4 + num_classes + num_masks, 500)).astype(np.float32)
+
+    # The transposed decoding of `YOLOv8Seg.process_box_output`
+    predictions = output.T
+    scores = np.max(predictions[:, 4 : 4 + num_classes], axis=1)
+    predictions = predictions[scores > 0.5, :]
+
+    boxes, scores_, class_ids, extra = decode_predictions(output, 0.5, num_classes)
+    assert np.array_equal(boxes, predictions[:, :4])
+    assert np.array_equal(scores_, scores[scores > 0.5])
+    assert np.array_equal(class_ids, np.argmax(predictions[:, 4 : 4 + num_classes], axis=1))
+    assert np.array_equal(extra, predictions[:, 4 + num_classes :])
+
+    boxes = boxes.copy()
+    assert np.array_equal(xywh2xyxy(boxes.copy(), inplace=True), xywh2xyxy(boxes))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/7 10:26
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+import yaml
+
+from hcaptcha_challenger.onnx import modelhub as hub
+from hcaptcha_challenger.onnx.modelhub import ModelHub, load_objects
+
+project_dir = Path(__file__).parent.parent
+
+
+@pytest.fixture()
+def objects_path(tmp_path: Path) -> Path:
+    objects_path = tmp_path.joinpath("objects.yaml")
+    shutil.copyfile(project_dir.joinpath("src/objects.yaml"), objects_path)
+    return objects_path
+
+
+def _forbid_yaml(monkeypatch):
+    def load(*args, **kwargs):
+        raise AssertionError("objects.yaml was parsed again")
+
+    monkeypatch.setattr(hub.yaml, "load", load)
+
+
+def test_snapshot_roundtrip(objects_path: Path, monkeypatch):
+    data, router = load_objects(objects_path)
+    assert data == yaml.safe_load(objects_path.read_text(encoding="utf8"))
+    assert router.ashes_of_war is data["ashes_of_war"]
+    assert objects_path.with_name("objects.yaml.snapshot").exists()
+
+    _forbid_yaml(monkeypatch)
+    modelhub = ModelHub()
+    modelhub.objects_path = objects_path
+    modelhub.parse_objects()
+
+    assert modelhub.ashes_of_war == data["ashes_of_war"]
+    assert modelhub.label_alias
+    assert modelhub.datalake
+    # The router compiled into the snapshot is adopted as is
+    router = modelhub._router
+    assert router is not None
+    assert modelhub.router is router
+
+
+def test_snapshot_survives_rewrite_with_same_content(objects_path: Path, monkeypatch):
+    load_objects(objects_path)
+
+    # pull_objects downloads the same file again
+    objects_path.write_bytes(objects_path.read_bytes())
+    stat = objects_path.stat()
+    os.utime(objects_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    _forbid_yaml(monkeypatch)
+    data, _ = load_objects(objects_path)
+    assert data["ashes_of_war"]
+
+
+def test_snapshot_invalidated_by_new_content(objects_path: Path):
+    load_objects(objects_path)
+
+    objects_path.write_text(
+        objects_path.read_text(encoding="utf8") + "\ncircle_seg: new-seg.onnx\n", encoding="utf8"
+    )
+    data, _ = load_objects(objects_path)
+    assert data["circle_seg"] == "new-seg.onnx"
+
+
+def test_broken_snapshot_is_dropped(objects_path: Path):
+    objects_path.with_name("objects.yaml.snapshot").write_bytes(b"garbage")
+
+    data, router = load_objects(objects_path)
+    assert data["ashes_of_war"]
+    assert router.ashes_of_war is data["ashes_of_war"]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/10 14:40
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+from hcaptcha_challenger.onnx.modelhub import ModelHub, Assets
+from hcaptcha_challenger.onnx.prefork import spawn_workers, wait_workers
+from hcaptcha_challenger.onnx.resnet import ResNetControl
+from hcaptcha_challenger.onnx.yolo import YOLOv8
+
+this_dir = Path(__file__).parent
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+
+
+@pytest.fixture()
+def modelhub(tmp_path: Path) -> ModelHub:
+    shutil.copyfile(this_dir.joinpath("goose2309.onnx"), tmp_path.joinpath("goose2309.onnx"))
+    # Any name with `yolo` is served by onnxruntime
+    shutil.copyfile(this_dir.joinpath("goose2309.onnx"), tmp_path.joinpath("goose_yolov8n.onnx"))
+
+    modelhub = ModelHub()
+    modelhub.models_dir = tmp_path
+    modelhub.optimized_dir = tmp_path.joinpath("_optimized")
+    modelhub.assets = Assets(release_url="", _assets_dir=tmp_path, _memory_dir=tmp_path)
+    modelhub.label_alias = {"goose": "goose2309"}
+    modelhub.ashes_of_war = {"goose_yolov8n.onnx": ["goose"]}
+    modelhub.circle_segment_model = "appears_only_once_2309_yolov8s-seg.onnx"
+    return modelhub
+
+
+def test_enumerate_models(modelhub: ModelHub):
+    assert modelhub.enumerate_models(["resnet", "yolo"]) == [
+        "goose2309.onnx",
+        "goose_yolov8n.onnx",
+        "appears_only_once_2309_yolov8s-seg.onnx",
+    ]
+    assert modelhub.enumerate_models(downloaded_only=True) == [
+        "goose2309.onnx",
+        "goose_yolov8n.onnx",
+    ]
+
+
+def test_spawn_workers(modelhub: ModelHub, tmp_path: Path):
+    image = sorted(this_dir.joinpath("goose").glob("*.png"))[0].read_bytes()
+    expected = ResNetControl.from_pluggable_model(modelhub.active_net("goose2309.onnx")).execute(
+        image
+    )
+    modelhub.unplug(force=True)
+
+    def target(hub: ModelHub, index: int):
+        # The workers find the sessions of the parent in the pool
+        assert hub.pool_stats.misses == 2
+        resnet = ResNetControl.from_pluggable_model(hub.match_net("goose2309.onnx"))
+        session = hub.match_net("goose_yolov8n.onnx")
+        assert hub.pool_stats.misses == 2
+        assert session.get_inputs()[0].name == "input.1"
+        tmp_path.joinpath(f"{index}.txt").write_text(str(resnet.execute(image)))
+
+    pids = spawn_workers(target, 3, modelhub=modelhub)
+
+    assert list(wait_workers(pids).values()) == [0, 0, 0]
+    for index in range(3):
+        assert tmp_path.joinpath(f"{index}.txt").read_text() == str(expected)
+    assert modelhub.session_profile.intra_op_num_threads == 1
+    assert modelhub._name2net.pinned == {"goose2309.onnx", "goose_yolov8n.onnx"}
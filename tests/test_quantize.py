@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/8 14:52
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import shutil
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.onnx.modelhub import ModelHub
+from hcaptcha_challenger.onnx.quantize import QuantizePolicy, QuantizedVariant
+from hcaptcha_challenger.onnx.resnet import ResNetControl
+
+pytest.importorskip("onnx")
+
+this_dir = Path(__file__).parent
+FOCUS_NAME = "goose2309.onnx"
+
+
+def _blob(image_path: Path) -> np.ndarray:
+    img = cv2.resize(cv2.imread(str(image_path)), (64, 64))
+    return cv2.dnn.blobFromImage(img, 1 / 255.0, (64, 64), (0, 0, 0), swapRB=True, crop=False)
+
+
+@pytest.fixture()
+def modelhub(tmp_path: Path) -> ModelHub:
+    modelhub = ModelHub()
+    modelhub.models_dir = tmp_path
+    modelhub.quantized_dir = tmp_path.joinpath("_quantized")
+    shutil.copyfile(this_dir.joinpath(FOCUS_NAME), tmp_path.joinpath(FOCUS_NAME))
+    return modelhub
+
+
+def test_accuracy_gate(modelhub: ModelHub):
+    images = sorted(this_dir.joinpath("goose").glob("*.png"))
+    samples = [p.read_bytes() for p in images]
+    calibration = [{"input.1": _blob(p)} for p in images]
+
+    def predict(net, sample):
+        return ResNetControl.from_pluggable_model(net).execute(sample)
+
+    # cv2.dnn serves the ResNet binaries and only reads the QDQ graph of static INT8
+    dynamic = modelhub.check_quantized(FOCUS_NAME, "dynamic", samples, predict)
+    static = modelhub.check_quantized(
+        FOCUS_NAME, "static", samples, predict, calibration=calibration, threshold=0.8
+    )
+    assert not dynamic.approved
+    assert static.approved
+
+    variant_path = modelhub.quantized_dir.joinpath("goose2309.static.onnx")
+    assert variant_path.stat().st_size < modelhub.models_dir.joinpath(FOCUS_NAME).stat().st_size
+    assert modelhub.get_quantized_variant(FOCUS_NAME) == static
+
+    # The policy survives a restart
+    policy = QuantizePolicy.from_path(modelhub.quantized_dir.joinpath("policy.json"))
+    assert policy.select(FOCUS_NAME) == static
+
+    modelhub.use_quantized = False
+    assert modelhub.get_quantized_variant(FOCUS_NAME) is None
+
+
+def test_policy_select(tmp_path: Path):
+    policy = QuantizePolicy(path=tmp_path.joinpath("policy.json"))
+    policy.record(QuantizedVariant("a.onnx", "dynamic", "RA_1", agreement=0.97, samples=100))
+    assert policy.select("a.onnx", "RA_1") is None
+
+    policy.record(QuantizedVariant("a.onnx", "dynamic", "RA_1", agreement=0.99, samples=100))
+    policy.record(QuantizedVariant("a.onnx", "fp16", "RA_1", agreement=1.0, samples=100))
+    assert len(policy.variants["a.onnx"]) == 2
+    assert policy.select("a.onnx", "RA_1").mode == "fp16"
+
+    # A new release of the model invalidates its variants
+    assert policy.select("a.onnx", "RA_2") is None
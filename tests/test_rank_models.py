@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/13 10:24
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import itertools
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.components import common
+from hcaptcha_challenger.components.common import rank_models
+from hcaptcha_challenger.onnx.modelhub import ModelHub, Assets
+from hcaptcha_challenger.onnx.resnet import ResNetControl
+
+this_dir = Path(__file__).parent
+example_paths = sorted(this_dir.joinpath("goose").glob("*.png"))
+
+# Shift the logit of the positive class, so the nested models disagree with each other
+BIAS_SHIFTS = [-3.0, -1.0, 0.0, 0.5, 1.5, 3.0]
+
+
+def legacy_rank_models(nested_models: List[str], example_paths: List[Path], modelhub: ModelHub):
+    rank_ladder = []
+
+    for example_path in example_paths:
+        img_stream = example_path.read_bytes()
+        for model_name in reversed(nested_models):
+            if (net := modelhub.match_net(focus_name=model_name)) is None:
+                return
+            control = ResNetControl.from_pluggable_model(net)
+            result_, proba = control.execute(img_stream, proba=True)
+            if result_ and proba[0] > 0.68:
+                rank_ladder.append([control, model_name, proba])
+                if proba[0] > 0.87:
+                    break
+
+    if rank_ladder:
+        alts = sorted(rank_ladder, key=lambda x: x[-1][0], reverse=True)
+        best_model, model_name = alts[0][0], alts[0][1]
+        return best_model, model_name
+
+
+@pytest.fixture()
+def modelhub(tmp_path: Path) -> ModelHub:
+    onnx = pytest.importorskip("onnx")
+    from onnx import numpy_helper
+
+    for i, shift in enumerate(BIAS_SHIFTS):
+        model = onnx.load(str(this_dir.joinpath("goose2309.onnx")))
+        for tensor in model.graph.initializer:
+            if tensor.name == "fc.bias":
+                bias = numpy_helper.to_array(tensor).copy()
+                bias[0] += shift
+                tensor.CopyFrom(numpy_helper.from_array(bias, tensor.name))
+        onnx.save(model, str(tmp_path.joinpath(f"nested_{i}.onnx")))
+
+    modelhub = ModelHub()
+    modelhub.models_dir = tmp_path
+    modelhub.optimized_dir = tmp_path.joinpath("_optimized")
+    modelhub.assets = Assets(release_url="", _assets_dir=tmp_path, _memory_dir=tmp_path)
+    return modelhub
+
+
+@pytest.fixture(autouse=True)
+def rank_memo():
+    common._rank_memo.clear()
+    yield common._rank_memo
+    common._rank_memo.clear()
+
+
+def test_rank_models_legacy(modelhub: ModelHub, rank_memo):
+    models = [f"nested_{i}.onnx" for i in range(len(BIAS_SHIFTS))]
+    rng = np.random.default_rng(2309)
+
+    cases = [(models, example_paths[:k]) for k in range(len(example_paths) + 1)]
+    cases += [(list(p), example_paths[:3]) for p in itertools.permutations(models[:4])]
+    cases += [(models, list(rng.permutation(example_paths))) for _ in range(5)]
+    cases += [(models[i : i + 2], example_paths) for i in range(len(models) - 1)]
+
+    winners = set()
+    for nested_models, examples in cases:
+        rank_memo.clear()
+        expected = legacy_rank_models(nested_models, examples, modelhub)
+        actual = rank_models(nested_models, examples, modelhub)
+        if expected is None:
+            assert actual is None
+            continue
+        assert actual[1] == expected[1], (nested_models, examples)
+        assert isinstance(actual[0], ResNetControl)
+        winners.add(actual[1])
+
+    # The cases exercise the ladder, not a single dominant model
+    assert len(winners) > 1
+
+
+def test_rank_models_memo(modelhub: ModelHub, rank_memo, monkeypatch):
+    models = [f"nested_{i}.onnx" for i in range(len(BIAS_SHIFTS))]
+
+    expected = rank_models(models, example_paths, modelhub, label="goose")
+    assert len(rank_memo) == 1
+
+    def ladder(*args, **kwargs):
+        raise AssertionError("Repeated examples must skip the ranking")
+
+    monkeypatch.setattr(common, "_rank_ladder", ladder)
+    actual = rank_models(models, example_paths, modelhub, label="goose")
+    assert actual[1] == expected[1]
+
+    # Another label or other examples are ranked again
+    with pytest.raises(AssertionError):
+        rank_models(models, example_paths, modelhub, label="duck")
+    with pytest.raises(AssertionError):
+        rank_models(models, example_paths[1:], modelhub, label="goose")
+
+
+def test_rank_models_missing_model(modelhub: ModelHub, rank_memo, monkeypatch):
+    monkeypatch.setattr(modelhub, "pull_model", lambda focus_name: None)
+    models = ["nested_0.onnx", "missing.onnx"]
+
+    assert rank_models(models, example_paths, modelhub) is None
+    assert legacy_rank_models(models, example_paths, modelhub) is None
+    # A model that is not available yet is not remembered as a loser
+    assert not rank_memo
+
+
+def test_rank_models_memo_versions(modelhub: ModelHub, rank_memo, monkeypatch):
+    models = [f"nested_{i}.onnx" for i in range(len(BIAS_SHIFTS))]
+    rank_models(models, example_paths, modelhub, label="goose")
+
+    def ladder(*args, **kwargs):
+        raise AssertionError("Stale rankings must not be served")
+
+    monkeypatch.setattr(common, "_rank_ladder", ladder)
+    rank_models(models, example_paths, modelhub, label="goose")
+
+    # Another denoise strategy ranks again
+    monkeypatch.setenv("RESNET_DENOISE_STRATEGY", "median")
+    with pytest.raises(AssertionError):
+        rank_models(models, example_paths, modelhub, label="goose")
+    monkeypatch.delenv("RESNET_DENOISE_STRATEGY")
+
+    # So does a new release or quantized variant of one of the models
+    released = modelhub.model_version
+
+    def model_version(focus_name: str) -> str:
+        version = released(focus_name)
+        return f"{version}.int8" if focus_name == models[0] else version
+
+    monkeypatch.setattr(modelhub, "model_version", model_version)
+    with pytest.raises(AssertionError):
+        rank_models(models, example_paths, modelhub, label="goose")
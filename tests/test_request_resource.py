@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/4 20:17
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from hcaptcha_challenger.onnx.modelhub import request_resource
+
+PAYLOAD = os.urandom(300_000)
+CHUNK_SIZE = 64 * 1024
+
+
+class ModelHandler(BaseHTTPRequestHandler):
+    accept_ranges = True
+    requested_ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        range_header = self.headers.get("Range", "")
+        if self.accept_ranges and range_header.startswith("bytes="):
+            start, end = (int(i) for i in range_header[len("bytes=") :].split("-"))
+            end = min(end, len(PAYLOAD) - 1)
+            self.requested_ranges.append((start, end))
+            body = PAYLOAD[start : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(PAYLOAD)}")
+            self.send_header("Accept-Ranges", "bytes")
+        else:
+            body = PAYLOAD
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"model-v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture()
+def server():
+    ModelHandler.accept_ranges = True
+    ModelHandler.requested_ranges = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ModelHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}/model.onnx"
+    httpd.shutdown()
+
+
+def test_parallel_range_download(server: str, tmp_path: Path):
+    save_path = tmp_path.joinpath("model.onnx")
+    sha256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+    result = request_resource(server, save_path, sha256=sha256, chunk_size=CHUNK_SIZE)
+
+    assert result == save_path
+    assert save_path.read_bytes() == PAYLOAD
+    assert not list(tmp_path.glob("*.part*"))
+
+
+def test_resume_partial_download(server: str, tmp_path: Path):
+    save_path = tmp_path.joinpath("model.onnx")
+    part_path = tmp_path.joinpath("model.onnx.part")
+
+    # The first two chunks survived an interrupted download
+    part_path.write_bytes(PAYLOAD[: 2 * CHUNK_SIZE].ljust(len(PAYLOAD), b"\0"))
+    state = {
+        "url": server,
+        "total": len(PAYLOAD),
+        "etag": '"model-v1"',
+        "chunk_size": CHUNK_SIZE,
+        "done": [0, 1],
+    }
+    tmp_path.joinpath("model.onnx.part.json").write_text(json.dumps(state))
+
+    request_resource(server, save_path, chunk_size=CHUNK_SIZE)
+
+    assert save_path.read_bytes() == PAYLOAD
+    fetched = {start for start, _ in ModelHandler.requested_ranges}
+    assert 0 in fetched  # the size probe
+    assert CHUNK_SIZE not in fetched
+
+
+def test_checksum_mismatch(server: str, tmp_path: Path):
+    save_path = tmp_path.joinpath("model.onnx")
+
+    result = request_resource(server, save_path, sha256="0" * 64, chunk_size=CHUNK_SIZE)
+
+    assert result is None
+    assert not save_path.exists()
+    assert not tmp_path.joinpath("model.onnx.part").exists()
+
+
+def test_server_without_range_support(server: str, tmp_path: Path):
+    ModelHandler.accept_ranges = False
+    save_path = tmp_path.joinpath("model.onnx")
+    sha256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+    assert request_resource(server, save_path, sha256=sha256) == save_path
+    assert save_path.read_bytes() == PAYLOAD
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/11 15:20
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import os
+import shutil
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.onnx import batching
+from hcaptcha_challenger.onnx import modelhub as modelhub_module
+from hcaptcha_challenger.onnx.batching import batch_name
+from hcaptcha_challenger.onnx.modelhub import ModelHub, Assets
+from hcaptcha_challenger.onnx.resnet import ResNetControl
+
+this_dir = Path(__file__).parent
+model_path = this_dir.joinpath("goose2309.onnx")
+images = [p.read_bytes() for p in sorted(this_dir.joinpath("goose").glob("*.png"))]
+
+
+@pytest.fixture()
+def modelhub(tmp_path: Path) -> ModelHub:
+    shutil.copyfile(model_path, tmp_path.joinpath("goose2309.onnx"))
+
+    modelhub = ModelHub()
+    modelhub.models_dir = tmp_path
+    modelhub.optimized_dir = tmp_path.joinpath("_optimized")
+    modelhub.assets = Assets(release_url="", _assets_dir=tmp_path, _memory_dir=tmp_path)
+    return modelhub
+
+
+def _reference(proba: bool = False):
+    control = ResNetControl.from_pluggable_model(cv2.dnn.readNetFromONNX(str(model_path)))
+    return [control.execute(image, proba=proba) for image in images]
+
+
+def _assert_same(results, expected):
+    assert len(results) == len(expected)
+    for (prediction, confidence), (prediction_, confidence_) in zip(results, expected):
+        assert prediction is prediction_
+        assert np.allclose(confidence, confidence_, atol=1e-5)
+
+
+def test_execute_batch(modelhub: ModelHub):
+    pytest.importorskip("onnx")
+
+    control = ResNetControl.from_pluggable_model(modelhub.match_net("goose2309.onnx"))
+    assert modelhub.optimized_dir.joinpath(batch_name(model_path)).exists()
+
+    _assert_same(control.execute_batch(images, proba=True), _reference(proba=True))
+    assert control._batchable
+    assert control.execute_batch(images) == _reference()
+    assert control.execute_batch(images[:1]) == _reference()[:1]
+
+
+def test_execute_batch_fallback():
+    # Exported with a fixed batch size of 1
+    control = ResNetControl.from_pluggable_model(cv2.dnn.readNetFromONNX(str(model_path)))
+
+    _assert_same(control.execute_batch(images, proba=True), _reference(proba=True))
+    assert not control._batchable
+
+
+def test_unbatchable_net_is_remembered(modelhub: ModelHub, monkeypatch):
+    # Served without a batch copy, e.g. the export failed
+    modelhub.batch_resnet = False
+    modelhub.resnet_backend = "cv2"
+    net = modelhub.match_net("goose2309.onnx")
+    ResNetControl.from_pluggable_model(net).execute_batch(images)
+    assert batching.is_unbatchable(net)
+
+    # The control of the next challenge skips the batched forward pass
+    forward = ResNetControl._forward
+    batch_sizes = []
+
+    def counting_forward(self, images_):
+        batch_sizes.append(len(images_))
+        return forward(self, images_)
+
+    monkeypatch.setattr(ResNetControl, "_forward", counting_forward)
+    control = ResNetControl.from_pluggable_model(net)
+    assert not control._batchable
+    _assert_same(control.execute_batch(images, proba=True), _reference(proba=True))
+    assert set(batch_sizes) == {1}
+
+    # Released once the net leaves the pool
+    modelhub.unplug(force=True)
+    assert not batching.is_unbatchable(net)
+
+
+def test_execute_batch_broken_images(modelhub: ModelHub):
+    control = ResNetControl.from_pluggable_model(modelhub.match_net("goose2309.onnx"))
+
+    results = control.execute_batch([b"", images[0], b"not an image", images[1]])
+    assert results == [None, *_reference()[:1], None, *_reference()[1:2]]
+    assert control.execute_batch([]) == []
+
+
+def test_failed_batch_export_is_remembered(modelhub: ModelHub, monkeypatch):
+    exports = []
+
+    def export_dynamic_batch(model_path_, batch_path, **kwargs):
+        exports.append(model_path_)
+        raise ValueError("Batch copy disagrees with the original model")
+
+    monkeypatch.setattr(modelhub_module, "export_dynamic_batch", export_dynamic_batch)
+    local_path = modelhub.models_dir.joinpath("goose2309.onnx")
+    assert modelhub._get_batch_model(local_path) == local_path
+    failed_path = modelhub.optimized_dir.joinpath("goose2309.batch.failed")
+    assert failed_path.exists()
+
+    # Reloads after an eviction do not export again
+    assert modelhub._get_batch_model(local_path) == local_path
+    assert len(exports) == 1
+
+    # A new release of the model is tried again
+    mtime = failed_path.stat().st_mtime
+    os.utime(local_path, (mtime + 10, mtime + 10))
+    assert modelhub._get_batch_model(local_path) == local_path
+    assert len(exports) == 2
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/6 22:05
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import json
+import random
+import shutil
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from hcaptcha_challenger import split_prompt_message, label_cleaning
+from hcaptcha_challenger.onnx.modelhub import ModelHub, DEFAULT_KEYPOINT_MODEL
+from hcaptcha_challenger.onnx.routing import Automaton
+from hcaptcha_challenger.onnx.yolo import is_matched_ash_of_war
+
+project_dir = Path(__file__).parent.parent
+
+prompts: List[str] = json.loads(project_dir.joinpath("tests/prompts.json").read_text("utf8"))
+
+
+@pytest.fixture(scope="module")
+def modelhub(tmp_path_factory):
+    objects_path = tmp_path_factory.mktemp("objects").joinpath("objects.yaml")
+    shutil.copyfile(project_dir.joinpath("src/objects.yaml"), objects_path)
+
+    modelhub = ModelHub()
+    modelhub.objects_path = objects_path
+    modelhub.parse_objects()
+    return modelhub
+
+
+def legacy_apply_ash_of_war(modelhub: ModelHub, ash: str):
+    if "head of " in ash and "animal" in ash:
+        for model_name, covered_class in modelhub.ashes_of_war.items():
+            if "head" not in model_name:
+                continue
+            for class_name in covered_class:
+                if class_name.replace("-head", "") in ash:
+                    return model_name, covered_class
+
+    for model_name, covered_class in modelhub.ashes_of_war.items():
+        for class_name in covered_class:
+            if class_name in ash:
+                return model_name, covered_class
+
+    return DEFAULT_KEYPOINT_MODEL, modelhub.ashes_of_war[DEFAULT_KEYPOINT_MODEL]
+
+
+def legacy_lookup_ash_of_war(modelhub: ModelHub, ash: str):
+    if "can be eaten" in ash:
+        for model_name, covered_class in modelhub.ashes_of_war.items():
+            if "can_be_eaten" in model_name:
+                yield model_name, covered_class
+
+    if "not an animal" in ash:
+        for model_name, covered_class in modelhub.ashes_of_war.items():
+            if "notanimal" in model_name:
+                yield model_name, covered_class
+
+    if "head of " in ash and "animal" in ash:
+        for model_name, covered_class in modelhub.ashes_of_war.items():
+            if "head" in model_name:
+                yield model_name, covered_class
+
+    if "animal" in ash and "not belong to the sea" in ash:
+        for model_name, covered_class in modelhub.ashes_of_war.items():
+            if (
+                "notseaanimal" in model_name
+                or "fantasia_elephant" in model_name
+                or "fantasia_cat" in model_name
+            ):
+                yield model_name, covered_class
+
+    for model_name, covered_class in modelhub.ashes_of_war.items():
+        binder = model_name.split("_")
+        if len(binder) > 2 and binder[-2].isdigit():
+            binder = " ".join(model_name.split("_")[:-2])
+            if binder in ash:
+                yield model_name, covered_class
+        else:
+            for class_name in covered_class:
+                if class_name in ash:
+                    yield model_name, covered_class
+
+
+def legacy_match_clip_candidates(modelhub: ModelHub, label: str):
+    for ket in reversed(modelhub.clip_candidates.keys()):
+        if ket in label:
+            candidates = modelhub.clip_candidates[ket]
+            if candidates and len(candidates) > 2:
+                return ket
+
+
+def _asks() -> List[str]:
+    asks = []
+    for prompt in prompts:
+        asks.append(prompt)
+        asks.append(label_cleaning(split_prompt_message(prompt, lang="en")))
+    return asks
+
+
+@pytest.mark.parametrize("ash", _asks())
+def test_router_equivalence(modelhub: ModelHub, ash: str):
+    router = modelhub.router
+
+    assert router.apply(ash) == legacy_apply_ash_of_war(modelhub, ash)
+    assert router.lookup(ash) == list(legacy_lookup_ash_of_war(modelhub, ash))
+    assert router.is_matched(ash) == any(is_matched_ash_of_war(ash, c) for c in modelhub.yolo_names)
+    assert router.match_clip_candidates(ash) == legacy_match_clip_candidates(modelhub, ash)
+
+
+def test_router_follows_objects(modelhub: ModelHub):
+    router = modelhub.router
+    assert modelhub.router is router
+
+    modelhub.clip_candidates = {**modelhub.clip_candidates, "xylophone": ["a", "b", "c"]}
+    assert modelhub.router is not router
+    assert modelhub.router.match_clip_candidates("please click on the xylophone") == "xylophone"
+
+
+def test_automaton_against_substring_scan():
+    rand = random.Random(2309)
+    for _ in range(200):
+        patterns = ["".join(rand.choices("abc", k=rand.randint(0, 4))) for _ in range(8)]
+        text = "".join(rand.choices("abc", k=rand.randint(0, 30)))
+
+        automaton = Automaton()
+        ids = {p: automaton.add(p) for p in patterns}
+        automaton.build()
+
+        assert automaton.search(text) == {ids[p] for p in patterns if p in text}
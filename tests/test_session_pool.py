@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/2 16:20
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import pytest
+
+from hcaptcha_challenger.onnx.pool import SessionPool
+
+MiB = 1024 * 1024
+
+
+def test_lru_eviction():
+    pool = SessionPool(budget=100 * MiB, policy="lru")
+    pool.put("a.onnx", object(), size=40 * MiB)
+    pool.put("b.onnx", object(), size=40 * MiB)
+    assert pool.get("a.onnx") is not None
+
+    # `b` is the least recently used session
+    pool.put("c.onnx", object(), size=40 * MiB)
+    assert "a.onnx" in pool
+    assert "b.onnx" not in pool
+    assert "c.onnx" in pool
+    assert pool.stats.evictions == 1
+
+
+def test_lfu_eviction():
+    pool = SessionPool(budget=100 * MiB, policy="lfu")
+    pool.put("a.onnx", object(), size=40 * MiB)
+    pool.put("b.onnx", object(), size=40 * MiB)
+    for _ in range(3):
+        pool.get("a.onnx")
+    pool.get("b.onnx")
+    pool.put("c.onnx", object(), size=40 * MiB)
+    assert "a.onnx" in pool
+    assert "b.onnx" not in pool
+
+
+def test_pinned_sessions_survive():
+    pool = SessionPool(budget=50 * MiB)
+    pool.put("clip.onnx", object(), size=40 * MiB)
+    pool.pin("clip.onnx")
+    pool.put("yolo.onnx", object(), size=40 * MiB)
+    assert "clip.onnx" in pool
+    assert "yolo.onnx" in pool
+
+    pool.trim()
+    assert "clip.onnx" in pool
+    assert "yolo.onnx" not in pool
+
+    pool.unpin("clip.onnx")
+    pool.clear()
+    assert len(pool) == 0
+
+
+def test_pins_are_counted():
+    pool = SessionPool(budget=0)
+    pool.pin("clip.onnx")
+    pool.pin("clip.onnx")
+    pool.put("clip.onnx", object(), size=MiB)
+
+    pool.unpin("clip.onnx")
+    assert pool.pinned == {"clip.onnx"}
+    pool.trim()
+    assert "clip.onnx" in pool
+
+    pool.unpin("clip.onnx")
+    pool.unpin("clip.onnx")
+    assert not pool.pinned
+    pool.trim()
+    assert "clip.onnx" not in pool
+
+
+def test_stats():
+    pool = SessionPool()
+    assert pool.get("missing.onnx") is None
+    pool.put("a.onnx", object(), size=MiB)
+    pool.get("a.onnx")
+    pool.get("a.onnx")
+    assert (pool.stats.hits, pool.stats.misses) == (2, 1)
+    assert pool.stats.hit_rate == pytest.approx(2 / 3)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/3 14:20
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import onnxruntime
+import pytest
+
+from hcaptcha_challenger.onnx import options
+from hcaptcha_challenger.onnx.options import SessionProfile
+
+this_dir = Path(__file__).parent
+FOCUS_NAME = "goose2309.onnx"
+
+
+@pytest.fixture()
+def model_path(tmp_path: Path) -> Path:
+    model_path = tmp_path.joinpath(FOCUS_NAME)
+    shutil.copyfile(this_dir.joinpath(FOCUS_NAME), model_path)
+    return model_path
+
+
+def _run(session) -> np.ndarray:
+    arg = session.get_inputs()[0]
+    blob = np.random.default_rng(0).random((1, 3, 64, 64), dtype=np.float32)
+    return session.run(None, {arg.name: blob})[0]
+
+
+def test_cache_round_trip(model_path: Path):
+    profile = SessionProfile(providers=["CPUExecutionProvider"])
+    cache_name = profile.cache_name(FOCUS_NAME, "node1")
+    assert cache_name == profile.cache_name(FOCUS_NAME, "node1")
+    assert cache_name.startswith(f"{FOCUS_NAME}.node1.") and cache_name.endswith(".ort")
+    cache_path = model_path.parent.joinpath("_optimized", cache_name)
+
+    expected = _run(profile.create_session(model_path))
+    assert np.allclose(_run(profile.create_session(model_path, cache_path=cache_path)), expected)
+    assert cache_path.stat().st_size
+    mtime = cache_path.stat().st_mtime_ns
+
+    # Read back without optimizing and saving again
+    assert np.allclose(_run(profile.create_session(model_path, cache_path=cache_path)), expected)
+    assert cache_path.stat().st_mtime_ns == mtime
+    assert not list(cache_path.parent.glob("*.tmp"))
+
+
+def test_cache_keeps_other_profiles(model_path: Path):
+    cache_dir = model_path.parent.joinpath("_optimized")
+    profile = SessionProfile(providers=["CPUExecutionProvider"])
+    other = SessionProfile(providers=["CPUExecutionProvider"], graph_optimization_level="basic")
+    assert profile.cache_name(FOCUS_NAME, "node1") != other.cache_name(FOCUS_NAME, "node1")
+
+    old_path = cache_dir.joinpath(profile.cache_name(FOCUS_NAME, "node1"))
+    other_path = cache_dir.joinpath(other.cache_name(FOCUS_NAME, "node1"))
+    profile.create_session(model_path, cache_path=old_path)
+    other.create_session(model_path, cache_path=other_path)
+    assert old_path.exists() and other_path.exists()
+
+    # A new release of the model replaces the graph of the same profile only
+    new_path = cache_dir.joinpath(profile.cache_name(FOCUS_NAME, "node2"))
+    profile.create_session(model_path, cache_path=new_path)
+    assert new_path.exists() and other_path.exists()
+    assert not old_path.exists()
+
+
+def test_cache_of_replaced_local_model(model_path: Path):
+    profile = SessionProfile(providers=["CPUExecutionProvider"])
+    cache_dir = model_path.parent.joinpath("_optimized")
+    old_path = cache_dir.joinpath(profile.cache_name(FOCUS_NAME, "", model_path))
+    assert old_path.name.startswith(f"{FOCUS_NAME}.local-")
+    profile.create_session(model_path, cache_path=old_path)
+    assert old_path.exists()
+
+    # Another model file under the same name, without a release node_id
+    stat = model_path.stat()
+    os.utime(model_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    new_path = cache_dir.joinpath(profile.cache_name(FOCUS_NAME, "", model_path))
+    assert new_path != old_path
+    profile.create_session(model_path, cache_path=new_path)
+    assert new_path.exists() and not old_path.exists()
+
+
+def test_broken_cache_is_dropped(model_path: Path):
+    profile = SessionProfile(providers=["CPUExecutionProvider"])
+    cache_path = model_path.parent.joinpath(profile.cache_name(FOCUS_NAME, "node1"))
+    cache_path.write_bytes(b"not an ORT graph")
+
+    expected = _run(profile.create_session(model_path))
+    assert np.allclose(_run(profile.create_session(model_path, cache_path=cache_path)), expected)
+    # Optimized and saved again in place of the broken graph
+    assert cache_path.read_bytes() != b"not an ORT graph"
+    profile.create_session(model_path, cache_path=cache_path)
+
+
+def test_failed_save_falls_back(model_path: Path, monkeypatch):
+    profile = SessionProfile(providers=["CPUExecutionProvider"])
+    cache_path = model_path.parent.joinpath(profile.cache_name(FOCUS_NAME, "node1"))
+    expected = _run(profile.create_session(model_path))
+
+    def create(path, sess_options=None, **kwargs):
+        if sess_options is not None and sess_options.optimized_model_filepath:
+            raise RuntimeError("graphs over 2GB cannot be serialized in ORT format")
+        return onnxruntime.InferenceSession(path, sess_options, **kwargs)
+
+    monkeypatch.setattr(options, "InferenceSession", create)
+    session = profile.create_session(model_path, cache_path=cache_path)
+    assert np.allclose(_run(session), expected)
+    assert not cache_path.exists()
+    assert not list(cache_path.parent.glob("*.tmp"))
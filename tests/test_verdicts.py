@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/13 15:20
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import multiprocessing
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.components.common import classify_images
+from hcaptcha_challenger.onnx import verdicts
+from hcaptcha_challenger.onnx.modelhub import ModelHub, Assets
+from hcaptcha_challenger.onnx.resnet import ResNetControl
+from hcaptcha_challenger.onnx.verdicts import VerdictCache, image_digest
+
+this_dir = Path(__file__).parent
+images = [p.read_bytes() for p in sorted(this_dir.joinpath("goose").glob("*.png"))]
+
+
+@pytest.fixture()
+def modelhub(tmp_path: Path) -> ModelHub:
+    shutil.copyfile(this_dir.joinpath("goose2309.onnx"), tmp_path.joinpath("goose2309.onnx"))
+
+    modelhub = ModelHub()
+    modelhub.models_dir = tmp_path
+    modelhub.optimized_dir = tmp_path.joinpath("_optimized")
+    modelhub.assets = Assets(release_url="", _assets_dir=tmp_path, _memory_dir=tmp_path)
+    modelhub.verdict_cache_path = str(tmp_path.joinpath("verdicts.db"))
+    return modelhub
+
+
+def test_verdict_round_trip(tmp_path: Path):
+    cache = VerdictCache(tmp_path.joinpath("verdicts.db"))
+    digest = image_digest(images[0])
+
+    assert cache.get(digest, "yolo.onnx", "1", "goose", "point") is None
+    detections = [("goose", (np.float32(10.5), 20), np.float32(0.9))]
+    cache.put(digest, "yolo.onnx", "1", "goose", "point", detections)
+
+    [(name, (x, y), score)] = cache.get(digest, "yolo.onnx", "1", "goose", "point")
+    assert (name, x, y) == ("goose", 10.5, 20)
+    assert score == pytest.approx(0.9)
+    # Another model version, prompt or kind is another verdict
+    assert cache.get(digest, "yolo.onnx", "2", "goose", "point") is None
+    assert cache.get(digest, "yolo.onnx", "1", "duck", "point") is None
+    assert cache.get(digest, "yolo.onnx", "1", "goose", "bounding_box") is None
+
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.writes) == (1, 4, 1)
+    assert cache.stats.hit_rate == pytest.approx(0.2)
+
+
+def test_verdict_eviction(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(verdicts, "EVICT_EVERY", 1)
+    cache = VerdictCache(tmp_path.joinpath("verdicts.db"), budget=4096)
+
+    value = [True, [0.9] * 32]
+    for i in range(200):
+        cache.put(f"{i:032x}", "goose.onnx", "1", "", "resnet", value)
+        # Keep the first verdict warm
+        cache.get(f"{0:032x}", "goose.onnx", "1", "", "resnet")
+
+    assert cache.nbytes() <= cache.budget
+    assert cache.stats.evictions > 0
+    assert len(cache) < 200
+    assert cache.get(f"{0:032x}", "goose.onnx", "1", "", "resnet") is not None
+    assert cache.get(f"{1:032x}", "goose.onnx", "1", "", "resnet") is None
+
+
+def _writer(path: str, worker: int):
+    cache = VerdictCache(path)
+    for i in range(50):
+        cache.put(f"{worker}-{i}", "goose.onnx", "1", "", "resnet", [bool(i % 2), [0.5, 0.5]])
+        assert cache.get(f"{worker}-{i}", "goose.onnx", "1", "", "resnet") is not None
+
+
+def test_verdict_processes(tmp_path: Path):
+    path = str(tmp_path.joinpath("verdicts.db"))
+    cache = VerdictCache(path)
+
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_writer, args=(path, worker)) for worker in range(4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+
+    assert len(cache) == 200
+    assert cache.get("3-49", "goose.onnx", "1", "", "resnet") == (True, (0.5, 0.5))
+
+
+def test_classify_images(modelhub: ModelHub, monkeypatch):
+    control = ResNetControl.from_pluggable_model(modelhub.match_net("goose2309.onnx"))
+    expected = control.execute_batch(images)
+
+    assert classify_images(control, images, modelhub, label="goose") == expected
+    assert modelhub.verdict_stats.writes == len(images)
+
+    def execute_batch(img_streams, proba=False):
+        assert not img_streams, "Cached images must skip inference"
+        return []
+
+    monkeypatch.setattr(control, "execute_batch", execute_batch)
+    assert classify_images(control, images, modelhub, label="goose") == expected
+    assert modelhub.verdict_stats.hits == len(images)
+
+    # Another prompt does not reuse the verdicts of the label
+    with pytest.raises(AssertionError):
+        classify_images(control, images, modelhub, label="duck")
+
+
+def test_classify_images_replaced_model(modelhub: ModelHub, monkeypatch):
+    control = ResNetControl.from_pluggable_model(modelhub.match_net("goose2309.onnx"))
+    classify_images(control, images, modelhub, label="goose")
+    assert modelhub.verdict_stats.writes == len(images)
+
+    # A local model without a release node_id is replaced under the same name
+    model_path = modelhub.models_dir.joinpath("goose2309.onnx")
+    stat = model_path.stat()
+    os.utime(model_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    modelhub._verdicts = None
+
+    misses = []
+    execute_batch = control.execute_batch
+
+    def counting_execute_batch(img_streams, proba=False):
+        misses.extend(img_streams)
+        return execute_batch(img_streams, proba=proba)
+
+    monkeypatch.setattr(control, "execute_batch", counting_execute_batch)
+    classify_images(control, images, modelhub, label="goose")
+    assert len(misses) == len(images)
+
+
+def test_classify_images_without_cache(modelhub: ModelHub):
+    modelhub.verdict_cache_path = ""
+    control = ResNetControl.from_pluggable_model(modelhub.match_net("goose2309.onnx"))
+
+    assert classify_images(control, images, modelhub) == control.execute_batch(images)
+    assert modelhub.verdicts is None
+    assert modelhub.verdict_stats is None
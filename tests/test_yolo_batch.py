@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/13 17:40
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import math
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.onnx.modelhub import ModelHub, Assets
+from hcaptcha_challenger.onnx.utils import sigmoid
+from hcaptcha_challenger.onnx.yolo import YOLOv8, YOLOv8Seg, Segmentation
+
+this_dir = Path(__file__).parent
+images = [p.read_bytes() for p in sorted(this_dir.joinpath("goose").glob("*.png"))]
+decoded = [cv2.imdecode(np.frombuffer(image, np.uint8), flags=1) for image in images]
+
+CLASSES = ["goose", "duck"]
+NUM_MASKS = 32
+
+
+def _export_detector(model_path: Path, *, num_masks: int = 0):
+    """A YOLOv8-shaped graph on 32x32 inputs: [1, 4 + classes (+ masks), 64] (+ protos)"""
+    onnx = pytest.importorskip("onnx")
+    from onnx import helper, numpy_helper, TensorProto
+
+    rng = np.random.default_rng(2312)
+    channels = 4 + len(CLASSES) + num_masks
+    scale = np.ones((1, channels, 1), dtype=np.float32)
+    scale[0, :4, 0] = [32, 32, 16, 16]
+
+    initializers = [
+        numpy_helper.from_array(rng.normal(size=(channels, 3, 4, 4)).astype(np.float32), "w"),
+        numpy_helper.from_array(rng.normal(size=channels).astype(np.float32), "b"),
+        numpy_helper.from_array(np.array([1, channels, -1], dtype=np.int64), "shape"),
+        numpy_helper.from_array(scale, "scale"),
+    ]
+    nodes = [
+        helper.make_node("Conv", ["images", "w", "b"], ["conv"], strides=[4, 4]),
+        helper.make_node("Reshape", ["conv", "shape"], ["flat"]),
+        helper.make_node("Sigmoid", ["flat"], ["proba"]),
+        helper.make_node("Mul", ["proba", "scale"], ["output0"]),
+    ]
+    outputs = [helper.make_tensor_value_info("output0", TensorProto.FLOAT, [1, channels, 64])]
+    if num_masks:
+        protos = rng.normal(size=(num_masks, 3, 2, 2)).astype(np.float32)
+        initializers.append(numpy_helper.from_array(protos, "protos"))
+        nodes.append(helper.make_node("Conv", ["images", "protos"], ["output1"], strides=[2, 2]))
+        outputs.append(
+            helper.make_tensor_value_info("output1", TensorProto.FLOAT, [1, num_masks, 16, 16])
+        )
+
+    graph = helper.make_graph(
+        nodes,
+        "detector",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT, [1, 3, 32, 32])],
+        outputs,
+        initializers,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    onnx.save(model, str(model_path))
+
+
+class CountingSession:
+    def __init__(self, session, max_batch: int | None = None):
+        self.session = session
+        self.max_batch = max_batch
+        self.batches = []
+        self.get_inputs_calls = 0
+
+    def get_inputs(self):
+        self.get_inputs_calls += 1
+        return self.session.get_inputs()
+
+    def get_outputs(self):
+        return self.session.get_outputs()
+
+    def run(self, output_names, input_feed):
+        [blob] = input_feed.values()
+        if self.max_batch and len(blob) > self.max_batch:
+            raise RuntimeError(f"Got invalid dimensions for input: {len(blob)}")
+        self.batches.append(len(blob))
+        return self.session.run(output_names, input_feed)
+
+
+@pytest.fixture()
+def modelhub(tmp_path: Path) -> ModelHub:
+    _export_detector(tmp_path.joinpath("tiny_yolov8.onnx"))
+    _export_detector(tmp_path.joinpath("tiny_yolov8-seg.onnx"), num_masks=NUM_MASKS)
+
+    modelhub = ModelHub()
+    modelhub.models_dir = tmp_path
+    modelhub.optimized_dir = tmp_path.joinpath("_optimized")
+    modelhub.assets = Assets(release_url="", _assets_dir=tmp_path, _memory_dir=tmp_path)
+    return modelhub
+
+
+def _assert_same(actual, expected):
+    assert len(actual) == len(expected)
+    for result, result_ in zip(actual, expected):
+        assert len(result) == len(result_)
+        for (name, *coords, score), (name_, *coords_, score_) in zip(result, result_):
+            assert name == name_
+            assert np.allclose(coords, coords_, atol=1e-3)
+            assert score == pytest.approx(score_, abs=1e-5)
+
+
+@pytest.mark.parametrize("shape_type", ["point", "bounding_box"])
+def test_detect_batch(modelhub: ModelHub, shape_type: str):
+    session = CountingSession(modelhub.match_net("tiny_yolov8.onnx"))
+    detector = YOLOv8.from_pluggable_model(session, CLASSES)
+    assert detector.dynamic_batch
+
+    expected = [detector(image, shape_type=shape_type) for image in images]
+    assert any(expected), "The fixture detects nothing"
+    session.batches.clear()
+
+    actual = detector.detect_batch([*images, b""], shape_type=shape_type)
+    assert actual[-1] is None
+    _assert_same(actual[:-1], expected)
+    assert session.batches == [len(images)]
+
+
+def test_detect_batch_fixed(modelhub: ModelHub):
+    modelhub.batch_yolo = False
+    session = CountingSession(modelhub.match_net("tiny_yolov8.onnx"))
+    detector = YOLOv8.from_pluggable_model(session, CLASSES)
+    assert not detector.dynamic_batch
+
+    actual = detector.detect_batch(images)
+    assert session.batches == [1] * len(images)
+    _assert_same(actual, [detector(image) for image in images])
+
+
+def test_detect_batch_rejected(modelhub: ModelHub):
+    session = CountingSession(modelhub.match_net("tiny_yolov8.onnx"), max_batch=1)
+    detector = YOLOv8.from_pluggable_model(session, CLASSES)
+
+    actual = detector.detect_batch(images)
+    assert not detector._batchable
+    assert session.batches == [1] * len(images)
+    _assert_same(actual, [detector(image) for image in images])
+
+
+def test_rejected_batch_is_remembered(modelhub: ModelHub):
+    session = CountingSession(modelhub.match_net("tiny_yolov8.onnx"), max_batch=1)
+    YOLOv8.from_pluggable_model(session, CLASSES).detect_batch(images)
+    session.batches.clear()
+
+    detector = YOLOv8.from_pluggable_model(session, CLASSES)
+    assert not detector._batchable
+    detector.detect_batch(images)
+    assert session.batches == [1] * len(images)
+
+
+def test_segment_batch(modelhub: ModelHub):
+    session = CountingSession(modelhub.match_net("tiny_yolov8-seg.onnx"))
+    detector = YOLOv8Seg.from_pluggable_model(session, CLASSES)
+    assert detector.dynamic_batch
+
+    expected = [detector(image, shape_type="bounding_box") for image in images]
+    assert any(expected), "The fixture segments nothing"
+    masks = [detector.segment_objects(image)[-1] for image in decoded]
+    session.batches.clear()
+
+    _assert_same(detector.detect_batch(images, shape_type="bounding_box"), expected)
+    assert session.batches == [len(images)]
+
+    for (*_, masks_), expected_masks in zip(detector.segment_objects_batch(decoded), masks):
+        _assert_same_masks(masks_, expected_masks)
+
+
+def _assert_same_masks(actual, expected):
+    assert len(actual) == len(expected)
+    for mask, mask_ in zip(actual, expected):
+        assert (mask.x1, mask.y1) == (mask_.x1, mask_.y1)
+        assert mask.mask.dtype == np.uint8
+        assert np.array_equal(mask.mask, mask_.mask)
+
+
+def _legacy_mask_maps(segmentation: Segmentation):
+    """`YOLOv8Seg.process_mask_output` before crop-local masks"""
+    img_height, img_width = segmentation.img_height, segmentation.img_width
+    if not len(segmentation.mask_predictions):
+        return np.zeros((0, img_height, img_width))
+
+    mask_output = np.squeeze(segmentation.mask_output)
+    num_mask, mask_height, mask_width = mask_output.shape
+    masks = sigmoid(segmentation.mask_predictions @ mask_output.reshape((num_mask, -1)))
+    masks = masks.reshape((-1, mask_height, mask_width))
+    boxes = segmentation.boxes
+    scale_boxes = YOLOv8Seg.rescale_boxes(boxes, (img_height, img_width), (mask_height, mask_width))
+
+    mask_maps = np.zeros((len(scale_boxes), img_height, img_width))
+    blur_size = (int(img_width / mask_width), int(img_height / mask_height))
+    for i in range(len(scale_boxes)):
+        sx1, sy1 = (int(math.floor(v)) for v in scale_boxes[i][:2])
+        sx2, sy2 = (int(math.ceil(v)) for v in scale_boxes[i][2:])
+        x1, y1 = (int(math.floor(v)) for v in boxes[i][:2])
+        x2, y2 = (int(math.ceil(v)) for v in boxes[i][2:])
+        crop_mask = cv2.resize(
+            masks[i][sy1:sy2, sx1:sx2], (x2 - x1, y2 - y1), interpolation=cv2.INTER_CUBIC
+        )
+        crop_mask = cv2.blur(crop_mask, blur_size)
+        mask_maps[i, y1:y2, x1:x2] = (crop_mask > 0.5).astype(np.uint8)
+    return mask_maps
+
+
+def test_lazy_masks(modelhub: ModelHub):
+    detector = YOLOv8Seg.from_pluggable_model(modelhub.match_net("tiny_yolov8-seg.onnx"), CLASSES)
+
+    segmented = 0
+    for image, image_ in zip(images, decoded):
+        assert detector(image) == detector(image, shape_type="point")
+        assert "masks" not in vars(detector._last)
+        *_, no_masks = detector.segment_objects(image_, masks=False)
+        assert no_masks is None and "masks" not in vars(detector._last)
+
+        # The masks of the last image are computed once, on first read
+        expected = _legacy_mask_maps(detector._last)
+        assert np.array_equal(detector.mask_maps, expected)
+        assert detector.masks is detector.masks
+        _assert_same_masks(detector.masks, detector.segment_objects(image_)[-1])
+        segmented += len(expected)
+    assert segmented, "The fixture segments nothing"
+
+
+def test_step_by_step_api(modelhub: ModelHub):
+    """prepare_input, inference and the post-processing without passing letterboxes"""
+    detector = YOLOv8Seg.from_pluggable_model(modelhub.match_net("tiny_yolov8-seg.onnx"), CLASSES)
+    with pytest.raises(ValueError):
+        detector.process_box_output(np.zeros((1, 4 + len(CLASSES) + NUM_MASKS, 64)))
+
+    segmented = 0
+    for image in decoded:
+        boxes_, scores_, class_ids_, masks_ = detector.segment_objects(image)
+        outputs = detector.inference(detector.prepare_input(image))
+        boxes, scores, class_ids, mask_pred = detector.process_box_output(outputs[0])
+        assert np.allclose(boxes, boxes_) and np.array_equal(class_ids, class_ids_)
+        _assert_same_masks(detector.process_mask_output(mask_pred, outputs[1], boxes), masks_)
+        segmented += len(masks_)
+    assert segmented, "The fixture segments nothing"
+
+    yolo = YOLOv8.from_pluggable_model(modelhub.match_net("tiny_yolov8.onnx"), CLASSES)
+    for image in decoded:
+        boxes_, scores_, _ = yolo.detect_objects(image)
+        output = yolo.session.run(yolo.output_names, {"images": yolo._prepare_input(image)})
+        assert np.allclose(yolo._process_output(output).boxes, boxes_)
+
+
+def test_session_meta_cached(modelhub: ModelHub):
+    session = CountingSession(modelhub.match_net("tiny_yolov8.onnx"))
+    detectors = [YOLOv8.from_pluggable_model(session, CLASSES) for _ in range(3)]
+    assert session.get_inputs_calls == 1
+    assert all(detector.input_shape == detectors[0].input_shape for detector in detectors)
+
+    YOLOv8(session=session, classes=CLASSES, letterbox=True)
+    assert session.get_inputs_calls == 1
+
+
+@pytest.mark.parametrize("seg", [False, True])
+def test_shared_detector_threads(modelhub: ModelHub, seg: bool):
+    if seg:
+        session = modelhub.match_net("tiny_yolov8-seg.onnx")
+        detector = YOLOv8Seg.from_pluggable_model(session, CLASSES)
+        segment = detector.segment
+    else:
+        detector = YOLOv8.from_pluggable_model(modelhub.match_net("tiny_yolov8.onnx"), CLASSES)
+        segment = detector.detect
+    expected = [segment(image) for image in decoded]
+    expected_batch = detector.detect_batch(images, shape_type="bounding_box")
+
+    def work(k: int):
+        # Odd workers run batches, the images of one run must not leak into another
+        for _ in range(5):
+            if k % 2:
+                assert detector.detect_batch(images, shape_type="bounding_box") == expected_batch
+                continue
+            for image, result_ in zip(decoded, expected):
+                result = segment(image)
+                assert np.array_equal(result.boxes, result_.boxes)
+                assert np.array_equal(result.scores, result_.scores)
+                if seg:
+                    _assert_same_masks(result.masks, result_.masks)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(work, k) for k in range(8)]:
+            future.result()
+
+    # What the old attributes read is the last image of the calling thread
+    detector.detect_batch(images[:1])
+    assert (detector.img_height, detector.img_width) == decoded[0].shape[:2]
+
+
+def test_letterbox_detector(modelhub: ModelHub):
+    session = modelhub.match_net("tiny_yolov8.onnx")
+    stretched = YOLOv8.from_pluggable_model(session, CLASSES)
+    letterboxed = YOLOv8(session=session, classes=CLASSES, letterbox=True)
+
+    # Square images fill the square input either way
+    square = [image for image in decoded if image.shape[0] == image.shape[1]]
+    for image in square:
+        tensor, _ = letterboxed._inputs.fill([image])
+        assert np.array_equal(tensor, stretched._inputs.fill([image])[0])
+    _assert_same(letterboxed.detect_batch(images), stretched.detect_batch(images))
+
+    segment = YOLOv8Seg(
+        classes=CLASSES, session=modelhub.match_net("tiny_yolov8-seg.onnx"), letterbox=True
+    )
+    # Half height images are padded above and below
+    wide = [image[: image.shape[0] // 2] for image in decoded]
+    for image, result in zip(wide, segment.segment_objects_batch(wide)):
+        height, width = image.shape[:2]
+        boxes, scores, class_ids, masks = result
+        assert np.all(boxes[:, [0, 2]] <= width) and np.all(boxes[:, [1, 3]] <= height)
+        assert len(masks) == len(boxes)
+        for mask in masks:
+            assert mask.y1 + len(mask.mask) <= height and mask.x1 + mask.mask.shape[1] <= width
+        assert np.array_equal(segment.segment_objects(image)[0], boxes)
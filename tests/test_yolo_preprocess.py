@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Time       : 2023/12/14 11:05
+# Author     : QIN2DIM
+# GitHub     : https://github.com/QIN2DIM
+# Description:
+import cv2
+import numpy as np
+import pytest
+
+from hcaptcha_challenger.onnx.preprocess import InputTensor, Letterbox, LETTERBOX_PAD
+
+rng = np.random.default_rng(2312)
+
+
+def legacy_prepare_input(image: np.ndarray, height: int, width: int) -> np.ndarray:
+    input_img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    input_img = cv2.resize(input_img, (width, height))
+    input_img = input_img / 255.0
+    input_img = input_img.transpose(2, 0, 1)
+    return input_img[np.newaxis, :, :, :].astype(np.float32)
+
+
+@pytest.mark.parametrize("shape", [(128, 128), (144, 144), (500, 520), (300, 80)])
+def test_input_tensor_matches_legacy(shape):
+    image = rng.integers(0, 256, (*shape, 3), dtype=np.uint8)
+    inputs = InputTensor(64, 96)
+
+    tensor, [letterbox] = inputs.fill([image])
+    assert tensor.dtype == np.float32
+    assert np.array_equal(tensor, legacy_prepare_input(image, 64, 96))
+    assert letterbox == Letterbox(*shape, 64, 96)
+
+
+def test_input_tensor_reuses_buffers():
+    images = [rng.integers(0, 256, (128, 128, 3), dtype=np.uint8) for _ in range(9)]
+    inputs = InputTensor(64, 64)
+
+    tensor, _ = inputs.fill(images)
+    resized = inputs._resized
+    again, _ = inputs.fill(images[:4])
+    assert np.shares_memory(tensor, again)
+    assert inputs._resized is resized
+    for i, image in enumerate(images[:4]):
+        assert np.array_equal(again[i : i + 1], legacy_prepare_input(image, 64, 64))
+
+
+def test_letterbox():
+    image = rng.integers(0, 256, (100, 200, 3), dtype=np.uint8)
+    inputs = InputTensor(64, 64, letterbox=True)
+
+    tensor, [letterbox] = inputs.fill([image])
+    assert letterbox == Letterbox(100, 200, 32, 64, pad_top=16, pad_left=0)
+
+    pad = np.float32(LETTERBOX_PAD / 255.0)
+    assert np.all(tensor[0, :, :16] == pad)
+    assert np.all(tensor[0, :, 48:] == pad)
+    content = cv2.cvtColor(cv2.resize(image, (64, 32)), cv2.COLOR_BGR2RGB)
+    assert np.array_equal(tensor[0, :, 16:48], content.transpose(2, 0, 1) / np.float32(255.0))
+
+    # The content of the input covers the whole image
+    boxes = np.array([[32, 32, 64, 32]], dtype=np.float32)
+    assert np.allclose(letterbox.unmap(boxes), [[100, 50, 200, 100]])
+    corners = np.array([[0, 0, 200, 100]], dtype=np.float32)
+    assert np.allclose(letterbox.map(corners), [[0, 16, 64, 48]])